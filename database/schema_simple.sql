@@ -16,7 +16,8 @@ CREATE TABLE IF NOT EXISTS bird_detections (
     location TEXT,
     species TEXT,
     analysis_date TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    detection_time_utc TEXT  -- 検出の絶対時刻 (UTC, 'YYYY-MM-DD HH:MM:SS.sss')
 );
 
 -- インデックス作成
@@ -25,3 +26,80 @@ CREATE INDEX IF NOT EXISTS idx_species ON bird_detections(scientific_name, commo
 CREATE INDEX IF NOT EXISTS idx_confidence ON bird_detections(confidence);
 CREATE INDEX IF NOT EXISTS idx_location ON bird_detections(location);
 CREATE INDEX IF NOT EXISTS idx_analysis_date ON bird_detections(analysis_date);
+CREATE INDEX IF NOT EXISTS idx_detection_time ON bird_detections(detection_time_utc);
+CREATE INDEX IF NOT EXISTS idx_species_time ON bird_detections(scientific_name, detection_time_utc);
+CREATE INDEX IF NOT EXISTS idx_file ON bird_detections(session_name, file_path);
+CREATE INDEX IF NOT EXISTS idx_session_confidence ON bird_detections(session_name, confidence);
+CREATE INDEX IF NOT EXISTS idx_species_confidence ON bird_detections(scientific_name, confidence);
+CREATE INDEX IF NOT EXISTS idx_species_file ON bird_detections(scientific_name, session_name, file_path);
+
+-- 録音ファイルごとの絶対開始時刻（ファイル名またはWAVメタデータから取得）
+CREATE TABLE IF NOT EXISTS recording_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    audio_path TEXT,
+    recording_start_utc TEXT NOT NULL,
+    timestamp_source TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(session_name, file_path)
+);
+
+-- イベントテーブル（重なり合うセグメントの検出を種ごとに1つの鳴き声にまとめたもの）
+-- bird_detections から materialize_events で作成
+CREATE TABLE IF NOT EXISTS bird_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_name TEXT NOT NULL,
+    model_name TEXT,
+    model_type TEXT DEFAULT 'default',
+    filename TEXT NOT NULL,
+    file_path TEXT,
+    start_time_seconds REAL NOT NULL,
+    end_time_seconds REAL NOT NULL,
+    scientific_name TEXT,
+    common_name TEXT,
+    max_confidence REAL NOT NULL,
+    mean_confidence REAL NOT NULL,
+    hit_count INTEGER NOT NULL,
+    gap_seconds REAL NOT NULL,
+    location TEXT,
+    species TEXT,
+    analysis_date TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_events_session_name ON bird_events(session_name);
+CREATE INDEX IF NOT EXISTS idx_events_species ON bird_events(scientific_name, common_name);
+CREATE INDEX IF NOT EXISTS idx_events_confidence ON bird_events(max_confidence);
+
+-- 時間帯別の検出数の集計テーブル（UTCの日付・時ごと、信頼度の下限0.05刻み）
+-- 絶対時刻のある検出から BirdNetSimpleDB が自動的に更新する
+CREATE TABLE IF NOT EXISTS activity_rollup (
+    session_name TEXT NOT NULL,
+    scientific_name TEXT NOT NULL,
+    common_name TEXT,
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    -- count_XX: 信頼度 >= 0.XX の検出数
+    count_00 INTEGER NOT NULL DEFAULT 0, count_05 INTEGER NOT NULL DEFAULT 0, count_10 INTEGER NOT NULL DEFAULT 0, count_15 INTEGER NOT NULL DEFAULT 0,
+    count_20 INTEGER NOT NULL DEFAULT 0, count_25 INTEGER NOT NULL DEFAULT 0, count_30 INTEGER NOT NULL DEFAULT 0, count_35 INTEGER NOT NULL DEFAULT 0,
+    count_40 INTEGER NOT NULL DEFAULT 0, count_45 INTEGER NOT NULL DEFAULT 0, count_50 INTEGER NOT NULL DEFAULT 0, count_55 INTEGER NOT NULL DEFAULT 0,
+    count_60 INTEGER NOT NULL DEFAULT 0, count_65 INTEGER NOT NULL DEFAULT 0, count_70 INTEGER NOT NULL DEFAULT 0, count_75 INTEGER NOT NULL DEFAULT 0,
+    count_80 INTEGER NOT NULL DEFAULT 0, count_85 INTEGER NOT NULL DEFAULT 0, count_90 INTEGER NOT NULL DEFAULT 0, count_95 INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (session_name, scientific_name, day, hour)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rollup_species ON activity_rollup(scientific_name, day);
+
+-- インポート済みの結果ファイル（同じセッションへの同じファイルの再インポートを防ぐ）
+-- サイズと更新時刻が同じなら内容を読まずに、内容のハッシュが同じなら読み込んだ上でスキップ
+CREATE TABLE IF NOT EXISTS import_ledger (
+    session_name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    file_mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,  -- SHA-256
+    row_count INTEGER NOT NULL,
+    imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_name, file_path)
+);
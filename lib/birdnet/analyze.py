@@ -1,24 +1,39 @@
 """Module to analyze audio samples."""
 
 import argparse
+import contextlib
 import datetime
+import functools
 import json
+import math
 import multiprocessing
 import operator
 import os
+import shutil
 import sys
+import time
 from multiprocessing import Pool, freeze_support
 
 import numpy as np
 
 import audio
+import checkpoint
 import config as cfg
 import model
+import result_writers
 import species
 import utils
 
-#                    0       1      2           3             4              5               6                7           8             9           10         11
-RTABLE_HEADER = "Selection\tView\tChannel\tBegin Time (s)\tEnd Time (s)\tLow Freq (Hz)\tHigh Freq (Hz)\tCommon Name\tSpecies Code\tConfidence\tBegin Path\tFile Offset (s)\n"
+# Names of the outputs of a forward pass
+DETECTIONS = "detections"
+DEFAULT_DETECTIONS = "default"
+EMBEDDINGS = "embeddings"
+EVENTS = "events"
+
+RTABLE_HEADER = result_writers.RTABLE_HEADER
+
+# Durations of the analyzed files in the output folder, used to combine results
+DURATIONS_FILE = "BirdNET.durations.jsonl"
 
 
 def loadCodes():
@@ -33,252 +48,219 @@ def loadCodes():
     return codes
 
 
-def saveResultFile(r: dict[str, list], path: str, afile_path: str):
+def saveResultFile(r: dict[str, list], path: str, afile_path: str, model_name: str = None):
     """Saves the results to the hard drive.
 
+    Rows are streamed into the result file by the writer of cfg.RESULT_TYPE.
+
     Args:
         r: The dictionary with {segment: scores}.
         path: The path where the result should be saved.
         afile_path: The path to audio file.
+        model_name: Name of the model, for formats that store it. Defaults to the model file name.
     """
-    # Make folder if it doesn't exist
-    if os.path.dirname(path):
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with result_writers.getWriter()(path, afile_path, model_name) as writer:
+        for timestamp in getSortedTimestamps(r):
+            start, end = timestamp.split("-", 1)
+            writer.writeSegment(start, end, r[timestamp])
 
-    # Selection table
-    out_string = ""
 
-    if cfg.RESULT_TYPE == "table":
-        selection_id = 0
-        filename = os.path.basename(afile_path)
+def recordDuration(result_path: str, afile_path: str, duration: float):
+    """Records the duration of an analyzed file in the durations file of the output folder.
 
-        # Write header
-        out_string += RTABLE_HEADER
+    Combining results uses these durations instead of opening the audio files.
 
-        # Read native sample rate
-        high_freq = audio.get_sample_rate(afile_path) / 2
+    Args:
+        result_path: Path to the result file.
+        afile_path: The path to audio file.
+        duration: The length of the audio file in seconds.
+    """
+    if not os.path.isdir(cfg.OUTPUT_PATH):
+        return
 
-        if high_freq > cfg.SIG_FMAX:
-            high_freq = cfg.SIG_FMAX
+    entry = {"result": os.path.relpath(result_path, cfg.OUTPUT_PATH), "audio": afile_path, "duration": duration}
 
-        high_freq = min(high_freq, cfg.BANDPASS_FMAX)
-        low_freq = max(cfg.SIG_FMIN, cfg.BANDPASS_FMIN)
+    # Appending one short line is atomic, so parallel workers can share the file
+    with open(os.path.join(cfg.OUTPUT_PATH, DURATIONS_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
 
-        # Extract valid predictions for every timestamp
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (
-                    not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST
-                ):
-                    selection_id += 1
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    code = cfg.CODES[c[0]] if c[0] in cfg.CODES else c[0]
-                    rstring += f"{selection_id}\tSpectrogram 1\t1\t{start}\t{end}\t{low_freq}\t{high_freq}\t{label.split('_', 1)[-1]}\t{code}\t{c[1]:.4f}\t{afile_path}\t{start}\n"
-
-            # Write result string to file
-            out_string += rstring
-
-        # If we don't have any valid predictions, we still need to add a line to the selection table in case we want to combine results
-        # TODO: That's a weird way to do it, but it works for now. It would be better to keep track of file durations during the analysis.
-        if len(out_string) == len(RTABLE_HEADER) and cfg.OUTPUT_PATH is not None:
-            selection_id += 1
-            out_string += f"{selection_id}\tSpectrogram 1\t1\t0\t3\t{low_freq}\t{high_freq}\tnocall\tnocall\t1.0\t{afile_path}\t0\n"
-
-    elif cfg.RESULT_TYPE == "audacity":
-        # Audacity timeline labels
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
+def readDurations(folder: str):
+    """Reads the durations file of an output folder.
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (
-                    not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST
-                ):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    ts = timestamp.replace("-", "\t")
-                    lbl = label.replace("_", ", ")
-                    rstring += f"{ts}\t{lbl}\t{c[1]:.4f}\n"
+    Args:
+        folder: The output folder.
 
-            # Write result string to file
-            out_string += rstring
+    Returns:
+        A dictionary with {result path: (audio path, duration)}, the latest entry wins.
+    """
+    durations = {}
+    path = os.path.join(folder, DURATIONS_FILE)
 
-    elif cfg.RESULT_TYPE == "r":
-        # Output format for R
-        header = "filepath,start,end,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity,min_conf,species_list,model"
-        out_string += header
+    if not os.path.isfile(path):
+        return durations
 
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partial line of an interrupted write
+                continue
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (
-                    not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST
-                ):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "\n{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{},{},{},{}".format(
-                        afile_path,
-                        start,
-                        end,
-                        label.split("_", 1)[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                        cfg.LATITUDE,
-                        cfg.LONGITUDE,
-                        cfg.WEEK,
-                        cfg.SIG_OVERLAP,
-                        (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
-                        cfg.MIN_CONFIDENCE,
-                        cfg.SPECIES_LIST_FILE,
-                        os.path.basename(cfg.MODEL_PATH),
-                    )
-
-            # Write result string to file
-            out_string += rstring
-
-    elif cfg.RESULT_TYPE == "kaleidoscope":
-        # Output format for kaleidoscope
-        header = "INDIR,FOLDER,IN FILE,OFFSET,DURATION,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity"
-        out_string += header
-
-        folder_path, filename = os.path.split(afile_path)
-        parent_folder, folder_name = os.path.split(folder_path)
+            durations[os.path.normpath(os.path.join(folder, entry["result"]))] = (entry["audio"], entry["duration"])
 
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
+    return durations
 
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (
-                    not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST
-                ):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += (
-                        "\n{},{},{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{}".format(
-                            parent_folder.rstrip("/"),
-                            folder_name,
-                            filename,
-                            start,
-                            float(end) - float(start),
-                            label.split("_", 1)[0],
-                            label.split("_", 1)[-1],
-                            c[1],
-                            cfg.LATITUDE,
-                            cfg.LONGITUDE,
-                            cfg.WEEK,
-                            cfg.SIG_OVERLAP,
-                            (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
-                        )
-                    )
-
-            # Write result string to file
-            out_string += rstring
 
-    else:
-        # CSV output file
-        header = "Start (s),End (s),Scientific name,Common name,Confidence\n"
+def inspectSelectionTable(item):
+    """Counts the selections of a table and gets the duration of its audio file.
 
-        # Write header
-        out_string += header
+    Args:
+        item: Tuple containing (result file, (audio file, duration) or None, config)
 
-        for timestamp in getSortedTimestamps(r):
-            rstring = ""
+    Returns:
+        A tuple of (result file, audio file, duration, number of selections),
+        None if the file is not a selection table or cannot be read.
+    """
+    rfile, recorded, config = item
+    cfg.setConfig(config)
+    afile, duration = recorded or (None, None)
+    num_rows = 0
 
-            for c in r[timestamp]:
-                start, end = timestamp.split("-", 1)
-                formatted_start_time = (
-                    f"{int(float(start)//60)}m{int(float(start)%60)}s"
-                )
-                formatted_end_time = f"{int(float(end)//60)}m{int(float(end)%60)}s"
-                print(formatted_start_time)
-
-                if c[1] > cfg.MIN_CONFIDENCE and (
-                    not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST
-                ):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "{},{},{},{},{:.4f}\n".format(
-                        # start,
-                        formatted_start_time,
-                        # end,
-                        formatted_end_time,
-                        label.split("_", 1)[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                    )
-
-            # Write result string to file
-            out_string += rstring
-
-    # Save as file
-    with open(path, "w", encoding="utf-8") as rfile:
-        rfile.write(out_string)
-
-
-def combineResults(folder: str, output_file: str):
-    # Read all files
-    files = utils.collect_all_files(folder, ["txt"], pattern="BirdNET.selection.table")
+    try:
+        with open(rfile, "r", encoding="utf-8") as rf:
+            # make sure it's a selection table
+            header = rf.readline()
+
+            if not "Selection" in header or not "File Offset" in header:
+                return None
+
+            for line in rf:
+                # Tables of older versions have a dummy 'nocall' line
+                if afile is None and line.strip():
+                    afile = line.split("\t")[10]
+
+                if line.strip() and not "\tnocall\tnocall\t" in line:
+                    num_rows += 1
+
+        # Tables without an entry in the durations file
+        if duration is None:
+            if afile is None:
+                return None
+
+            duration = audio.getAudioFileLength(afile, cfg.SAMPLE_RATE)
+
+    except Exception as ex:
+        print(f"Error: Cannot combine results from {rfile}.\n", flush=True)
+        utils.writeErrorLog(ex)
+
+        return None
 
-    # Combine all files
-    s_id = 1
-    time_offset = 0
-    audiofiles = []
+    return rfile, afile, duration, num_rows
 
-    with open(os.path.join(folder, output_file), "w", encoding="utf-8") as f:
-        f.write(RTABLE_HEADER)
 
-        for rfile in files:
+def combineSelectionTables(item):
+    """Writes a chunk of selection tables with their final selection IDs and times.
+
+    Args:
+        item: Tuple containing (list of (result file, first selection ID, time offset), part path)
+
+    Returns:
+        The part path.
+    """
+    tables, part_path = item
+
+    with open(part_path, "w", encoding="utf-8", buffering=result_writers.WRITE_BUFFER_SIZE) as f:
+        for rfile, s_id, time_offset in tables:
             with open(rfile, "r", encoding="utf-8") as rf:
-                try:
-                    lines = rf.readlines()
+                # skip header
+                rf.readline()
 
-                    # make sure it's a selection table
-                    if not "Selection" in lines[0] or not "File Offset" in lines[0]:
+                for line in rf:
+                    # skip empty and dummy lines
+                    if not line.strip() or "\tnocall\tnocall\t" in line:
                         continue
 
-                    # skip header and add to file
-                    f_name = lines[1].split("\t")[10]
-                    f_duration = audio.getAudioFileLength(f_name, cfg.SAMPLE_RATE)
+                    # adjust selection id and time
+                    line = line.split("\t")
+                    line[0] = str(s_id)
+                    line[3] = str(float(line[3]) + time_offset)
+                    line[4] = str(float(line[4]) + time_offset)
+                    s_id += 1
 
-                    audiofiles.append(f_name)
+                    f.write("\t".join(line))
 
-                    for line in lines[1:]:
-                        # empty line?
-                        if not line.strip():
-                            continue
+    return part_path
 
-                        # Is species code and common name == 'nocall'?
-                        # If so, that's a dummy line and we can skip it
-                        if (
-                            line.split("\t")[7] == "nocall"
-                            and line.split("\t")[8] == "nocall"
-                        ):
-                            continue
 
-                        # adjust selection id
-                        line = line.split("\t")
-                        line[0] = str(s_id)
-                        s_id += 1
+def combineResults(folder: str, output_file: str, num_workers: int = None):
+    """Combines the selection tables of a folder into one table.
 
-                        # adjust time
-                        line[3] = str(float(line[3]) + time_offset)
-                        line[4] = str(float(line[4]) + time_offset)
+    Selections of each file are shifted by the durations of all previous
+    files. Durations come from the durations file written during analysis,
+    only tables without an entry need their audio file. Tables are first
+    counted, then written in parallel chunks with their final selection IDs
+    and times, and the chunks are concatenated.
 
-                        # write line
-                        f.write("\t".join(line))
+    Args:
+        folder: Folder with the selection tables, searched recursively.
+        output_file: Name of the combined table in `folder`.
+        num_workers: Number of worker processes. Defaults to cfg.CPU_THREADS.
+    """
+    num_workers = max(1, num_workers or cfg.CPU_THREADS)
+    output_path = os.path.join(folder, output_file)
+    config = cfg.getConfig()
 
-                    # adjust time offset
-                    time_offset += f_duration
+    # Read all files
+    durations = readDurations(folder)
+    files = [
+        f
+        for f in utils.collect_all_files(folder, ["txt"], pattern="BirdNET.selection.table")
+        if os.path.normpath(f) != os.path.normpath(output_path)
+    ]
+
+    with Pool(num_workers) if num_workers > 1 and len(files) > 1 else contextlib.nullcontext() as p:
+        imap = functools.partial(p.imap, chunksize=16) if p else map
+        tables = [
+            t for t in imap(inspectSelectionTable, [(f, durations.get(os.path.normpath(f)), config) for f in files]) if t
+        ]
+
+        # First selection ID and time offset of every table
+        s_id = 1
+        time_offset = 0
+        offsets = []
+
+        for rfile, _, duration, num_rows in tables:
+            offsets.append((rfile, s_id, time_offset))
+            s_id += num_rows
+            time_offset += duration
+
+        chunk_size = max(1, math.ceil(len(offsets) / (num_workers * 4)))
+        chunks = [
+            (offsets[i : i + chunk_size], f"{output_path}.part{i // chunk_size}.tmp")
+            for i in range(0, len(offsets), chunk_size)
+        ]
+
+        parts = list(imap(combineSelectionTables, chunks))
+
+    try:
+        with open(output_path + ".tmp", "wb") as f:
+            f.write(RTABLE_HEADER.encode("utf-8"))
 
-                except Exception as ex:
-                    print(f"Error: Cannot combine results from {rfile}.\n", flush=True)
-                    utils.writeErrorLog(ex)
+            for part in parts:
+                with open(part, "rb") as pf:
+                    shutil.copyfileobj(pf, f, result_writers.WRITE_BUFFER_SIZE)
+
+        os.replace(output_path + ".tmp", output_path)
+    finally:
+        for part in parts:
+            os.remove(part)
 
     listfilesname = output_file.rsplit(".", 1)[0] + ".list.txt"
 
     with open(os.path.join(folder, listfilesname), "w", encoding="utf-8") as f:
-        f.writelines((f + "\n" for f in audiofiles))
+        f.writelines((afile + "\n" for _, afile, _, _ in tables))
 
 
 def getSortedTimestamps(results: dict[str, list]):
@@ -293,26 +275,28 @@ def getSortedTimestamps(results: dict[str, list]):
     return sorted(results, key=lambda t: float(t.split("-", 1)[0]))
 
 
-def getRawAudioFromFile(fpath: str, offset, duration):
+def getRawAudioFromFile(fpath: str, offset, duration, overlap=None):
     """Reads an audio file.
 
     Reads the file and splits the signal into chunks.
 
     Args:
         fpath: Path to the audio file.
+        overlap: Overlap of the chunks in seconds. Defaults to cfg.SIG_OVERLAP.
 
     Returns:
         The signal split into a list of chunks.
     """
+    if overlap is None:
+        overlap = cfg.SIG_OVERLAP
+
     # Open file
     sig, rate = audio.openAudioFile(
         fpath, cfg.SAMPLE_RATE, offset, duration, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX
     )
 
     # Split into raw audio chunks
-    chunks = audio.splitSignal(
-        sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN
-    )
+    chunks = audio.splitSignal(sig, rate, cfg.SIG_LENGTH, overlap, cfg.SIG_MINLEN)
 
     return chunks
 
@@ -332,16 +316,250 @@ def predict(samples):
 
     # Logits or sigmoid activations?
     if cfg.APPLY_SIGMOID:
-        prediction = model.flat_sigmoid(
-            np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY
-        )
+        prediction = applySigmoid(prediction)
 
     return prediction
 
 
+def applySigmoid(prediction):
+    """Converts logits to sigmoid activations with the configured sensitivity."""
+    return model.flat_sigmoid(np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY)
+
+
+def predictOutputs(samples):
+    """Predicts all requested outputs for the given samples.
+
+    Scores of the default model, scores of the custom classifiers and the
+    embeddings are all taken from a single forward pass through BirdNET.
+
+    Args:
+        samples: Samples to be predicted.
+
+    Returns:
+        A dictionary with {output name: scores or embeddings}.
+    """
+    save_default_detections = cfg.CUSTOM_CLASSIFIER is not None and cfg.SAVE_DEFAULT_DETECTIONS
+
+    if not cfg.SAVE_EMBEDDINGS and not save_default_detections and not cfg.ADDITIONAL_CLASSIFIERS:
+        return {DETECTIONS: predict(samples)}
+
+    data = np.array(samples, dtype="float32")
+    logits, embeddings = model.predictWithEmbeddings(data)
+    outputs = {}
+
+    if cfg.CUSTOM_CLASSIFIER is not None:
+        # Classifiers on top of the embeddings reuse the forward pass
+        if cfg.ADDITIONAL_CLASSIFIERS:
+            paths = [cfg.CUSTOM_CLASSIFIER] + [c["path"] for c in cfg.ADDITIONAL_CLASSIFIERS]
+            prediction, *additional = model.predictWithClassifiers(data, embeddings, paths)
+
+            for c, p in zip(cfg.ADDITIONAL_CLASSIFIERS, additional):
+                outputs[c["name"]] = applySigmoid(p) if c["apply_sigmoid"] else p
+        else:
+            prediction = model.predictWithCustomClassifier(data, embeddings)
+
+        outputs[DETECTIONS] = applySigmoid(prediction) if cfg.APPLY_SIGMOID else prediction
+
+        if save_default_detections:
+            outputs[DEFAULT_DETECTIONS] = applySigmoid(logits)
+    else:
+        outputs[DETECTIONS] = applySigmoid(logits) if cfg.APPLY_SIGMOID else logits
+
+    if cfg.SAVE_EMBEDDINGS:
+        outputs[EMBEDDINGS] = embeddings
+
+    return outputs
+
+
+def getOutputLabels(output: str):
+    """Gets the labels of the scores of an output.
+
+    Args:
+        output: The name of the output.
+
+    Returns:
+        The list of labels.
+    """
+    if output == DEFAULT_DETECTIONS:
+        return cfg.DEFAULT_LABELS
+
+    for c in cfg.ADDITIONAL_CLASSIFIERS:
+        if c["name"] == output:
+            return c["labels"]
+
+    return cfg.LABELS
+
+
+def addPredictionsToResults(results: dict[str, dict], samples, timestamps):
+    """Predicts a batch of samples and stores the sorted scores.
+
+    Args:
+        results: The dictionary with {output name: {segment: scores}} to be extended.
+        samples: The audio chunks of the batch.
+        timestamps: A list of [start, end] for each chunk.
+    """
+    for name, p in predictOutputs(samples).items():
+        output_results = results.setdefault(name, {})
+        labels = getOutputLabels(name)
+
+        for i in range(len(samples)):
+            # Get timestamp
+            s_start, s_end = timestamps[i]
+            timestamp = str(s_start) + "-" + str(s_end)
+
+            # Embeddings are stored as they are
+            if name == EMBEDDINGS:
+                output_results[timestamp] = p[i]
+                continue
+
+            # Assign scores to labels
+            p_labels = zip(labels, p[i])
+
+            # Sort by score
+            p_sorted = sorted(p_labels, key=operator.itemgetter(1), reverse=True)
+
+            # Store results
+            output_results[timestamp] = p_sorted
+
+
+def mergeResults(results: dict[str, dict], other: dict[str, dict]):
+    """Merges the outputs of a work unit into the outputs of a file.
+
+    Args:
+        results: The dictionary with {output name: {segment: scores}} to be extended.
+        other: The outputs to be added.
+    """
+    for name, output_results in other.items():
+        results.setdefault(name, {}).update(output_results)
+
+
+def getCandidateRegions(results: dict[str, list], file_length: float):
+    """Finds the regions that need to be refined in adaptive overlap mode.
+
+    A segment of the first pass is a candidate if any allowed species exceeds
+    cfg.CANDIDATE_CONFIDENCE. For every candidate, all overlapping segments that
+    intersect it are scheduled, neighbouring candidates are merged.
+
+    Args:
+        results: The dictionary with {segment: scores} of the first pass.
+        file_length: The length of the audio file in seconds.
+
+    Returns:
+        A sorted list of (first_start, last_start) tuples of overlapping segments.
+    """
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    regions = []
+
+    for timestamp in getSortedTimestamps(results):
+        start, end = map(float, timestamp.split("-", 1))
+        candidate = False
+
+        # Scores are sorted, so we can stop at the first one below the threshold
+        for c in results[timestamp]:
+            if c[1] <= cfg.CANDIDATE_CONFIDENCE:
+                break
+
+            if not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST:
+                candidate = True
+                break
+
+        if not candidate:
+            continue
+
+        # Overlapping segments that intersect the candidate segment
+        first_start = max(
+            0.0, step * (math.floor(round((start - cfg.SIG_LENGTH) / step, 6)) + 1)
+        )
+        last_start = min(
+            step * (math.ceil(round(end / step, 6)) - 1),
+            file_length - cfg.SIG_MINLEN,
+        )
+
+        if last_start < first_start:
+            continue
+
+        if regions and first_start <= regions[-1][1] + step:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], last_start))
+        else:
+            regions.append((first_start, last_start))
+
+    return regions
+
+
+def refineResults(fpath: str, results: dict[str, dict], file_length: float):
+    """Runs the overlapping segments around candidate detections.
+
+    Second pass of the adaptive overlap mode. Segments that were already
+    predicted in the first pass are skipped, new segments are added to `results`.
+
+    Args:
+        fpath: Path to the audio file.
+        results: The dictionary with {output name: {segment: scores}} of the first pass.
+        file_length: The length of the audio file in seconds.
+    """
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    regions = []
+
+    # Candidates of all classifiers, every segment is only predicted once
+    for first_start, last_start in sorted(
+        region
+        for name, output_results in results.items()
+        if name != EMBEDDINGS
+        for region in getCandidateRegions(output_results, file_length)
+    ):
+        if regions and first_start <= regions[-1][1] + step:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], last_start))
+        else:
+            regions.append((first_start, last_start))
+
+    for first_start, last_start in regions:
+        # Number of overlapping segments in this region
+        num_segments = int(round((last_start - first_start) / step)) + 1
+        segments_per_block = max(1, int(cfg.FILE_SPLITTING_DURATION / step))
+
+        # Load long regions in blocks to limit memory usage
+        for block in range(0, num_segments, segments_per_block):
+            block_start = first_start + block * step
+            block_segments = min(segments_per_block, num_segments - block)
+            sig, rate = audio.openAudioFile(
+                fpath,
+                cfg.SAMPLE_RATE,
+                block_start,
+                (block_segments - 1) * step + cfg.SIG_LENGTH,
+                cfg.BANDPASS_FMIN,
+                cfg.BANDPASS_FMAX,
+            )
+            samples = []
+            timestamps = []
+
+            for i in range(block_segments):
+                start = round(block_start + i * step, 3)
+
+                # Already predicted in the first pass
+                if abs(start / cfg.SIG_LENGTH - round(start / cfg.SIG_LENGTH)) < 1e-6:
+                    continue
+
+                split_start = int(round((start - block_start) * rate))
+                chunk = sig[split_start : split_start + int(cfg.SIG_LENGTH * rate)]
+
+                if len(chunk) < int(cfg.SIG_MINLEN * rate):
+                    break
+
+                samples.append(audio.pad(chunk, cfg.SIG_LENGTH, rate, 0.5))
+                timestamps.append([start, round(start + cfg.SIG_LENGTH, 3)])
+
+                if len(samples) >= cfg.BATCH_SIZE:
+                    addPredictionsToResults(results, samples, timestamps)
+                    samples = []
+                    timestamps = []
+
+            if samples:
+                addPredictionsToResults(results, samples, timestamps)
+
+
 def get_result_file_name(fpath: str):
     # We have to check if output path is a file or directory
-    if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
+    if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv", "parquet"]:
         rpath = fpath.replace(cfg.INPUT_PATH, "")
         rpath = rpath[1:] if rpath[0] in ["/", "\\"] else rpath
 
@@ -350,18 +568,308 @@ def get_result_file_name(fpath: str):
 
         os.makedirs(rdir, exist_ok=True)
 
-        if cfg.RESULT_TYPE == "table":
-            rtype = ".BirdNET.selection.table.txt"
-        elif cfg.RESULT_TYPE == "audacity":
-            rtype = ".BirdNET.results.txt"
-        else:
-            rtype = ".BirdNET.results.csv"
+        rtype = result_writers.getWriter().suffix
 
         return os.path.join(cfg.OUTPUT_PATH, rpath.rsplit(".", 1)[0] + rtype)
 
     return cfg.OUTPUT_PATH
 
 
+def getWorkUnits(fpath: str, file_length: float):
+    """Splits a file into work units that can be analyzed independently.
+
+    Units are at most cfg.FILE_SPLITTING_DURATION long and aligned to the
+    segment grid, so analyzing all units yields the same segments as
+    analyzing the whole file at once.
+
+    Args:
+        fpath: Path to the audio file.
+        file_length: The length of the audio file in seconds.
+
+    Returns:
+        A list of (file path, offset, duration, file length) tuples.
+    """
+    overlap = 0.0 if cfg.ADAPTIVE_OVERLAP else cfg.SIG_OVERLAP
+    step = cfg.SIG_LENGTH - overlap
+    unit_duration = step * max(1, int(cfg.FILE_SPLITTING_DURATION / step))
+    num_units = max(1, math.ceil(file_length / unit_duration))
+
+    return [
+        (
+            fpath,
+            round(i * unit_duration, 3),
+            round(min(unit_duration, file_length - i * unit_duration), 3),
+            file_length,
+        )
+        for i in range(num_units)
+    ]
+
+
+def analyzeUnit(item):
+    """Analyzes a time range of a file.
+
+    Segments starting inside the unit are predicted, overlapping segments
+    are allowed to reach into the next unit.
+
+    Args:
+        item: Tuple containing (file path, offset, duration, file length, config)
+
+    Returns:
+        A tuple of (file path, offset, duration, results), results is None on error.
+    """
+    # Get work unit and restore cfg
+    fpath, offset, duration, file_length = item[:4]
+    cfg.setConfig(item[4])
+
+    overlap = 0.0 if cfg.ADAPTIVE_OVERLAP else cfg.SIG_OVERLAP
+    step = cfg.SIG_LENGTH - overlap
+    is_last_unit = offset + duration >= file_length
+    results = {}
+
+    try:
+        # The last unit is read until the end of the file
+        chunks = getRawAudioFromFile(
+            fpath, offset, None if is_last_unit else duration + overlap, overlap
+        )
+
+        # Segments starting after the unit belong to the next unit
+        if not is_last_unit:
+            chunks = chunks[: math.ceil(round(duration / step, 6))]
+
+        samples = []
+        timestamps = []
+
+        for chunk_index, chunk in enumerate(chunks):
+            start = round(offset + chunk_index * step, 3)
+
+            # Add to batch
+            samples.append(chunk)
+            timestamps.append([start, round(start + cfg.SIG_LENGTH, 3)])
+
+            # Check if batch is full or last chunk
+            if len(samples) < cfg.BATCH_SIZE and chunk_index < len(chunks) - 1:
+                continue
+
+            # Predict and add to results
+            addPredictionsToResults(results, samples, timestamps)
+
+            # Clear batch
+            samples = []
+            timestamps = []
+
+        # Refine candidate detections with overlapping segments
+        if cfg.ADAPTIVE_OVERLAP and cfg.SIG_OVERLAP > 0:
+            refineResults(fpath, results, file_length)
+
+    except Exception as ex:
+        # Write error log
+        print(
+            f"Error: Cannot analyze audio file {fpath} at offset {offset}.\n",
+            flush=True,
+        )
+        utils.writeErrorLog(ex)
+
+        return fpath, offset, duration, None
+
+    # Only keep scores that can make it into the result files
+    for name, output_results in results.items():
+        if name == EMBEDDINGS:
+            continue
+
+        for timestamp, scores in output_results.items():
+            output_results[timestamp] = [c for c in scores if c[1] > cfg.MIN_CONFIDENCE]
+
+    return fpath, offset, duration, results
+
+
+def getOutputFileName(fpath: str, output: str):
+    """Gets the file name for an additional output of an audio file.
+
+    Args:
+        fpath: Path to the audio file.
+        output: The name of the output.
+
+    Returns:
+        The path of the output file, derived from the result file name.
+    """
+    result_file_name = get_result_file_name(fpath)
+    folder, name = os.path.split(result_file_name)
+
+    if ".BirdNET." in name:
+        base, rtype = name.rsplit(".BirdNET.", 1)
+    else:
+        base, rtype = name.rsplit(".", 1)[0], name.rsplit(".", 1)[-1]
+
+    if output == DETECTIONS:
+        return result_file_name
+
+    if output == EMBEDDINGS:
+        return os.path.join(folder, f"{base}.birdnet.embeddings")
+
+    if output == EVENTS:
+        return os.path.join(folder, base + result_writers.EventsWriter.suffix)
+
+    # Detections of the default model or an additional classifier
+    if ".BirdNET." in name:
+        return os.path.join(folder, f"{base}.BirdNET.{output}.{rtype}")
+
+    return os.path.join(folder, f"{base}.{output}.{rtype}")
+
+
+def saveOutputResultFile(r: dict[str, list], path: str, afile_path: str, output_labels: list[str], model_name: str):
+    """Saves the results of the default model or an additional classifier next to the custom classifier results.
+
+    Args:
+        r: The dictionary with {segment: scores}.
+        path: The path where the result should be saved.
+        afile_path: The path to audio file.
+        output_labels: The labels of the scores.
+        model_name: Name of the model.
+    """
+    labels, translated_labels = cfg.LABELS, cfg.TRANSLATED_LABELS
+
+    # Translated labels are not used with custom classifiers
+    cfg.LABELS = cfg.TRANSLATED_LABELS = output_labels
+
+    try:
+        saveResultFile(r, path, afile_path, model_name)
+    finally:
+        cfg.LABELS, cfg.TRANSLATED_LABELS = labels, translated_labels
+
+
+def saveEventsFile(r: dict[str, list], path: str, afile_path: str):
+    """Merges the detections into events and saves them next to the result file.
+
+    Args:
+        r: The dictionary with {segment: scores}.
+        path: The path where the events should be saved.
+        afile_path: The path to audio file.
+    """
+    with result_writers.EventsWriter(path, afile_path) as writer:
+        for timestamp in getSortedTimestamps(r):
+            start, end = timestamp.split("-", 1)
+            writer.writeSegment(start, end, r[timestamp])
+
+
+def saveResults(results: dict[str, dict], fpath: str, file_length: float = None):
+    """Saves the merged results of a file.
+
+    Args:
+        results: The dictionary with {output name: {segment: scores}}.
+        fpath: Path to the audio file.
+        file_length: The length of the audio file in seconds, recorded in the durations file if given.
+
+    Returns:
+        The `True` if the result file was written successfully.
+    """
+    try:
+        saveResultFile(results.get(DETECTIONS, {}), get_result_file_name(fpath), fpath)
+
+        if file_length is not None:
+            recordDuration(get_result_file_name(fpath), fpath, file_length)
+
+        if cfg.MERGE_GAP is not None:
+            saveEventsFile(results.get(DETECTIONS, {}), getOutputFileName(fpath, EVENTS), fpath)
+
+        if cfg.CUSTOM_CLASSIFIER is not None and cfg.SAVE_DEFAULT_DETECTIONS:
+            saveOutputResultFile(
+                results.get(DEFAULT_DETECTIONS, {}),
+                getOutputFileName(fpath, DEFAULT_DETECTIONS),
+                fpath,
+                cfg.DEFAULT_LABELS,
+                os.path.basename(cfg.MODEL_PATH),
+            )
+
+        for c in cfg.ADDITIONAL_CLASSIFIERS:
+            saveOutputResultFile(
+                results.get(c["name"], {}),
+                getOutputFileName(fpath, c["name"]),
+                fpath,
+                c["labels"],
+                c["name"],
+            )
+
+        if cfg.SAVE_EMBEDDINGS:
+            import embeddings
+
+            e = results.get(EMBEDDINGS, {})
+            embeddings.saveAsEmbeddingsFile(
+                {t: e[t] for t in getSortedTimestamps(e)},
+                getOutputFileName(fpath, EMBEDDINGS),
+                fpath,
+            )
+
+    except Exception as ex:
+        # Write error log
+        print(f"Error: Cannot save result for {fpath}.\n", flush=True)
+        utils.writeErrorLog(ex)
+
+        return False
+
+    return True
+
+
+def analyzeUnitTimed(item):
+    """Analyzes a work unit and measures the time spent on it.
+
+    Args:
+        item: Tuple containing (file path, offset, duration, file length, config)
+
+    Returns:
+        A tuple of (worker id, busy seconds, analyzeUnit result).
+    """
+    start_time = time.perf_counter()
+    result = analyzeUnit(item)
+
+    return os.getpid(), time.perf_counter() - start_time, result
+
+
+def printWorkerUtilisation(worker_stats: dict[int, list], wall_time: float):
+    """Prints how busy each worker process was during a run.
+
+    Args:
+        worker_stats: Dictionary with {worker id: [number of units, busy seconds]}.
+        wall_time: Wall-clock duration of the run in seconds.
+    """
+    if not worker_stats or wall_time <= 0:
+        return
+
+    print(f"Worker utilisation ({wall_time:.2f} seconds wall time):", flush=True)
+
+    for i, (num_units, busy_time) in enumerate(worker_stats.values(), 1):
+        print(
+            f"  Worker {i}: {num_units} units, busy {busy_time:.2f} seconds ({100 * busy_time / wall_time:.1f}%)",
+            flush=True,
+        )
+
+    total_busy_time = sum(busy_time for _, busy_time in worker_stats.values())
+    utilisation = total_busy_time / (wall_time * cfg.CPU_THREADS)
+    print(f"  Average utilisation: {100 * utilisation:.1f}%", flush=True)
+
+
+def getFileLength(item):
+    """Gets the length of an audio file in a worker process.
+
+    Args:
+        item: Tuple containing (file path, config)
+
+    Returns:
+        A tuple of (file path, length in seconds), length is None on error.
+    """
+    fpath: str = item[0]
+    cfg.setConfig(item[1])
+
+    try:
+        return fpath, audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE)
+
+    except Exception as ex:
+        # Write error log
+        print(f"Error: Cannot open audio file {fpath}.\n", flush=True)
+        utils.writeErrorLog(ex)
+
+        return fpath, None
+
+
 def analyzeFile(item):
     """Analyzes a file.
 
@@ -379,10 +887,6 @@ def analyzeFile(item):
 
     # Start time
     start_time = datetime.datetime.now()
-    offset = 0
-    duration = cfg.FILE_SPLITTING_DURATION
-    start, end = 0, cfg.SIG_LENGTH
-    fileLengthSeconds = audio.getAudioFileLength(fpath, cfg.SAMPLE_RATE)
     results = {}
     result_file_name = get_result_file_name(fpath)
 
@@ -393,75 +897,175 @@ def analyzeFile(item):
     # Status
     print(f"Analyzing {fpath}", flush=True)
 
-    # Process each chunk
-    try:
-        while offset < fileLengthSeconds:
-            chunks = getRawAudioFromFile(fpath, offset, duration)
-            samples = []
-            timestamps = []
+    _, fileLengthSeconds = getFileLength(item)
 
-            for chunk_index, chunk in enumerate(chunks):
-                # Add to batch
-                samples.append(chunk)
-                timestamps.append([start, end])
+    if fileLengthSeconds is None:
+        return False
 
-                # Advance start and end
-                start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
-                end = start + cfg.SIG_LENGTH
+    # Process each work unit
+    for unit in getWorkUnits(fpath, fileLengthSeconds):
+        *_, unit_results = analyzeUnit((*unit, item[1]))
 
-                # Check if batch is full or last chunk
-                if len(samples) < cfg.BATCH_SIZE and chunk_index < len(chunks) - 1:
-                    continue
+        if unit_results is None:
+            return False
+
+        mergeResults(results, unit_results)
+
+    # Save as selection table
+    if not saveResults(results, fpath, fileLengthSeconds):
+        return False
 
-                # Predict
-                p = predict(samples)
+    delta_time = (datetime.datetime.now() - start_time).total_seconds()
+    print(f"Finished {fpath} in {delta_time:.2f} seconds", flush=True)
 
-                # Add to results
-                for i in range(len(samples)):
-                    # Get timestamp
-                    s_start, s_end = timestamps[i]
+    return True
 
-                    # Get prediction
-                    pred = p[i]
 
-                    # Assign scores to labels
-                    p_labels = zip(cfg.LABELS, pred)
+def analyzeFiles(files: list[str], manifest: checkpoint.RunManifest = None):
+    """Analyzes files work unit by work unit.
 
-                    # Sort by score
-                    p_sorted = sorted(
-                        p_labels, key=operator.itemgetter(1), reverse=True
-                    )
+    Files are split into work units by time range, so long recordings are
+    spread over all workers. Unit results are merged per file and the result
+    file is saved as soon as all units of a file are done.
 
-                    # Store top 5 results and advance indices
-                    results[str(s_start) + "-" + str(s_end)] = p_sorted
+    If a run manifest is given, completed units and files are recorded in it
+    and everything that is already in the manifest is skipped.
 
-                # Clear batch
-                samples = []
-                timestamps = []
-            offset = offset + duration
+    Args:
+        files: List of audio file paths.
+        manifest: Optional manifest of the run.
+    """
+    start_time = datetime.datetime.now()
+    config = cfg.getConfig()
+    remaining_files = []
+
+    # Skip files that have already been analyzed
+    for fpath in files:
+        if manifest and manifest.isFileComplete(fpath):
+            print(f"Skipping {fpath} as it has been completed in run {manifest.run_id}", flush=True)
+        elif cfg.SKIP_EXISTING_RESULTS and os.path.exists(get_result_file_name(fpath)):
+            print(f"Skipping {fpath} as it has already been analyzed", flush=True)
+        else:
+            remaining_files.append(fpath)
 
-    except Exception as ex:
-        # Write error log
-        print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
-        utils.writeErrorLog(ex)
+    with Pool(cfg.CPU_THREADS) if cfg.CPU_THREADS > 1 else contextlib.nullcontext() as p:
+        imap = p.imap if p else map
+        imap_unordered = functools.partial(p.imap_unordered, chunksize=1) if p else map
 
-        return False
+        # Split files into work units
+        units = []
+        pending = {}
 
-    # Save as selection table
-    try:
-        saveResultFile(results, result_file_name, fpath)
+        for fpath, length in imap(getFileLength, [(f, config) for f in remaining_files]):
+            if length is None:
+                continue
 
-    except Exception as ex:
-        # Write error log
-        print(f"Error: Cannot save result for {fpath}.\n", flush=True)
-        utils.writeErrorLog(ex)
+            file_units = getWorkUnits(fpath, length)
+            entry = {"remaining": len(file_units), "results": {}, "failed": False, "length": length}
 
-        return False
+            # Restore units of an interrupted run
+            if manifest:
+                completed_units = manifest.getCompletedUnits(fpath)
 
-    delta_time = (datetime.datetime.now() - start_time).total_seconds()
-    print(f"Finished {fpath} in {delta_time:.2f} seconds", flush=True)
+                for unit in file_units:
+                    if unit[1] in completed_units:
+                        mergeResults(entry["results"], completed_units[unit[1]])
+                        entry["remaining"] -= 1
 
-    return True
+                file_units = [unit for unit in file_units if unit[1] not in completed_units]
+
+                if completed_units:
+                    print(f"Resuming {fpath} at {len(completed_units)} completed work units", flush=True)
+
+            pending[fpath] = entry
+            units.extend((*unit, config) for unit in file_units)
+
+        print(f"Analyzing {len(pending)} files in {len(units)} work units", flush=True)
+
+        def finishFile(fpath: str):
+            entry = pending.pop(fpath)
+
+            if not entry["failed"] and saveResults(entry["results"], fpath, entry["length"]):
+                if manifest:
+                    manifest.completeFile(fpath, get_result_file_name(fpath))
+
+                delta_time = (datetime.datetime.now() - start_time).total_seconds()
+                print(f"Finished {fpath} after {delta_time:.2f} seconds", flush=True)
+
+        # Files that are complete from restored units only
+        for fpath in [f for f, entry in pending.items() if entry["remaining"] == 0]:
+            finishFile(fpath)
+
+        # Longest files first, so the short ones fill the gaps at the end. The sort is stable,
+        # so the units of a file stay together and only a few files are in flight at a time
+        units.sort(key=lambda unit: unit[3], reverse=True)
+        worker_stats = {}
+        units_start_time = time.perf_counter()
+
+        # Merge unit results as they come in; chunksize 1 hands out units one by one
+        for worker_id, busy_time, unit_result in imap_unordered(analyzeUnitTimed, units):
+            fpath, offset, duration, unit_results = unit_result
+            stats = worker_stats.setdefault(worker_id, [0, 0.0])
+            stats[0] += 1
+            stats[1] += busy_time
+
+            entry = pending[fpath]
+            entry["remaining"] -= 1
+
+            if unit_results is None:
+                entry["failed"] = True
+            else:
+                mergeResults(entry["results"], unit_results)
+
+                if manifest:
+                    manifest.addUnit(fpath, offset, duration, unit_results)
+
+            if entry["remaining"] == 0:
+                finishFile(fpath)
+
+    if cfg.CPU_THREADS > 1:
+        printWorkerUtilisation(worker_stats, time.perf_counter() - units_start_time)
+
+
+def parseClassifier(value: str):
+    """Splits a --classifier argument of the form [NAME=]PATH.
+
+    Without a name, the classifier is named after its file or folder.
+
+    Args:
+        value: The argument.
+
+    Returns:
+        A tuple of (name, path).
+    """
+    name, sep, path = value.partition("=")
+
+    if not sep or not name or os.path.exists(value):
+        path = value
+        name = os.path.basename(os.path.normpath(path))
+        name = name.rsplit(".", 1)[0] if name.endswith((".tflite", ".npz")) else name
+
+    return name, path
+
+
+def loadClassifierLabels(path: str):
+    """Reads the labels of a custom classifier.
+
+    Args:
+        path: Path to the classifier.
+
+    Returns:
+        A tuple of (labels file, labels, apply sigmoid).
+    """
+    if path.endswith((".tflite", ".npz")):
+        labels_file = path.rsplit(".", 1)[0] + "_Labels.txt"
+
+        return labels_file, utils.readLines(labels_file), True
+
+    # Raven models output sigmoid activations
+    labels_file = os.path.join(path, "labels", "label_names.csv")
+
+    return labels_file, [line.split(",")[1] for line in utils.readLines(labels_file)], False
 
 
 if __name__ == "__main__":
@@ -521,15 +1125,27 @@ if __name__ == "__main__":
         default=0.0,
         help="Overlap of prediction segments. Values in [0.0, 2.9]. Defaults to 0.0.",
     )
+    parser.add_argument(
+        "--adaptive_overlap",
+        action="store_true",
+        help="Analyze without overlap first and only use --overlap around candidate detections. Defaults to False.",
+    )
+    parser.add_argument(
+        "--candidate_conf",
+        type=float,
+        default=0.05,
+        help="Minimum confidence of a segment to be refined in adaptive overlap mode. Values in [0.01, 0.99]. Defaults to 0.05.",
+    )
     parser.add_argument(
         "--rtype",
         default="table",
-        help="Specifies output format. Values in ['table', 'audacity', 'r',  'kaleidoscope', 'csv']. Defaults to 'table' (Raven selection table).",
+        help=f"Specifies output format. Values in {list(result_writers.WRITERS)}. Defaults to 'table' (Raven selection table).",
     )
     parser.add_argument(
         "--output_file",
         default=None,
-        help="Path to combined Raven selection table. If set and rtype is 'table', all results will be combined into this file. Defaults to None.",
+        help="Path to combined Raven selection table. If set and rtype is 'table', all results will be combined into this file. "
+        f"If rtype is 'parquet', path of the combined dataset directory. Defaults to None, which is {result_writers.PARQUET_DATASET} in the output folder for 'parquet'.",
     )
     parser.add_argument(
         "--threads",
@@ -556,8 +1172,10 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--classifier",
+        nargs="+",
         default=None,
-        help="Path to custom trained classifier. Defaults to None. If set, --lat, --lon and --locale are ignored.",
+        help="Path to custom trained classifier. Defaults to None. If set, --lat, --lon and --locale are ignored. "
+        "Several classifiers can be given as [NAME=]PATH, they share one forward pass and each additional classifier writes its own result file named after it.",
     )
     parser.add_argument(
         "--fmin",
@@ -576,6 +1194,28 @@ if __name__ == "__main__":
         action="store_true",
         help="Skip files that have already been analyzed. Defaults to False.",
     )
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="Also save the embeddings of every segment, taken from the same forward pass. Defaults to False.",
+    )
+    parser.add_argument(
+        "--default_detections",
+        action="store_true",
+        help="If --classifier is set, also save the detections of the default model from the same forward pass. Defaults to False.",
+    )
+    parser.add_argument(
+        "--merge_gap",
+        type=float,
+        default=None,
+        help="Also save the detections merged into events, one row per species and call with max and mean confidence and number of segments. "
+        "Detections of a species at most this many seconds apart are merged, 0 merges overlapping and adjacent segments only. Defaults to None (no events).",
+    )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        help="ID of an interrupted run to resume. All other arguments are restored from that run. Defaults to None.",
+    )
 
     args = parser.parse_args()
 
@@ -583,6 +1223,17 @@ if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
     print(script_dir)
 
+    cfg.RUNS_PATH = os.path.join(script_dir, cfg.RUNS_PATH)
+
+    # Create a manifest for this run or restore the interrupted one
+    if args.resume is not None:
+        manifest = checkpoint.RunManifest.open(cfg.RUNS_PATH, args.resume)
+        args = argparse.Namespace(**{**manifest.getArgs(), "resume": args.resume})
+        print(f"Resuming run {manifest.run_id}", flush=True)
+    else:
+        manifest = checkpoint.RunManifest.create(cfg.RUNS_PATH, vars(args))
+        print(f"Run ID: {manifest.run_id} (use --resume {manifest.run_id} to continue an interrupted run)", flush=True)
+
     cfg.MODEL_PATH = os.path.join(script_dir, cfg.MODEL_PATH)
     cfg.LABELS_FILE = os.path.join(script_dir, cfg.LABELS_FILE)
     cfg.LABELS = utils.readLines(cfg.LABELS_FILE)
@@ -597,23 +1248,32 @@ if __name__ == "__main__":
 
     cfg.SKIP_EXISTING_RESULTS = args.skip_existing_results
 
+    # Additional outputs of the forward pass
+    cfg.SAVE_EMBEDDINGS = args.embeddings
+    cfg.SAVE_DEFAULT_DETECTIONS = args.default_detections
+    cfg.DEFAULT_LABELS = cfg.LABELS
+
+    # Merge detections into events
+    cfg.MERGE_GAP = None if args.merge_gap is None else max(0.0, float(args.merge_gap))
+
     # Set custom classifier?
     if args.classifier is not None:
-        cfg.CUSTOM_CLASSIFIER = (
-            args.classifier
-        )  # we treat this as absolute path, so no need to join with dirname
-
-        if args.classifier.endswith(".tflite"):
-            cfg.LABELS_FILE = args.classifier.replace(
-                ".tflite", "_Labels.txt"
-            )  # same for labels file
-            cfg.LABELS = utils.readLines(cfg.LABELS_FILE)
-        else:
-            cfg.APPLY_SIGMOID = False
-            cfg.LABELS_FILE = os.path.join(args.classifier, "labels", "label_names.csv")
-            cfg.LABELS = [
-                line.split(",")[1] for line in utils.readLines(cfg.LABELS_FILE)
-            ]
+        # we treat these as absolute paths, so no need to join with dirname
+        classifiers = [parseClassifier(c) for c in args.classifier]
+        cfg.CUSTOM_CLASSIFIER = classifiers[0][1]
+        cfg.LABELS_FILE, cfg.LABELS, cfg.APPLY_SIGMOID = loadClassifierLabels(cfg.CUSTOM_CLASSIFIER)
+
+        # Further classifiers write their results to files named after them
+        cfg.ADDITIONAL_CLASSIFIERS = []
+
+        for name, path in classifiers[1:]:
+            if name in (DETECTIONS, DEFAULT_DETECTIONS, EMBEDDINGS) or name in [c["name"] for c in cfg.ADDITIONAL_CLASSIFIERS]:
+                raise ValueError(f"Classifier name '{name}' is reserved or used twice, name it with NAME={path}")
+
+            _, labels, apply_sigmoid = loadClassifierLabels(path)
+            cfg.ADDITIONAL_CLASSIFIERS.append(
+                {"name": name, "path": path, "labels": labels, "apply_sigmoid": apply_sigmoid}
+            )
 
         args.lat = -1
         args.lon = -1
@@ -681,6 +1341,11 @@ if __name__ == "__main__":
     # Set overlap
     cfg.SIG_OVERLAP = max(0.0, min(2.9, float(args.overlap)))
 
+    # Set adaptive overlap
+    cfg.ADAPTIVE_OVERLAP = args.adaptive_overlap
+
+    cfg.CANDIDATE_CONFIDENCE = max(0.01, min(0.99, float(args.candidate_conf)))
+
     # Set bandpass frequency range
     cfg.BANDPASS_FMIN = max(0, min(cfg.SIG_FMAX, int(args.fmin)))
     cfg.BANDPASS_FMAX = max(cfg.SIG_FMIN, min(cfg.SIG_FMAX, int(args.fmax)))
@@ -688,17 +1353,21 @@ if __name__ == "__main__":
     # Set result type
     cfg.RESULT_TYPE = args.rtype.lower()
 
-    if not cfg.RESULT_TYPE in ["table", "audacity", "r", "kaleidoscope", "csv"]:
+    if not cfg.RESULT_TYPE in result_writers.WRITERS:
         cfg.RESULT_TYPE = "table"
 
     # Set output file
-    if args.output_file is not None and cfg.RESULT_TYPE == "table":
+    if args.output_file is not None and cfg.RESULT_TYPE in ("table", "parquet"):
         cfg.OUTPUT_FILE = args.output_file
     else:
         cfg.OUTPUT_FILE = None
 
     # Set number of threads
-    if os.path.isdir(cfg.INPUT_PATH):
+    # Long single files are split into work units and analyzed in parallel
+    if os.path.isdir(cfg.INPUT_PATH) or (
+        audio.getAudioFileLength(cfg.INPUT_PATH, cfg.SAMPLE_RATE)
+        > cfg.FILE_SPLITTING_DURATION
+    ):
         cfg.CPU_THREADS = max(1, int(args.threads))
         cfg.TFLITE_THREADS = 1
     else:
@@ -708,25 +1377,19 @@ if __name__ == "__main__":
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
-    # Add config items to each file list entry.
-    # We have to do this for Windows which does not
-    # support fork() and thus each process has to
-    # have its own config. USE LINUX!
-    flist = [(f, cfg.getConfig()) for f in cfg.FILE_LIST]
+    # Analyze files, completed units and files are recorded in the manifest
+    analyzeFiles(cfg.FILE_LIST, manifest)
+    manifest.finish()
+    manifest.close()
 
-    # Analyze files
-    if cfg.CPU_THREADS < 2 or len(flist) < 2:
-        for entry in flist:
-            analyzeFile(entry)
-    else:
-        with Pool(cfg.CPU_THREADS) as p:
-            # Map analyzeFile function to each entry in flist
-            results = p.map_async(analyzeFile, flist)
-            # Wait for all tasks to complete
-            results.wait()
+    # Combine Parquet results of the output folder into one dataset
+    if cfg.RESULT_TYPE == "parquet" and os.path.isdir(cfg.OUTPUT_PATH):
+        print("Combining results into Parquet dataset...", end="", flush=True)
+        result_writers.writeParquetDataset(cfg.OUTPUT_PATH, cfg.OUTPUT_FILE)
+        print("done!", flush=True)
 
     # Combine results?
-    if not cfg.OUTPUT_FILE is None:
+    elif not cfg.OUTPUT_FILE is None:
         print(f"Combining results into {cfg.OUTPUT_FILE}...", end="", flush=True)
         combineResults(cfg.OUTPUT_PATH, cfg.OUTPUT_FILE)
         print("done!", flush=True)
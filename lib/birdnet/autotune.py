@@ -0,0 +1,301 @@
+"""Module to tune the hyperparameters of a custom classifier in parallel.
+
+Trials run concurrently in worker processes. The training data is put into
+shared memory once, every worker keeps the augmented datasets of recent
+augmentation settings, and trials whose validation loss falls behind the
+median of the finished trials are stopped early.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import config as cfg
+import utils
+
+# Hyperparameter choices, same as the keras-tuner search
+SEARCH_SPACE = {
+    "hidden_units": [0, 128, 256, 512, 1024, 2048],
+    "dropout": [0.0, 0.25, 0.33, 0.5, 0.75, 0.9],
+    "batch_size": [8, 16, 32, 64, 128],
+    "learning_rate": [0.1, 0.01, 0.005, 0.002, 0.001, 0.0005, 0.0002, 0.0001],
+    "upsampling_ratio": [0.0, 0.25, 0.33, 0.5, 0.75, 1.0],
+    "upsampling_mode": ["repeat", "mean", "linear"],  # SMOTE is too slow
+    "mixup": [False, True],
+    "label_smoothing": [False, True],
+}
+
+# Trials are only pruned after this many epochs
+PRUNING_WARMUP_EPOCHS = 5
+
+# Number of finished trials needed before pruning starts
+PRUNING_MIN_TRIALS = 3
+
+# Number of augmented datasets each worker keeps
+DATA_CACHE_SIZE = 4
+
+_X_TRAIN = None
+_Y_TRAIN = None
+_SHARED_MEMORY = []
+_DATA_CACHE = collections.OrderedDict()
+
+
+class TrialPruned(Exception):
+    """Raised from the epoch callback to stop a trial that falls behind."""
+
+
+def _toSharedMemory(array: np.ndarray):
+    """Copies an array into a new shared memory block.
+
+    Returns:
+        A tuple of (shared memory, (name, shape, dtype)) to attach in other processes.
+    """
+    array = np.ascontiguousarray(array, dtype="float32")
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _fromSharedMemory(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    _SHARED_MEMORY.append(shm)
+
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _initWorker(config, x_spec, y_spec, tf_threads: int):
+    """Restores the config, limits TensorFlow threads and attaches the training data.
+
+    Args:
+        config: The config of the main process.
+        x_spec: Shared memory spec of the samples.
+        y_spec: Shared memory spec of the labels.
+        tf_threads: Number of TensorFlow threads per worker.
+    """
+    global _X_TRAIN
+    global _Y_TRAIN
+
+    cfg.setConfig(config)
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(tf_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    _X_TRAIN = _fromSharedMemory(x_spec)
+    _Y_TRAIN = _fromSharedMemory(y_spec)
+
+
+def _getPreparedData(params: dict):
+    """Returns the split and augmented data for the augmentation settings of a trial.
+
+    Args:
+        params: The hyperparameters of the trial.
+
+    Returns:
+        A tuple of (x_train, y_train, x_val, y_val).
+    """
+    key = (
+        params["upsampling_ratio"],
+        params["upsampling_mode"] if params["upsampling_ratio"] > 0 else None,
+        params["mixup"] and not cfg.BINARY_CLASSIFICATION,
+        params["label_smoothing"] and not cfg.BINARY_CLASSIFICATION,
+    )
+
+    if key in _DATA_CACHE:
+        _DATA_CACHE.move_to_end(key)
+    else:
+        _DATA_CACHE[key] = utils.prepareTrainingData(
+            _X_TRAIN,
+            _Y_TRAIN,
+            cfg.TRAIN_VAL_SPLIT,
+            params["upsampling_ratio"],
+            params["upsampling_mode"],
+            params["mixup"],
+            params["label_smoothing"],
+        )
+
+        if len(_DATA_CACHE) > DATA_CACHE_SIZE:
+            _DATA_CACHE.popitem(last=False)
+
+    return _DATA_CACHE[key]
+
+
+def _runTrial(item):
+    """Trains the classifiers of one trial in a worker.
+
+    Args:
+        item: (trial number, hyperparameters, median loss curve of finished trials)
+
+    Returns:
+        A tuple of (trial number, hyperparameters, best validation loss, loss curve, pruned).
+    """
+    trial_number, params, median_curve = item
+
+    import model
+    from tensorflow import keras
+
+    best_losses = []
+    curves = []
+    pruned = False
+
+    for execution in range(int(cfg.AUTOTUNE_EXECUTIONS_PER_TRIAL)):
+        curve = []
+
+        def onEpochEnd(epoch, logs):
+            # Best validation loss so far
+            curve.append(min(logs["val_loss"], curve[-1]) if curve else logs["val_loss"])
+
+            if epoch + 1 >= PRUNING_WARMUP_EPOCHS and epoch < len(median_curve) and curve[-1] > median_curve[epoch]:
+                raise TrialPruned()
+
+        classifier = model.buildLinearClassifier(
+            _Y_TRAIN.shape[1], _X_TRAIN.shape[1], params["hidden_units"], params["dropout"]
+        )
+
+        try:
+            model.trainLinearClassifier(
+                classifier,
+                _X_TRAIN,
+                _Y_TRAIN,
+                epochs=cfg.TRAIN_EPOCHS,
+                batch_size=params["batch_size"],
+                learning_rate=params["learning_rate"],
+                val_split=cfg.TRAIN_VAL_SPLIT,
+                upsampling_ratio=params["upsampling_ratio"],
+                upsampling_mode=params["upsampling_mode"],
+                train_with_mixup=params["mixup"],
+                train_with_label_smoothing=params["label_smoothing"],
+                on_epoch_end=onEpochEnd,
+                prepared_data=_getPreparedData(params),
+            )
+        except TrialPruned:
+            pruned = True
+
+        keras.backend.clear_session()
+        del classifier
+
+        best_losses.append(curve[-1] if curve else np.inf)
+        curves.append(curve)
+
+        # No need to repeat a trial that was pruned
+        if pruned:
+            break
+
+    return trial_number, params, float(np.mean(best_losses)), curves[0], pruned
+
+
+def defaultParams():
+    """Returns the hyperparameters from the config."""
+    return {
+        "hidden_units": cfg.TRAIN_HIDDEN_UNITS,
+        "dropout": cfg.TRAIN_DROPOUT,
+        "batch_size": cfg.TRAIN_BATCH_SIZE,
+        "learning_rate": cfg.TRAIN_LEARNING_RATE,
+        "upsampling_ratio": cfg.UPSAMPLING_RATIO,
+        "upsampling_mode": cfg.UPSAMPLING_MODE if not cfg.MULTI_LABEL else "repeat",
+        "mixup": cfg.TRAIN_WITH_MIXUP,
+        "label_smoothing": cfg.TRAIN_WITH_LABEL_SMOOTHING,
+    }
+
+
+def sampleParams(rng: np.random.RandomState):
+    """Draws random hyperparameters from the search space."""
+    params = {name: choices[rng.randint(len(choices))] for name, choices in SEARCH_SPACE.items()}
+
+    # Only allow repeat upsampling in multi-label setting
+    if cfg.MULTI_LABEL:
+        params["upsampling_mode"] = "repeat"
+
+    return params
+
+
+def medianCurve(curves: list[list[float]]):
+    """Median of the best validation loss per epoch over the finished trials.
+
+    Trials that stopped early keep their last value for the remaining epochs.
+    """
+    if len(curves) < PRUNING_MIN_TRIALS:
+        return []
+
+    padded = [c + [c[-1]] * (cfg.TRAIN_EPOCHS - len(c)) for c in curves if c]
+
+    return list(np.median(padded, axis=0))
+
+
+def runAutotune(x_train, y_train, num_processes: int, on_trial_result=None):
+    """Runs the hyperparameter search with concurrent trials.
+
+    The first trial uses the configured hyperparameters, the others are drawn
+    at random from the search space.
+
+    Args:
+        x_train: Samples.
+        y_train: Labels.
+        num_processes: Number of trials that run at the same time.
+        on_trial_result: Optional callback `function(trial_number)`.
+
+    Returns:
+        The best hyperparameters.
+    """
+    rng = np.random.RandomState(cfg.RANDOM_SEED)
+    tf_threads = max(1, cfg.CPU_THREADS // num_processes)
+    trials = [defaultParams()] + [sampleParams(rng) for _ in range(cfg.AUTOTUNE_TRIALS - 1)]
+
+    x_shm, x_spec = _toSharedMemory(x_train)
+    y_shm, y_spec = _toSharedMemory(y_train)
+
+    best_loss, best_params = np.inf, trials[0]
+    finished_curves = []
+    num_finished = 0
+
+    try:
+        # Workers are spawned so TensorFlow picks up the thread limits
+        with concurrent.futures.ProcessPoolExecutor(
+            num_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_initWorker,
+            initargs=(cfg.getConfig(), x_spec, y_spec, tf_threads),
+        ) as executor:
+            next_trial = 0
+            running = set()
+
+            while next_trial < len(trials) or running:
+                # Keep every worker busy, new trials get the latest median curve
+                while next_trial < len(trials) and len(running) < num_processes:
+                    item = (next_trial + 1, trials[next_trial], medianCurve(finished_curves))
+                    running.add(executor.submit(_runTrial, item))
+                    next_trial += 1
+
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    trial_number, params, loss, curve, pruned = future.result()
+                    num_finished += 1
+
+                    if pruned:
+                        print(f"Pruned Trial #{trial_number} after {len(curve)} epochs.", flush=True)
+                    else:
+                        finished_curves.append(curve)
+                        print(
+                            f"Finished Trial #{trial_number}. best validation loss: {loss}",
+                            flush=True,
+                        )
+
+                    if loss < best_loss:
+                        best_loss, best_params = loss, params
+
+                    # Call the on_trial_result callback
+                    if on_trial_result:
+                        on_trial_result(num_finished)
+    finally:
+        for shm in (x_shm, y_shm):
+            shm.close()
+            shm.unlink()
+
+    return best_params
@@ -0,0 +1,174 @@
+"""Module to checkpoint and resume long analysis runs.
+
+Every run gets a manifest (a small SQLite database) that records the
+arguments of the run, every completed work unit with its results and every
+file whose result file has been written.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+
+MANIFEST_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS run (
+        run_id TEXT PRIMARY KEY,
+        args TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        finished_at TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS units (
+        file TEXT NOT NULL,
+        offset REAL NOT NULL,
+        duration REAL NOT NULL,
+        results TEXT NOT NULL,
+        completed_at TEXT NOT NULL,
+        PRIMARY KEY (file, offset)
+    );
+
+    CREATE TABLE IF NOT EXISTS files (
+        file TEXT PRIMARY KEY,
+        result_file TEXT NOT NULL,
+        completed_at TEXT NOT NULL
+    );
+"""
+
+
+def newRunId():
+    """Creates a run ID from the current time.
+
+    Returns:
+        The run ID as string, e.g. '20240629_213000'.
+    """
+    return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+
+def _toJson(value):
+    # NumPy scores and embedding vectors
+    return value.tolist()
+
+
+class RunManifest:
+    """Manifest of a single analysis run."""
+
+    def __init__(self, runs_path: str, run_id: str):
+        self.run_id = run_id
+        self.path = os.path.join(runs_path, f"{run_id}.sqlite")
+
+        os.makedirs(runs_path, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(MANIFEST_SCHEMA)
+
+    @classmethod
+    def create(cls, runs_path: str, args: dict):
+        """Creates the manifest for a new run.
+
+        Args:
+            runs_path: Folder for the manifests.
+            args: The command line arguments of the run.
+
+        Returns:
+            The new manifest.
+        """
+        run_id = newRunId()
+
+        # Don't reuse a manifest of a run started in the same second
+        suffix = 1
+
+        while os.path.exists(os.path.join(runs_path, f"{run_id}.sqlite")):
+            suffix += 1
+            run_id = f"{newRunId()}_{suffix}"
+
+        manifest = cls(runs_path, run_id)
+
+        with manifest.conn:
+            manifest.conn.execute(
+                "INSERT INTO run (run_id, args, created_at) VALUES (?, ?, ?)",
+                (run_id, json.dumps(args), datetime.datetime.now().isoformat()),
+            )
+
+        return manifest
+
+    @classmethod
+    def open(cls, runs_path: str, run_id: str):
+        """Opens the manifest of an existing run.
+
+        Args:
+            runs_path: Folder for the manifests.
+            run_id: The ID of the run.
+
+        Returns:
+            The manifest.
+
+        Raises:
+            FileNotFoundError: If there is no manifest for the run.
+        """
+        if not os.path.isfile(os.path.join(runs_path, f"{run_id}.sqlite")):
+            raise FileNotFoundError(f"No manifest found for run {run_id} in {runs_path}")
+
+        return cls(runs_path, run_id)
+
+    def getArgs(self):
+        """Returns the command line arguments the run was started with."""
+        row = self.conn.execute("SELECT args FROM run WHERE run_id = ?", (self.run_id,)).fetchone()
+
+        return json.loads(row[0])
+
+    def isFileComplete(self, fpath: str):
+        """Checks whether the result file for an audio file has been written."""
+        return self.conn.execute("SELECT 1 FROM files WHERE file = ?", (fpath,)).fetchone() is not None
+
+    def getCompletedUnits(self, fpath: str):
+        """Returns the stored results of all completed units of a file.
+
+        Args:
+            fpath: Path to the audio file.
+
+        Returns:
+            A dictionary with {offset: results}.
+        """
+        rows = self.conn.execute("SELECT offset, results FROM units WHERE file = ?", (fpath,))
+
+        return {offset: json.loads(results) for offset, results in rows}
+
+    def addUnit(self, fpath: str, offset: float, duration: float, results: dict[str, list]):
+        """Records a completed work unit.
+
+        Args:
+            fpath: Path to the audio file.
+            offset: Start of the unit in seconds.
+            duration: Duration of the unit in seconds.
+            results: The dictionary with {output name: {segment: scores}} of the unit.
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO units (file, offset, duration, results, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (fpath, offset, duration, json.dumps(results, default=_toJson), datetime.datetime.now().isoformat()),
+            )
+
+    def completeFile(self, fpath: str, result_file: str):
+        """Records a written result file and drops the unit results of the file.
+
+        Args:
+            fpath: Path to the audio file.
+            result_file: Path to the result file.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM units WHERE file = ?", (fpath,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (file, result_file, completed_at) VALUES (?, ?, ?)",
+                (fpath, result_file, datetime.datetime.now().isoformat()),
+            )
+
+    def finish(self):
+        """Marks the run as finished."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE run SET finished_at = ? WHERE run_id = ?",
+                (datetime.datetime.now().isoformat(), self.run_id),
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,227 @@
+"""Module to pass audio chunks between processes through shared memory.
+
+Decoder processes write float32 chunks into the slots of a shared memory
+ring buffer, the inference process reads them as NumPy views. Only the slot
+index and a small metadata tuple go through a queue, the samples themselves
+are never pickled.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import config as cfg
+
+
+class ChunkRingBuffer:
+    """Fixed number of chunk slots in shared memory.
+
+    Free slot indices circulate through `free_slots`, filled slots are
+    announced on `filled_slots` as (slot, length, metadata). The consumer
+    has to release every slot it got once it is done with the view.
+    """
+
+    def __init__(self, num_slots: int = 32, chunk_size: int = None, _name: str = None):
+        self.num_slots = num_slots
+        self.chunk_size = chunk_size or int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE)
+        # Forked children inherit this object, only the creating process may free the memory
+        self._owner_pid = os.getpid() if _name is None else None
+
+        nbytes = self.num_slots * self.chunk_size * np.dtype("float32").itemsize
+
+        if _name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.free_slots = multiprocessing.Queue()
+            self.filled_slots = multiprocessing.Queue()
+
+            for slot in range(self.num_slots):
+                self.free_slots.put(slot)
+        else:
+            self.shm = shared_memory.SharedMemory(name=_name)
+
+        self.buffer = np.ndarray((self.num_slots, self.chunk_size), dtype="float32", buffer=self.shm.buf)
+
+    def __getstate__(self):
+        # Child processes attach to the same shared memory block by name
+        return {
+            "num_slots": self.num_slots,
+            "chunk_size": self.chunk_size,
+            "name": self.shm.name,
+            "free_slots": self.free_slots,
+            "filled_slots": self.filled_slots,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state["num_slots"], state["chunk_size"], _name=state["name"])
+        self.free_slots = state["free_slots"]
+        self.filled_slots = state["filled_slots"]
+
+    def put(self, chunk, meta=None):
+        """Writes a chunk into the next free slot.
+
+        Blocks until a slot is free. Chunks shorter than the slot are zero-padded.
+
+        Args:
+            chunk: The audio samples.
+            meta: Small picklable metadata, e.g. (file, start, end).
+        """
+        slot = self.free_slots.get()
+        length = min(len(chunk), self.chunk_size)
+
+        self.buffer[slot, :length] = chunk[:length]
+        self.buffer[slot, length:] = 0
+
+        self.filled_slots.put((slot, length, meta))
+
+    def finish(self):
+        """Tells the consumer that one producer is done."""
+        self.filled_slots.put(None)
+
+    def get(self, timeout=None):
+        """Gets the next filled slot.
+
+        Args:
+            timeout: Seconds to wait for a chunk. Waits forever if None.
+
+        Returns:
+            A tuple of (slot, metadata, view) or None if a producer finished.
+        """
+        item = self.filled_slots.get(timeout=timeout)
+
+        if item is None:
+            return None
+
+        slot, length, meta = item
+
+        return slot, meta, self.buffer[slot, :length]
+
+    def release(self, slot: int):
+        """Hands a slot back to the producers after the view is no longer used."""
+        self.free_slots.put(slot)
+
+    def chunks(self, num_producers: int = 1):
+        """Yields (slot, metadata, view) until all producers have finished."""
+        finished = 0
+
+        while finished < num_producers:
+            item = self.get()
+
+            if item is None:
+                finished += 1
+            else:
+                yield item
+
+    def close(self):
+        """Detaches from the shared memory, the owner also frees it."""
+        del self.buffer
+        self.shm.close()
+
+        if self._owner_pid == os.getpid():
+            self.shm.unlink()
+
+
+def _produceShared(ring: ChunkRingBuffer, num_chunks: int, seed: int):
+    chunk = np.random.RandomState(seed).uniform(-1, 1, ring.chunk_size).astype("float32")
+
+    for i in range(num_chunks):
+        ring.put(chunk, (seed, i))
+
+    ring.finish()
+    ring.close()
+
+
+def _producePickled(queue, num_chunks: int, chunk_size: int, seed: int):
+    chunk = np.random.RandomState(seed).uniform(-1, 1, chunk_size).astype("float32")
+
+    for i in range(num_chunks):
+        queue.put((chunk, (seed, i)))
+
+    queue.put(None)
+
+
+def benchmark(num_chunks: int = 2000, num_producers: int = 2, num_slots: int = 32):
+    """Compares the shared memory ring buffer with pickled queues.
+
+    Each producer sends `num_chunks` chunks, the consumer touches every sample.
+
+    Args:
+        num_chunks: Number of chunks per producer.
+        num_producers: Number of producer processes.
+        num_slots: Number of slots of the ring buffer.
+
+    Returns:
+        A dictionary with {transport: chunks per second}.
+    """
+    chunk_size = int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE)
+    total = num_chunks * num_producers
+    results = {}
+
+    # Pickled chunks through a multiprocessing queue
+    queue = multiprocessing.Queue(maxsize=num_slots)
+    producers = [
+        multiprocessing.Process(target=_producePickled, args=(queue, num_chunks, chunk_size, seed))
+        for seed in range(num_producers)
+    ]
+    start_time = time.perf_counter()
+
+    for p in producers:
+        p.start()
+
+    finished = 0
+
+    while finished < num_producers:
+        item = queue.get()
+
+        if item is None:
+            finished += 1
+        else:
+            item[0].sum()
+
+    results["pickled queue"] = total / (time.perf_counter() - start_time)
+
+    for p in producers:
+        p.join()
+
+    # Shared memory ring buffer
+    ring = ChunkRingBuffer(num_slots, chunk_size)
+    producers = [
+        multiprocessing.Process(target=_produceShared, args=(ring, num_chunks, seed)) for seed in range(num_producers)
+    ]
+    start_time = time.perf_counter()
+
+    for p in producers:
+        p.start()
+
+    for slot, _, view in ring.chunks(num_producers):
+        view.sum()
+        ring.release(slot)
+
+    results["shared memory"] = total / (time.perf_counter() - start_time)
+
+    for p in producers:
+        p.join()
+
+    ring.close()
+
+    return results
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Benchmark the shared memory chunk transport")
+    parser.add_argument("--chunks", type=int, default=2000, help="Number of chunks per producer. Defaults to 2000.")
+    parser.add_argument("--producers", type=int, default=2, help="Number of producer processes. Defaults to 2.")
+    parser.add_argument("--slots", type=int, default=32, help="Number of ring buffer slots. Defaults to 32.")
+
+    args = parser.parse_args()
+
+    chunk_mb = cfg.SIG_LENGTH * cfg.SAMPLE_RATE * 4 / 1024 / 1024
+
+    for transport, chunks_per_second in benchmark(args.chunks, args.producers, args.slots).items():
+        print(f"{transport}: {chunks_per_second:.0f} chunks/s ({chunks_per_second * chunk_mb:.0f} MB/s)")
+
+    # python3 chunk_transport.py --chunks 2000 --producers 2
@@ -27,6 +27,10 @@ TRANSLATED_LABELS_PATH: str = "labels/V2.4"
 # Make sure to set the LABELS_FILE above accordingly
 CUSTOM_CLASSIFIER = None
 
+# Further custom classifiers evaluated in the same pass as CUSTOM_CLASSIFIER
+# Each entry is a dictionary with 'name', 'path', 'labels' and 'apply_sigmoid'
+ADDITIONAL_CLASSIFIERS: list[dict] = []
+
 ##################
 # Audio settings #
 ##################
@@ -42,6 +46,14 @@ SIG_LENGTH: float = 3.0
 # Define overlap between consecutive chunks <3.0; 0 = no overlap
 SIG_OVERLAP: float = 0
 
+# Adaptive overlap: analyze with no overlap first and only re-run
+# overlapping segments (SIG_OVERLAP) around candidate detections
+ADAPTIVE_OVERLAP: bool = False
+
+# Minimum confidence of a segment in the first (non-overlapping) pass
+# to be refined with overlapping segments in adaptive mode
+CANDIDATE_CONFIDENCE: float = 0.05
+
 # Define minimum length of audio chunk for prediction,
 # chunks shorter than 3 seconds will be padded with zeros
 SIG_MINLEN: float = 1.0
@@ -114,6 +126,22 @@ BATCH_SIZE: int = 1
 # Lowering this value results in lower memory usage
 FILE_SPLITTING_DURATION: int = 600
 
+# Whether to also save the embeddings of every segment during analysis
+# Embeddings are taken from the same forward pass as the detections
+SAVE_EMBEDDINGS: bool = False
+
+# Storage type of binary embeddings archives, 'float16' or 'float32'
+EMBEDDINGS_DTYPE: str = "float16"
+
+# Whether to also save the detections of the default model
+# when analyzing with a custom classifier
+SAVE_DEFAULT_DETECTIONS: bool = False
+
+# Detections of the same species that are at most this many seconds apart
+# are merged into one event and saved to an additional events file.
+# Overlapping segments are always merged. If set to None, no events are saved.
+MERGE_GAP: float = None
+
 # Whether to use noise to pad the signal
 # If set to False, the signal will be padded with zeros
 USE_NOISE: bool = False
@@ -130,6 +158,9 @@ OUTPUT_FILENAME: str = (
 # If set to False, existing files will not be overwritten
 SKIP_EXISTING_RESULTS: bool = False
 
+# Folder for the manifests of analysis runs, used to resume interrupted runs
+RUNS_PATH: str = "runs/"
+
 #####################
 # Training settings #
 #####################
@@ -182,6 +213,11 @@ TRAINED_MODEL_SAVE_MODE: str = "replace"
 TRAIN_CACHE_MODE: str = "none"
 TRAIN_CACHE_FILE: str = "train_cache.npz"
 
+# Folder for the per-file embeddings cache of the training data
+# Files are only embedded again if their content or the embedding settings changed
+# If None or empty, no per-file cache will be used
+TRAIN_EMBEDDINGS_CACHE_PATH: str = "train_embeddings_cache/"
+
 # Use automatic Hyperparameter tuning
 AUTOTUNE: bool = False
 
@@ -192,6 +228,11 @@ AUTOTUNE_TRIALS: int = 50
 # Mutliple executions will be averaged, so the evaluation is more consistent
 AUTOTUNE_EXECUTIONS_PER_TRIAL: int = 1
 
+# How many trials of the hyperparameter tuning run in parallel processes
+# With more than 1, trials are drawn at random, share the training data
+# through shared memory and poor trials are stopped early
+AUTOTUNE_PROCESSES: int = 1
+
 # If a binary classification model is trained.
 # This value will be detected automatically in the training script, if only one class and a non-event class is used.
 BINARY_CLASSIFICATION: bool = False
@@ -205,6 +246,7 @@ MULTI_LABEL: bool = False
 #####################
 CODES = {}
 LABELS: list[str] = []
+DEFAULT_LABELS: list[str] = []
 TRANSLATED_LABELS: list[str] = []
 SPECIES_LIST: list[str] = []
 ERROR_LOG_FILE: str = "error_log.txt"
@@ -226,9 +268,12 @@ def getConfig():
         "LABELS_FILE": LABELS_FILE,
         "TRANSLATED_LABELS_PATH": TRANSLATED_LABELS_PATH,
         "CUSTOM_CLASSIFIER": CUSTOM_CLASSIFIER,
+        "ADDITIONAL_CLASSIFIERS": ADDITIONAL_CLASSIFIERS,
         "SAMPLE_RATE": SAMPLE_RATE,
         "SIG_LENGTH": SIG_LENGTH,
         "SIG_OVERLAP": SIG_OVERLAP,
+        "ADAPTIVE_OVERLAP": ADAPTIVE_OVERLAP,
+        "CANDIDATE_CONFIDENCE": CANDIDATE_CONFIDENCE,
         "SIG_MINLEN": SIG_MINLEN,
         "SIG_FMIN": SIG_FMIN,
         "SIG_FMAX": SIG_FMAX,
@@ -268,6 +313,7 @@ def getConfig():
         "TRAINED_MODEL_SAVE_MODE": TRAINED_MODEL_SAVE_MODE,
         "TRAIN_CACHE_MODE": TRAIN_CACHE_MODE,
         "TRAIN_CACHE_FILE": TRAIN_CACHE_FILE,
+        "TRAIN_EMBEDDINGS_CACHE_PATH": TRAIN_EMBEDDINGS_CACHE_PATH,
         "CODES": CODES,
         "LABELS": LABELS,
         "TRANSLATED_LABELS": TRANSLATED_LABELS,
@@ -276,7 +322,13 @@ def getConfig():
         "FILE_LIST": FILE_LIST,
         "FILE_STORAGE_PATH": FILE_STORAGE_PATH,
         "SKIP_EXISTING_RESULTS": SKIP_EXISTING_RESULTS,
+        "RUNS_PATH": RUNS_PATH,
         "USE_NOISE": USE_NOISE,
+        "SAVE_EMBEDDINGS": SAVE_EMBEDDINGS,
+        "EMBEDDINGS_DTYPE": EMBEDDINGS_DTYPE,
+        "SAVE_DEFAULT_DETECTIONS": SAVE_DEFAULT_DETECTIONS,
+        "MERGE_GAP": MERGE_GAP,
+        "DEFAULT_LABELS": DEFAULT_LABELS,
     }
 
 
@@ -289,9 +341,12 @@ def setConfig(c):
     global LABELS_FILE
     global TRANSLATED_LABELS_PATH
     global CUSTOM_CLASSIFIER
+    global ADDITIONAL_CLASSIFIERS
     global SAMPLE_RATE
     global SIG_LENGTH
     global SIG_OVERLAP
+    global ADAPTIVE_OVERLAP
+    global CANDIDATE_CONFIDENCE
     global SIG_MINLEN
     global SIG_FMIN
     global SIG_FMAX
@@ -331,6 +386,7 @@ def setConfig(c):
     global TRAINED_MODEL_SAVE_MODE
     global TRAIN_CACHE_MODE
     global TRAIN_CACHE_FILE
+    global TRAIN_EMBEDDINGS_CACHE_PATH
     global CODES
     global LABELS
     global TRANSLATED_LABELS
@@ -339,7 +395,13 @@ def setConfig(c):
     global FILE_LIST
     global FILE_STORAGE_PATH
     global SKIP_EXISTING_RESULTS
+    global RUNS_PATH
     global USE_NOISE
+    global SAVE_EMBEDDINGS
+    global EMBEDDINGS_DTYPE
+    global SAVE_DEFAULT_DETECTIONS
+    global MERGE_GAP
+    global DEFAULT_LABELS
 
     RANDOM_SEED = c["RANDOM_SEED"]
     MODEL_VERSION = c["MODEL_VERSION"]
@@ -349,9 +411,12 @@ def setConfig(c):
     LABELS_FILE = c["LABELS_FILE"]
     TRANSLATED_LABELS_PATH = c["TRANSLATED_LABELS_PATH"]
     CUSTOM_CLASSIFIER = c["CUSTOM_CLASSIFIER"]
+    ADDITIONAL_CLASSIFIERS = c["ADDITIONAL_CLASSIFIERS"]
     SAMPLE_RATE = c["SAMPLE_RATE"]
     SIG_LENGTH = c["SIG_LENGTH"]
     SIG_OVERLAP = c["SIG_OVERLAP"]
+    ADAPTIVE_OVERLAP = c["ADAPTIVE_OVERLAP"]
+    CANDIDATE_CONFIDENCE = c["CANDIDATE_CONFIDENCE"]
     SIG_MINLEN = c["SIG_MINLEN"]
     SIG_FMIN = c["SIG_FMIN"]
     SIG_FMAX = c["SIG_FMAX"]
@@ -391,6 +456,7 @@ def setConfig(c):
     TRAINED_MODEL_SAVE_MODE = c["TRAINED_MODEL_SAVE_MODE"]
     TRAIN_CACHE_MODE = c["TRAIN_CACHE_MODE"]
     TRAIN_CACHE_FILE = c["TRAIN_CACHE_FILE"]
+    TRAIN_EMBEDDINGS_CACHE_PATH = c["TRAIN_EMBEDDINGS_CACHE_PATH"]
     CODES = c["CODES"]
     LABELS = c["LABELS"]
     TRANSLATED_LABELS = c["TRANSLATED_LABELS"]
@@ -399,4 +465,10 @@ def setConfig(c):
     FILE_LIST = c["FILE_LIST"]
     FILE_STORAGE_PATH = c["FILE_STORAGE_PATH"]
     SKIP_EXISTING_RESULTS = c["SKIP_EXISTING_RESULTS"]
+    RUNS_PATH = c["RUNS_PATH"]
     USE_NOISE = c["USE_NOISE"]
+    SAVE_EMBEDDINGS = c["SAVE_EMBEDDINGS"]
+    EMBEDDINGS_DTYPE = c["EMBEDDINGS_DTYPE"]
+    SAVE_DEFAULT_DETECTIONS = c["SAVE_DEFAULT_DETECTIONS"]
+    MERGE_GAP = c["MERGE_GAP"]
+    DEFAULT_LABELS = c["DEFAULT_LABELS"]
@@ -11,25 +11,45 @@ import numpy as np
 import analyze
 import audio
 import config as cfg
+import embeddings_archive
 import model
 import utils
 
 
+ARCHIVE_SUFFIX = ".embeddings"
+
+
 def writeErrorLog(msg):
     with open(cfg.ERROR_LOG_FILE, "a") as elog:
         elog.write(msg + "\n")
 
 
-def saveAsEmbeddingsFile(results: dict[str], fpath: str):
+def saveAsEmbeddingsFile(results: dict[str], fpath: str, afile_path: str = None):
     """Write embeddings to file
-    
+
+    Paths ending with '.txt' get the tab separated text format, every other
+    path is a binary archive the embeddings are appended to.
+
     Args:
         results: A dictionary containing the embeddings at timestamp.
-        fpath: The path for the embeddings file.
+        fpath: The path for the embeddings file or archive.
+        afile_path: The path to the audio file, stored in the archive.
     """
-    with open(fpath, "w") as f:
-        for timestamp in results:
-            f.write(timestamp.replace("-", "\t") + "\t" + ",".join(map(str, results[timestamp])) + "\n")
+    if fpath.lower().endswith(".txt"):
+        embeddings_archive.saveAsText(results, fpath)
+    else:
+        timestamps = [embeddings_archive.parseTimestamp(t) for t in results]
+        vectors = [results[t] for t in results]
+
+        embeddings_archive.EmbeddingsArchive(fpath).append(afile_path, timestamps, vectors)
+
+
+def getArchivePath():
+    """Returns the path of the archive for the configured output path."""
+    if cfg.OUTPUT_PATH.rstrip("/\\").endswith(ARCHIVE_SUFFIX):
+        return cfg.OUTPUT_PATH
+
+    return os.path.join(cfg.OUTPUT_PATH, "BirdNET" + ARCHIVE_SUFFIX)
 
 
 def analyzeFile(item):
@@ -37,6 +57,9 @@ def analyzeFile(item):
 
     Args:
         item: (filepath, config)
+
+    Returns:
+        A tuple of (filepath, {timestamp: embeddings}) or None on error.
     """
     # Get file path and restore cfg
     fpath: str = item[0]
@@ -100,33 +123,35 @@ def analyzeFile(item):
         print(f"Error: Cannot analyze audio file {fpath}.", flush=True)
         utils.writeErrorLog(ex)
 
-        return
+        return None
 
-    # Save as embeddings file
-    try:
-        # We have to check if output path is a file or directory
-        if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
-            fpath = fpath.replace(cfg.INPUT_PATH, "")
-            fpath = fpath[1:] if fpath[0] in ["/", "\\"] else fpath
+    delta_time = (datetime.datetime.now() - start_time).total_seconds()
+    print("Finished {} in {:.2f} seconds".format(fpath, delta_time), flush=True)
 
-            # Make target directory if it doesn't exist
-            fdir = os.path.join(cfg.OUTPUT_PATH, os.path.dirname(fpath))
-            os.makedirs(fdir, exist_ok=True)
+    return fpath, results
 
-            saveAsEmbeddingsFile(results, os.path.join(cfg.OUTPUT_PATH, fpath.rsplit(".", 1)[0] + ".birdnet.embeddings.txt"))
-        else:
+
+def saveEmbeddings(fpath: str, results: dict[str]):
+    """Saves the embeddings of a file.
+
+    The text format is only used if the output path is a single file,
+    otherwise the embeddings of all files go into one binary archive.
+
+    Args:
+        fpath: Path to the audio file.
+        results: A dictionary containing the embeddings at timestamp.
+    """
+    try:
+        if cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
             saveAsEmbeddingsFile(results, cfg.OUTPUT_PATH)
+        else:
+            saveAsEmbeddingsFile(results, getArchivePath(), fpath)
 
     except Exception as ex:
         # Write error log
         print(f"Error: Cannot save embeddings for {fpath}.", flush=True)
         utils.writeErrorLog(ex)
 
-        return
-
-    delta_time = (datetime.datetime.now() - start_time).total_seconds()
-    print("Finished {} in {:.2f} seconds".format(fpath, delta_time), flush=True)
-
 
 if __name__ == "__main__":
     # Parse arguments
@@ -157,6 +182,13 @@ if __name__ == "__main__":
         help="Maximum frequency for bandpass filter in Hz. Defaults to {} Hz.".format(cfg.SIG_FMAX)
     )
 
+    parser.add_argument(
+        "--dtype",
+        default=cfg.EMBEDDINGS_DTYPE,
+        choices=["float16", "float32"],
+        help="Storage type of new embeddings archives. Defaults to {}.".format(cfg.EMBEDDINGS_DTYPE),
+    )
+
     args = parser.parse_args()
 
     # Set paths relative to script path (requested in #3)
@@ -193,20 +225,33 @@ if __name__ == "__main__":
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
+    # Set storage type of the archive
+    cfg.EMBEDDINGS_DTYPE = args.dtype
+
+    # Files that are already in the archive are not analyzed again
+    if cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() not in ["txt", "csv"]:
+        archive = embeddings_archive.EmbeddingsArchive(getArchivePath())
+        cfg.FILE_LIST = [f for f in cfg.FILE_LIST if not archive.hasFile(f)]
+
     # Add config items to each file list entry.
     # We have to do this for Windows which does not
     # support fork() and thus each process has to
     # have its own config. USE LINUX!
     flist = [(f, cfg.getConfig()) for f in cfg.FILE_LIST]
 
-    # Analyze files
+    # Analyze files, embeddings are written by the main process only
     if cfg.CPU_THREADS < 2:
         for entry in flist:
-            analyzeFile(entry)
+            result = analyzeFile(entry)
+
+            if result is not None:
+                saveEmbeddings(*result)
     else:
         with Pool(cfg.CPU_THREADS) as p:
-            p.map(analyzeFile, flist)
+            for result in p.imap(analyzeFile, flist):
+                if result is not None:
+                    saveEmbeddings(*result)
 
     # A few examples to test
-    # python3 embeddings.py --i example/ --o example/ --threads 4
+    # python3 embeddings.py --i example/ --o example/ --threads 4 --dtype float16
     # python3 embeddings.py --i example/soundscape.wav --o example/soundscape.birdnet.embeddings.txt --threads 4
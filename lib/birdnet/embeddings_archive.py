@@ -0,0 +1,319 @@
+"""Module to store embeddings in a binary, memory-mappable archive.
+
+An archive is a folder with three files:
+
+    header.json      dtype, dimension, number of rows and the source file table
+    embeddings.bin   raw row-major matrix with one embedding per row
+    segments.bin     one (file index, start, end) record per row
+
+Rows are appended. The header is replaced last, so rows of an interrupted
+write are never visible and get overwritten by the next append. Appending a
+file that already has rows, e.g. when a file is analyzed again, writes a new
+copy of the archive without its old rows and swaps it in.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import config as cfg
+
+ARCHIVE_VERSION = 1
+HEADER_FILE = "header.json"
+EMBEDDINGS_FILE = "embeddings.bin"
+SEGMENTS_FILE = "segments.bin"
+SEGMENT_DTYPE = np.dtype([("file", "<u4"), ("start", "<f8"), ("end", "<f8")])
+
+
+class EmbeddingsArchive:
+    """Appendable archive of embeddings from many audio files."""
+
+    def __init__(self, path: str, dtype: str = None, dim: int = None):
+        """Opens an archive, a missing archive is created on the first append.
+
+        Args:
+            path: Folder of the archive.
+            dtype: Storage type of new archives, 'float16' or 'float32'. Defaults to cfg.EMBEDDINGS_DTYPE.
+            dim: Dimension of the embeddings. Taken from the first append if None.
+        """
+        self.path = path
+        header_path = os.path.join(path, HEADER_FILE)
+
+        # Finish or roll back an interrupted replacement
+        if os.path.isdir(path + ".old"):
+            if os.path.isfile(header_path):
+                shutil.rmtree(path + ".old")
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+                os.replace(path + ".old", path)
+
+        if os.path.isfile(header_path):
+            with open(header_path, "r") as f:
+                header = json.load(f)
+
+            if header["version"] != ARCHIVE_VERSION:
+                raise ValueError(f"Unsupported embeddings archive version {header['version']} in {path}")
+
+            self.dtype = np.dtype(header["dtype"])
+            self.dim = header["dim"]
+            self.count = header["count"]
+            self.files = header["files"]
+        else:
+            self.dtype = np.dtype(dtype or cfg.EMBEDDINGS_DTYPE)
+            self.dim = dim
+            self.count = 0
+            self.files = []
+
+        self._file_index = {f: i for i, f in enumerate(self.files)}
+
+    def __len__(self):
+        return self.count
+
+    def hasFile(self, fpath: str):
+        """Checks whether the embeddings of an audio file are in the archive."""
+        return fpath in self._file_index
+
+    def append(self, fpath: str, timestamps, vectors):
+        """Appends the embeddings of one audio file.
+
+        Args:
+            fpath: Path to the audio file.
+            timestamps: A list of (start, end) for each embedding.
+            vectors: The embeddings, one row per segment.
+        """
+        if self.hasFile(fpath) and np.any(self.segments["file"] == self._file_index[fpath]):
+            self._replace(fpath, timestamps, vectors)
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        if fpath not in self._file_index:
+            self._file_index[fpath] = len(self.files)
+            self.files.append(fpath)
+
+        # Files without segments only go into the file table
+        if len(timestamps) == 0:
+            self._writeHeader()
+            return
+
+        vectors = np.asarray(vectors, dtype="float32").reshape(len(timestamps), -1)
+
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Embeddings have dimension {vectors.shape[1]}, archive {self.path} expects {self.dim}")
+
+        segments = np.zeros(len(timestamps), dtype=SEGMENT_DTYPE)
+        segments["file"] = self._file_index[fpath]
+        segments["start"], segments["end"] = np.asarray(timestamps, dtype="float64").T
+
+        # Drop rows of an interrupted append before writing new ones
+        self._appendRows(EMBEDDINGS_FILE, vectors.astype(self.dtype), self.dim * self.dtype.itemsize)
+        self._appendRows(SEGMENTS_FILE, segments, SEGMENT_DTYPE.itemsize)
+
+        self.count += len(segments)
+        self._writeHeader()
+
+    def _replace(self, fpath: str, timestamps, vectors, block_size: int = 65536):
+        """Rewrites the archive without the rows of a file, then appends its new rows.
+
+        The copy is built next to the archive and swapped in, so an interruption
+        leaves either the old or the new archive.
+        """
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+        # Keep the file table, so the file indices of the kept rows stay valid
+        copy = EmbeddingsArchive(tmp_path, self.dtype.name, self.dim)
+        copy.files = list(self.files)
+        copy._file_index = dict(self._file_index)
+        os.makedirs(tmp_path)
+
+        file_index = self._file_index[fpath]
+
+        vectors_map, segments_map = self.vectors, self.segments
+        row_size = self.dim * self.dtype.itemsize
+
+        for start in range(0, self.count, block_size):
+            segments = segments_map[start : start + block_size]
+            keep = segments["file"] != file_index
+
+            copy._appendRows(EMBEDDINGS_FILE, vectors_map[start : start + block_size][keep], row_size)
+            copy._appendRows(SEGMENTS_FILE, segments[keep], SEGMENT_DTYPE.itemsize)
+            copy.count += int(keep.sum())
+
+        # Close the memory maps before the folder is moved
+        del vectors_map, segments_map, segments
+
+        copy.append(fpath, timestamps, vectors)
+
+        os.replace(self.path, self.path + ".old")
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(self.path + ".old")
+
+        self.count, self.files, self._file_index = copy.count, copy.files, copy._file_index
+
+    def _appendRows(self, name: str, rows: np.ndarray, row_size: int):
+        with open(os.path.join(self.path, name), "ab") as f:
+            f.truncate(self.count * row_size)
+            f.write(np.ascontiguousarray(rows).tobytes())
+
+    def _writeHeader(self):
+        header_path = os.path.join(self.path, HEADER_FILE)
+        header = {
+            "version": ARCHIVE_VERSION,
+            "dtype": self.dtype.name,
+            "dim": self.dim,
+            "count": self.count,
+            "files": self.files,
+        }
+
+        with open(header_path + ".tmp", "w") as f:
+            json.dump(header, f)
+
+        os.replace(header_path + ".tmp", header_path)
+
+    @property
+    def vectors(self):
+        """All embeddings as read-only memory map of shape (rows, dim)."""
+        if self.count == 0:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+
+        return np.memmap(
+            os.path.join(self.path, EMBEDDINGS_FILE), dtype=self.dtype, mode="r", shape=(self.count, self.dim)
+        )
+
+    @property
+    def segments(self):
+        """All (file, start, end) records as read-only memory map."""
+        if self.count == 0:
+            return np.zeros(0, dtype=SEGMENT_DTYPE)
+
+        return np.memmap(os.path.join(self.path, SEGMENTS_FILE), dtype=SEGMENT_DTYPE, mode="r", shape=(self.count,))
+
+    def getFile(self, fpath: str):
+        """Returns the segments and embeddings of one audio file.
+
+        Args:
+            fpath: Path to the audio file.
+
+        Returns:
+            A tuple of (segments, vectors), empty if the file is not in the archive.
+        """
+        if fpath not in self._file_index:
+            return np.zeros(0, dtype=SEGMENT_DTYPE), np.zeros((0, self.dim or 0), dtype=self.dtype)
+
+        rows = np.flatnonzero(self.segments["file"] == self._file_index[fpath])
+
+        return self.segments[rows], self.vectors[rows]
+
+    def describe(self, row: int):
+        """Returns (file, start, end) of a row."""
+        segment = self.segments[row]
+
+        return self.files[segment["file"]], float(segment["start"]), float(segment["end"])
+
+
+def parseTimestamp(timestamp: str):
+    """Splits a '<start>-<end>' result key into floats."""
+    start, end = timestamp.split("-", 1)
+
+    return float(start), float(end)
+
+
+def saveAsText(results: dict[str], fpath: str):
+    """Writes embeddings in the tab separated text format.
+
+    Args:
+        results: A dictionary containing the embeddings at timestamp.
+        fpath: The path for the embeddings file.
+    """
+    with open(fpath, "w") as f:
+        for timestamp in results:
+            f.write(timestamp.replace("-", "\t") + "\t" + ",".join(map(str, results[timestamp])) + "\n")
+
+
+def loadText(fpath: str):
+    """Reads embeddings from the tab separated text format.
+
+    Args:
+        fpath: The path of the embeddings file.
+
+    Returns:
+        A tuple of (timestamps, vectors).
+    """
+    timestamps, vectors = [], []
+
+    with open(fpath, "r") as f:
+        for line in f:
+            start, end, values = line.rstrip("\n").split("\t")
+            timestamps.append((float(start), float(end)))
+            vectors.append(np.array(values.split(","), dtype="float32"))
+
+    return timestamps, np.array(vectors, dtype="float32")
+
+
+def benchmark(num_segments: int = 20000, dim: int = 1024):
+    """Compares write and read throughput of the text format and the archive.
+
+    Args:
+        num_segments: Number of embeddings to write and read.
+        dim: Dimension of the embeddings.
+
+    Returns:
+        A dictionary with {format: (write rows/s, read rows/s, size in MB)}.
+    """
+    vectors = np.random.RandomState(0).normal(size=(num_segments, dim)).astype("float32")
+    timestamps = [(i * 3.0, i * 3.0 + 3.0) for i in range(num_segments)]
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        # Text format
+        path = os.path.join(tmp_dir, "embeddings.txt")
+        start_time = time.perf_counter()
+        saveAsText({f"{s}-{e}": v for (s, e), v in zip(timestamps, vectors)}, path)
+        write_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        loadText(path)[1].sum(axis=0)
+        read_time = time.perf_counter() - start_time
+
+        results["text"] = (num_segments / write_time, num_segments / read_time, os.path.getsize(path) / 1024 / 1024)
+
+        # Binary archive
+        for dtype in ("float32", "float16"):
+            path = os.path.join(tmp_dir, f"{dtype}.embeddings")
+            start_time = time.perf_counter()
+            EmbeddingsArchive(path, dtype).append("benchmark.wav", timestamps, vectors)
+            write_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            EmbeddingsArchive(path).vectors.astype("float32").sum(axis=0)
+            read_time = time.perf_counter() - start_time
+
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            results[f"binary {dtype}"] = (num_segments / write_time, num_segments / read_time, size / 1024 / 1024)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Benchmark the binary embeddings archive against the text format")
+    parser.add_argument("--segments", type=int, default=20000, help="Number of embeddings. Defaults to 20000.")
+    parser.add_argument("--dim", type=int, default=1024, help="Dimension of the embeddings. Defaults to 1024.")
+
+    args = parser.parse_args()
+
+    for fmt, (write_rate, read_rate, size) in benchmark(args.segments, args.dim).items():
+        print(f"{fmt}: write {write_rate:.0f} rows/s, read {read_rate:.0f} rows/s, {size:.1f} MB")
+
+    # python3 embeddings_archive.py --segments 20000
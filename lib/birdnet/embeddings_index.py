@@ -0,0 +1,278 @@
+"""Module to find segments with embeddings similar to a query clip.
+
+Similarity is the cosine similarity of the embeddings. Small and medium
+archives are searched exactly with blocked matrix products; for very large
+archives an IVF index (k-means coarse quantizer with inverted lists) can be
+built once and stored next to the archive.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import config as cfg
+from embeddings_archive import EmbeddingsArchive
+
+IVF_INDEX_FILE = "ivf.npz"
+
+
+def normalize(vectors):
+    """Scales vectors to unit length, returns float32."""
+    vectors = np.asarray(vectors, dtype="float32")
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _mergeTopK(scores, rows, best_scores, best_rows, k: int):
+    # Keep the k highest scores of the previous best and the new candidates
+    scores = np.concatenate([best_scores, scores])
+    rows = np.concatenate([best_rows, rows])
+
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+        scores, rows = scores[top], rows[top]
+
+    return scores, rows
+
+
+def searchExact(archive: EmbeddingsArchive, query, k: int = 10, block_size: int = 65536):
+    """Searches all embeddings of an archive.
+
+    The archive is read block by block from the memory map, so memory use
+    only depends on `block_size`.
+
+    Args:
+        archive: The embeddings archive.
+        query: The query embedding.
+        k: Number of results.
+        block_size: Number of rows per matrix product.
+
+    Returns:
+        A tuple of (scores, rows), sorted by descending similarity.
+    """
+    query = normalize(query).reshape(-1)
+    vectors = archive.vectors
+    best_scores, best_rows = np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+
+    for start in range(0, len(vectors), block_size):
+        block = normalize(vectors[start : start + block_size])
+        scores = block @ query
+        best_scores, best_rows = _mergeTopK(
+            scores, np.arange(start, start + len(block)), best_scores, best_rows, k
+        )
+
+    order = np.argsort(-best_scores)
+
+    return best_scores[order], best_rows[order]
+
+
+def _assign(vectors, centroids, block_size: int = 65536):
+    # Index of the most similar centroid for every vector
+    assignments = np.empty(len(vectors), dtype="int64")
+
+    for start in range(0, len(vectors), block_size):
+        block = normalize(vectors[start : start + block_size])
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+    return assignments
+
+
+def trainCentroids(vectors, num_lists: int, iterations: int = 20, sample_size: int = 100000, seed: int = 42):
+    """Runs spherical k-means on a sample of the vectors.
+
+    Args:
+        vectors: The embeddings.
+        num_lists: Number of clusters.
+        iterations: Number of k-means iterations.
+        sample_size: Maximum number of vectors used for training.
+        seed: Random seed.
+
+    Returns:
+        The normalized centroids of shape (num_lists, dim).
+    """
+    rng = np.random.RandomState(seed)
+    sample_rows = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+    sample = normalize(vectors[sample_rows])
+    num_lists = min(num_lists, len(sample))
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+
+        # Empty clusters are restarted at a random sample
+        empty = np.bincount(assignments, minlength=num_lists) == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index over the rows of an embeddings archive."""
+
+    def __init__(self, centroids, rows, offsets):
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, archive: EmbeddingsArchive, num_lists: int = None, iterations: int = 20):
+        """Clusters the archive and sorts its rows into inverted lists.
+
+        Args:
+            archive: The embeddings archive.
+            num_lists: Number of inverted lists. Defaults to 4 * sqrt(rows).
+            iterations: Number of k-means iterations.
+
+        Returns:
+            The index.
+        """
+        vectors = archive.vectors
+        num_lists = num_lists or max(1, int(4 * np.sqrt(len(vectors))))
+        centroids = trainCentroids(vectors, num_lists, iterations)
+        assignments = _assign(vectors, centroids)
+
+        rows = np.argsort(assignments, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+
+        return cls(centroids, rows, offsets)
+
+    def save(self, archive: EmbeddingsArchive):
+        path = os.path.join(archive.path, IVF_INDEX_FILE)
+        np.savez(path + ".tmp.npz", centroids=self.centroids, rows=self.rows, offsets=self.offsets)
+        os.replace(path + ".tmp.npz", path)
+
+    @classmethod
+    def load(cls, archive: EmbeddingsArchive):
+        """Loads the index of an archive.
+
+        Raises:
+            ValueError: If the archive has been appended to since the index was built.
+        """
+        with np.load(os.path.join(archive.path, IVF_INDEX_FILE)) as data:
+            index = cls(data["centroids"], data["rows"], data["offsets"])
+
+        if len(index.rows) != len(archive):
+            raise ValueError(f"IVF index of {archive.path} is outdated, rebuild it with --build_index")
+
+        return index
+
+    def search(self, archive: EmbeddingsArchive, query, k: int = 10, num_probes: int = 8):
+        """Searches the inverted lists of the centroids closest to the query.
+
+        Args:
+            archive: The embeddings archive the index was built for.
+            query: The query embedding.
+            k: Number of results.
+            num_probes: Number of inverted lists to search.
+
+        Returns:
+            A tuple of (scores, rows), sorted by descending similarity.
+        """
+        query = normalize(query).reshape(-1)
+        probes = np.argsort(-(self.centroids @ query))[:num_probes]
+        rows = np.sort(np.concatenate([self.rows[self.offsets[p] : self.offsets[p + 1]] for p in probes]))
+
+        scores = normalize(archive.vectors[rows]) @ query
+        scores, rows = _mergeTopK(scores, rows, np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64"), k)
+        order = np.argsort(-scores)
+
+        return scores[order], rows[order]
+
+
+def search(archives: list[EmbeddingsArchive], query, k: int = 10, use_index: bool = False, num_probes: int = 8):
+    """Searches several archives.
+
+    Args:
+        archives: The embeddings archives.
+        query: The query embedding.
+        k: Number of results.
+        use_index: Whether to use the IVF index of the archives.
+        num_probes: Number of inverted lists to search per archive.
+
+    Returns:
+        A list of (score, file, start, end), sorted by descending similarity.
+    """
+    results = []
+
+    for archive in archives:
+        if len(archive) == 0:
+            continue
+
+        if use_index:
+            scores, rows = IVFIndex.load(archive).search(archive, query, k, num_probes)
+        else:
+            scores, rows = searchExact(archive, query, k)
+
+        results.extend((float(score), *archive.describe(row)) for score, row in zip(scores, rows))
+
+    return sorted(results, key=lambda r: r[0], reverse=True)[:k]
+
+
+def embedQuery(fpath: str, offset: float = 0.0, duration: float = None):
+    """Computes the query embedding of an audio clip.
+
+    Clips longer than one segment are split and their embeddings averaged.
+
+    Args:
+        fpath: Path to the audio file.
+        offset: Start of the clip in seconds.
+        duration: Duration of the clip in seconds. Defaults to one segment.
+
+    Returns:
+        The query embedding.
+    """
+    import analyze
+    import model
+
+    chunks = analyze.getRawAudioFromFile(fpath, offset, duration or cfg.SIG_LENGTH, overlap=0)
+    data = np.array(chunks, dtype="float32")
+
+    return normalize(model.embeddings(data)).mean(axis=0)
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Find segments similar to a query clip in embeddings archives")
+    parser.add_argument("--archive", nargs="+", required=True, help="Path to one or more embeddings archives.")
+    parser.add_argument("--query", help="Path to the audio file of the query clip.")
+    parser.add_argument("--offset", type=float, default=0.0, help="Start of the query clip in seconds. Defaults to 0.")
+    parser.add_argument(
+        "--duration", type=float, default=None, help="Duration of the query clip in seconds. Defaults to one segment."
+    )
+    parser.add_argument("--k", type=int, default=10, help="Number of results. Defaults to 10.")
+    parser.add_argument("--ivf", action="store_true", help="Search with the IVF index instead of exhaustively.")
+    parser.add_argument("--nprobe", type=int, default=8, help="Number of inverted lists to search. Defaults to 8.")
+    parser.add_argument("--build_index", action="store_true", help="Build the IVF index of the archives.")
+    parser.add_argument(
+        "--nlist", type=int, default=None, help="Number of inverted lists of a new index. Defaults to 4 * sqrt(rows)."
+    )
+    parser.add_argument("--threads", type=int, default=4, help="Number of CPU threads for the model. Defaults to 4.")
+
+    args = parser.parse_args()
+
+    # Set paths relative to script path (requested in #3)
+    cfg.MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), cfg.MODEL_PATH)
+    cfg.ERROR_LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), cfg.ERROR_LOG_FILE)
+    cfg.TFLITE_THREADS = max(1, int(args.threads))
+
+    archives = [EmbeddingsArchive(path) for path in args.archive]
+
+    if args.build_index:
+        for archive in archives:
+            print(f"Building IVF index for {archive.path} ({len(archive)} segments)", flush=True)
+            IVFIndex.build(archive, args.nlist).save(archive)
+
+    if args.query:
+        query = embedQuery(args.query, args.offset, args.duration)
+
+        for score, fpath, start, end in search(archives, query, args.k, args.ivf, args.nprobe):
+            print(f"{score:.4f}\t{fpath}\t{start}\t{end}")
+
+    # python3 embeddings_index.py --archive example/BirdNET.embeddings --build_index
+    # python3 embeddings_index.py --archive example/BirdNET.embeddings --query example/soundscape.wav --offset 12 --ivf
@@ -31,6 +31,7 @@ import librosa
 import webview
 
 import analyze
+import result_writers
 import segments
 import species
 import utils
@@ -338,7 +339,7 @@ def runAnalysis(
     # Set result type
     cfg.RESULT_TYPE = OUTPUT_TYPE_MAP[output_type] if output_type in OUTPUT_TYPE_MAP else output_type.lower()
 
-    if not cfg.RESULT_TYPE in ["table", "audacity", "r", "csv", "kaleidoscope"]:
+    if not cfg.RESULT_TYPE in result_writers.WRITERS:
         cfg.RESULT_TYPE = "table"
 
     # Set output filename
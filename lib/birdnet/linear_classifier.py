@@ -0,0 +1,375 @@
+"""Module to train and run custom classifiers with NumPy only.
+
+The classifiers have the same layout as model.buildLinearClassifier: an
+optional hidden ReLU layer, dropout and a dense output layer with sigmoid
+activation. They are trained on BirdNET embeddings with the same loss,
+optimizer, learning rate schedule and early stopping as the Keras
+classifiers, but neither training nor inference imports TensorFlow.
+"""
+
+import copy
+import os
+
+import numpy as np
+
+import config as cfg
+import utils
+
+
+class History:
+    """Training history with the attributes of a Keras `History`."""
+
+    def __init__(self):
+        self.epoch = []
+        self.history = {}
+
+    def add(self, epoch: int, logs: dict):
+        self.epoch.append(epoch)
+
+        for key, value in logs.items():
+            self.history.setdefault(key, []).append(value)
+
+
+def buildClassifier(num_labels, input_size, hidden_units=0, dropout=0.0):
+    """Builds a classifier.
+
+    Args:
+        num_labels: Output size.
+        input_size: Size of the input.
+        hidden_units: If > 0, creates another hidden layer with the given number of units.
+        dropout: Dropout rate in front of each dense layer.
+
+    Returns:
+        A new classifier.
+    """
+    rng = np.random.RandomState(cfg.RANDOM_SEED)
+    sizes = [input_size, *([hidden_units] if hidden_units > 0 else []), num_labels]
+    layers = []
+
+    # Glorot uniform initialization, like Keras dense layers
+    for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+        limit = np.sqrt(6 / (fan_in + fan_out))
+        layers.append(
+            [rng.uniform(-limit, limit, (fan_in, fan_out)).astype("float32"), np.zeros(fan_out, dtype="float32")]
+        )
+
+    return {"layers": layers, "dropout": dropout}
+
+
+def sigmoid(x):
+    return 1 / (1.0 + np.exp(-np.clip(x, -30, 30)))
+
+
+def customLoss(y_true, y_pred, epsilon=1e-7):
+    """NumPy version of model.custom_loss, averaged over the batch.
+
+    Args:
+        y_true: True labels.
+        y_pred: Predicted labels.
+        epsilon: Epsilon value to avoid log(0).
+
+    Returns:
+        The loss.
+    """
+    y_pred = np.clip(y_pred, epsilon, 1.0 - epsilon)
+
+    # Loss for positive and negative labels
+    positive_loss = -np.sum(y_true * np.log(y_pred), axis=-1)
+    negative_loss = -np.sum((1 - y_true) * np.log(1 - y_pred), axis=-1)
+
+    return float(np.mean(positive_loss + negative_loss))
+
+
+def _forward(classifier, x, rng=None):
+    """Runs the classifier and keeps the inputs of every dense layer.
+
+    Dropout is only applied if a random state is given, i.e. during training.
+
+    Returns:
+        A tuple of (logits, layer inputs, dropout masks).
+    """
+    layers, dropout = classifier["layers"], classifier["dropout"]
+    inputs, masks = [], []
+    h = x
+
+    for i, (w, b) in enumerate(layers):
+        mask = None
+
+        if rng is not None and dropout > 0:
+            mask = (rng.uniform(size=h.shape) >= dropout).astype("float32") / (1 - dropout)
+            h = h * mask
+
+        inputs.append(h)
+        masks.append(mask)
+        h = h @ w + b
+
+        # Hidden layer activation
+        if i < len(layers) - 1:
+            h = np.maximum(h, 0)
+
+    return h, inputs, masks
+
+
+def _backward(classifier, inputs, masks, grad):
+    """Backpropagates the gradient of the logits.
+
+    Returns:
+        A list of (weights gradient, bias gradient) per layer.
+    """
+    layers = classifier["layers"]
+    grads = [None] * len(layers)
+
+    for i in reversed(range(len(layers))):
+        w, _ = layers[i]
+        grads[i] = (inputs[i].T @ grad, grad.sum(axis=0))
+
+        if i > 0:
+            grad = grad @ w.T
+
+            if masks[i] is not None:
+                grad = grad * masks[i]
+
+            # ReLU of the hidden layer
+            grad = grad * (inputs[i] > 0)
+
+    return grads
+
+
+def _rocAuc(positive, scores):
+    num_positive = positive.sum()
+    num_negative = len(positive) - num_positive
+
+    if num_positive == 0 or num_negative == 0:
+        return 0.0
+
+    ranks = np.empty(len(scores))
+    ranks[np.argsort(scores, kind="stable")] = np.arange(1, len(scores) + 1)
+
+    return float((ranks[positive].sum() - num_positive * (num_positive + 1) / 2) / (num_positive * num_negative))
+
+
+def _prAuc(positive, scores):
+    num_positive = positive.sum()
+
+    if num_positive == 0:
+        return 0.0
+
+    # Average precision
+    positive = positive[np.argsort(-scores, kind="stable")]
+    precision = np.cumsum(positive) / np.arange(1, len(positive) + 1)
+
+    return float((precision * positive).sum() / num_positive)
+
+
+def auc(y_true, y_pred, curve="ROC"):
+    """Area under the ROC or PR curve.
+
+    Labels are flattened, or averaged per label for multi-label classifiers,
+    like the Keras AUC metrics used for training.
+
+    Args:
+        y_true: True labels.
+        y_pred: Predicted scores.
+        curve: 'ROC' or 'PR'.
+
+    Returns:
+        The area under the curve.
+    """
+    fn = _rocAuc if curve == "ROC" else _prAuc
+    positive = y_true > 0
+
+    if cfg.MULTI_LABEL:
+        return float(np.mean([fn(positive[:, i], y_pred[:, i]) for i in range(y_true.shape[1])]))
+
+    return fn(positive.ravel(), y_pred.ravel())
+
+
+def predict(classifier, x):
+    """Computes the logits of the classifier.
+
+    Args:
+        classifier: The classifier.
+        x: Embeddings.
+
+    Returns:
+        The logits, the activation is applied by the caller like for the tflite classifiers.
+    """
+    return _forward(classifier, np.asarray(x, dtype="float32"))[0]
+
+
+def trainClassifier(
+    classifier,
+    x_train,
+    y_train,
+    epochs,
+    batch_size,
+    learning_rate,
+    val_split,
+    upsampling_ratio,
+    upsampling_mode,
+    train_with_mixup,
+    train_with_label_smoothing,
+    on_epoch_end=None,
+    prepared_data=None,
+):
+    """Trains a custom classifier.
+
+    Minibatch Adam with cosine learning rate decay, early stopping on the
+    validation loss (patience 5, from epoch 5) and restoring the best weights,
+    same as model.trainLinearClassifier.
+
+    Args:
+        classifier: The classifier to be trained.
+        x_train: Samples.
+        y_train: Labels.
+        epochs: Number of epochs to train.
+        batch_size: Batch size.
+        learning_rate: The learning rate during training.
+        on_epoch_end: Optional callback `function(epoch, logs)`.
+        prepared_data: Optional result of `utils.prepareTrainingData` for these settings.
+
+    Returns:
+        (classifier, history)
+    """
+    # Shuffle, split and augment data
+    if prepared_data is None:
+        prepared_data = utils.prepareTrainingData(
+            x_train,
+            y_train,
+            val_split,
+            upsampling_ratio,
+            upsampling_mode,
+            train_with_mixup,
+            train_with_label_smoothing,
+        )
+
+    x_train, y_train, x_val, y_val = prepared_data
+    x_train = np.asarray(x_train, dtype="float32")
+    y_train = np.asarray(y_train, dtype="float32")
+
+    rng = np.random.RandomState(cfg.RANDOM_SEED)
+    layers = classifier["layers"]
+
+    # Adam state
+    beta_1, beta_2, epsilon = 0.9, 0.999, 1e-7
+    m = [[np.zeros_like(p) for p in layer] for layer in layers]
+    v = [[np.zeros_like(p) for p in layer] for layer in layers]
+    decay_steps = epochs * x_train.shape[0] / batch_size
+    step = 0
+
+    history = History()
+    best_val_loss, best_layers, wait = np.inf, None, 0
+
+    for epoch in range(epochs):
+        order = rng.permutation(len(x_train))
+        loss_sum = 0.0
+
+        for start in range(0, len(order), batch_size):
+            idx = order[start : start + batch_size]
+            logits, inputs, masks = _forward(classifier, x_train[idx], rng)
+            y_pred = sigmoid(logits)
+            loss_sum += customLoss(y_train[idx], y_pred) * len(idx)
+
+            # Gradient of the loss w.r.t. the logits is (y_pred - y_true)
+            grads = _backward(classifier, inputs, masks, (y_pred - y_train[idx]) / len(idx))
+
+            # Cosine annealing lr schedule
+            step += 1
+            lr = learning_rate * 0.5 * (1 + np.cos(np.pi * min(step, decay_steps) / decay_steps))
+            lr_t = lr * np.sqrt(1 - beta_2**step) / (1 - beta_1**step)
+
+            for layer, layer_grads, layer_m, layer_v in zip(layers, grads, m, v):
+                for j in range(2):
+                    layer_m[j] = beta_1 * layer_m[j] + (1 - beta_1) * layer_grads[j]
+                    layer_v[j] = beta_2 * layer_v[j] + (1 - beta_2) * layer_grads[j] ** 2
+                    layer[j] -= (lr_t * layer_m[j] / (np.sqrt(layer_v[j]) + epsilon)).astype("float32")
+
+        # Validate
+        val_pred = sigmoid(predict(classifier, x_val))
+        logs = {
+            "loss": loss_sum / len(x_train),
+            "val_loss": customLoss(y_val, val_pred),
+            "val_AUPRC": auc(y_val, val_pred, "PR"),
+            "val_AUROC": auc(y_val, val_pred, "ROC"),
+        }
+        history.add(epoch, logs)
+
+        print(
+            f"Epoch {epoch + 1}/{epochs} - loss: {logs['loss']:.4f} - val_loss: {logs['val_loss']:.4f} - val_AUPRC: {logs['val_AUPRC']:.4f}",
+            flush=True,
+        )
+
+        if on_epoch_end:
+            on_epoch_end(epoch, logs)
+
+        # Early stopping
+        if epoch < 5:
+            continue
+
+        if logs["val_loss"] < best_val_loss:
+            best_val_loss, best_layers, wait = logs["val_loss"], copy.deepcopy(layers), 0
+        else:
+            wait += 1
+
+            if wait >= 5:
+                print(f"Epoch {epoch + 1}: early stopping", flush=True)
+                break
+
+    # Restore best weights
+    if best_layers is not None:
+        classifier["layers"] = best_layers
+
+    return classifier, history
+
+
+def saveClassifier(classifier, model_path: str, labels: list[str], mode="replace"):
+    """Saves a custom classifier on the hard drive.
+
+    Saves the weights as .npz, as well as the used labels in a .txt.
+
+    Args:
+        classifier: The custom classifier.
+        model_path: Path the model will be saved at.
+        labels: List of labels used for the classifier.
+        mode: Only 'replace' is supported, the classifier runs on the embeddings.
+    """
+    if mode != "replace":
+        raise ValueError("NumPy classifiers can only be saved in 'replace' mode, use the tflite format to append")
+
+    # Append .npz if necessary
+    if not model_path.endswith(".npz"):
+        model_path += ".npz"
+
+    # Make folders
+    if os.path.dirname(model_path):
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+
+    weights = {}
+
+    for i, (w, b) in enumerate(classifier["layers"]):
+        weights[f"w{i}"] = w
+        weights[f"b{i}"] = b
+
+    np.savez(model_path, num_layers=len(classifier["layers"]), dropout=classifier["dropout"], **weights)
+
+    # Save labels
+    with open(model_path.replace(".npz", "_Labels.txt"), "w", encoding="utf-8") as f:
+        for label in labels:
+            f.write(label + "\n")
+
+    utils.save_model_params(model_path.replace(".npz", "_Params.csv"))
+
+
+def loadClassifier(model_path: str):
+    """Loads a custom classifier saved with `saveClassifier`.
+
+    Args:
+        model_path: Path to the .npz file.
+
+    Returns:
+        The classifier.
+    """
+    with np.load(model_path, allow_pickle=False) as data:
+        layers = [[data[f"w{i}"], data[f"b{i}"]] for i in range(int(data["num_layers"]))]
+
+        return {"layers": layers, "dropout": float(data["dropout"])}
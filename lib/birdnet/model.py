@@ -30,6 +30,8 @@ C_INTERPRETER: tflite.Interpreter = None
 M_INTERPRETER: tflite.Interpreter = None
 PBMODEL = None
 C_PBMODEL = None
+C_NUMPY_CLASSIFIER = None
+C_HEADS = None
 
 
 def loadModel(class_output=True):
@@ -42,6 +44,8 @@ def loadModel(class_output=True):
     global INTERPRETER
     global INPUT_LAYER_INDEX
     global OUTPUT_LAYER_INDEX
+    global CLASS_OUTPUT_LAYER_INDEX
+    global EMBEDDINGS_LAYER_INDEX
 
     cfg.MODEL_PATH = f"{PROJECT_PATH}/lib/birdnet/checkpoints/V2.4/BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite"
 
@@ -60,11 +64,16 @@ def loadModel(class_output=True):
         # Get input tensor index
         INPUT_LAYER_INDEX = input_details[0]["index"]
 
+        # Classification output and feature embeddings (the layer before),
+        # both are available after a single invoke()
+        CLASS_OUTPUT_LAYER_INDEX = output_details[0]["index"]
+        EMBEDDINGS_LAYER_INDEX = output_details[0]["index"] - 1
+
         # Get classification output or feature embeddings
         if class_output:
-            OUTPUT_LAYER_INDEX = output_details[0]["index"]
+            OUTPUT_LAYER_INDEX = CLASS_OUTPUT_LAYER_INDEX
         else:
-            OUTPUT_LAYER_INDEX = output_details[0]["index"] - 1
+            OUTPUT_LAYER_INDEX = EMBEDDINGS_LAYER_INDEX
 
     else:
         # Load protobuf model
@@ -73,6 +82,44 @@ def loadModel(class_output=True):
         PBMODEL = keras.models.load_model(cfg.MODEL_PATH, compile=False)
 
 
+def loadClassifier(path: str):
+    """Loads a custom classifier.
+
+    Args:
+        path: Path to a .npz, .tflite or saved model classifier.
+
+    Returns:
+        A dictionary with the type of the classifier and everything needed to run it.
+    """
+    if path.endswith(".npz"):
+        import linear_classifier
+
+        # Runs on the embeddings without TensorFlow
+        return {"type": "numpy", "classifier": linear_classifier.loadClassifier(path)}
+    elif path.endswith(".tflite"):
+        # Load TFLite model and allocate tensors.
+        interpreter = tflite.Interpreter(model_path=path, num_threads=cfg.TFLITE_THREADS)
+        interpreter.allocate_tensors()
+
+        # Get input and output tensors.
+        input_details = interpreter.get_input_details()
+        output_details = interpreter.get_output_details()
+
+        return {
+            "type": "tflite",
+            "interpreter": interpreter,
+            "input_index": input_details[0]["index"],
+            "input_size": input_details[0]["shape"][-1],
+            "output_index": output_details[0]["index"],
+        }
+    else:
+        import tensorflow as tf
+
+        tf.get_logger().setLevel("ERROR")
+
+        return {"type": "saved_model", "model": tf.saved_model.load(path)}
+
+
 def loadCustomClassifier():
     """Loads the custom classifier."""
     global C_INTERPRETER
@@ -80,31 +127,45 @@ def loadCustomClassifier():
     global C_OUTPUT_LAYER_INDEX
     global C_INPUT_SIZE
     global C_PBMODEL
+    global C_NUMPY_CLASSIFIER
 
-    if cfg.CUSTOM_CLASSIFIER.endswith(".tflite"):
-        # Load TFLite model and allocate tensors.
-        C_INTERPRETER = tflite.Interpreter(
-            model_path=cfg.CUSTOM_CLASSIFIER, num_threads=cfg.TFLITE_THREADS
-        )
-        C_INTERPRETER.allocate_tensors()
+    classifier = loadClassifier(cfg.CUSTOM_CLASSIFIER)
 
-        # Get input and output tensors.
-        input_details = C_INTERPRETER.get_input_details()
-        output_details = C_INTERPRETER.get_output_details()
+    if classifier["type"] == "numpy":
+        C_NUMPY_CLASSIFIER = classifier["classifier"]
+    elif classifier["type"] == "tflite":
+        C_INTERPRETER = classifier["interpreter"]
+        C_INPUT_LAYER_INDEX = classifier["input_index"]
+        C_INPUT_SIZE = classifier["input_size"]
+        C_OUTPUT_LAYER_INDEX = classifier["output_index"]
+    else:
+        C_PBMODEL = classifier["model"]
 
-        # Get input tensor index
-        C_INPUT_LAYER_INDEX = input_details[0]["index"]
 
-        C_INPUT_SIZE = input_details[0]["shape"][-1]
+def loadClassifierHeads(paths: list[str]):
+    """Loads several custom classifiers to be evaluated together.
 
-        # Get classification output
-        C_OUTPUT_LAYER_INDEX = output_details[0]["index"]
-    else:
-        import tensorflow as tf
+    The first dense layers of all NumPy classifiers are concatenated, so they
+    run as a single matrix product on the shared embeddings.
 
-        tf.get_logger().setLevel("ERROR")
+    Args:
+        paths: Paths to the classifiers.
+    """
+    global C_HEADS
+
+    heads = [loadClassifier(path) for path in paths]
+    numpy_heads = [i for i, head in enumerate(heads) if head["type"] == "numpy"]
+    stacked = None
+
+    if len(numpy_heads) > 1:
+        first_layers = [heads[i]["classifier"]["layers"][0] for i in numpy_heads]
+        stacked = (
+            np.concatenate([w for w, _ in first_layers], axis=1),
+            np.concatenate([b for _, b in first_layers]),
+            np.cumsum([w.shape[1] for w, _ in first_layers])[:-1],
+        )
 
-        C_PBMODEL = tf.saved_model.load(cfg.CUSTOM_CLASSIFIER)
+    C_HEADS = {"paths": list(paths), "heads": heads, "numpy_heads": numpy_heads, "stacked": stacked}
 
 
 def loadMetaModel():
@@ -184,6 +245,7 @@ def trainLinearClassifier(
     train_with_mixup,
     train_with_label_smoothing,
     on_epoch_end=None,
+    prepared_data=None,
 ):
     """Trains a custom classifier.
 
@@ -197,6 +259,8 @@ def trainLinearClassifier(
         batch_size: Batch size.
         learning_rate: The learning rate during training.
         on_epoch_end: Optional callback `function(epoch, logs)`.
+        prepared_data: Optional result of `utils.prepareTrainingData` for these settings,
+            the data is not split and augmented again if given.
 
     Returns:
         (classifier, history)
@@ -213,42 +277,19 @@ def trainLinearClassifier(
             if self.on_epoch_end_fn:
                 self.on_epoch_end_fn(epoch, logs)
 
-    # Set random seed
-    np.random.seed(cfg.RANDOM_SEED)
-
-    # Shuffle data
-    idx = np.arange(x_train.shape[0])
-    np.random.shuffle(idx)
-    x_train = x_train[idx]
-    y_train = y_train[idx]
-
-    # Random val split
-    if not cfg.MULTI_LABEL:
-        x_train, y_train, x_val, y_val = utils.random_split(x_train, y_train, val_split)
-    else:
-        x_train, y_train, x_val, y_val = utils.random_multilabel_split(
-            x_train, y_train, val_split
-        )
-
-    print(
-        f"Training on {x_train.shape[0]} samples, validating on {x_val.shape[0]} samples.",
-        flush=True,
-    )
-
-    # Upsample training data
-    if upsampling_ratio > 0:
-        x_train, y_train = utils.upsampling(
-            x_train, y_train, upsampling_ratio, upsampling_mode
+    # Shuffle, split and augment data
+    if prepared_data is None:
+        prepared_data = utils.prepareTrainingData(
+            x_train,
+            y_train,
+            val_split,
+            upsampling_ratio,
+            upsampling_mode,
+            train_with_mixup,
+            train_with_label_smoothing,
         )
-        print(f"Upsampled training data to {x_train.shape[0]} samples.", flush=True)
 
-    # Apply mixup to training data
-    if train_with_mixup and not cfg.BINARY_CLASSIFICATION:
-        x_train, y_train = utils.mixup(x_train, y_train)
-
-    # Apply label smoothing
-    if train_with_label_smoothing and not cfg.BINARY_CLASSIFICATION:
-        y_train = utils.label_smoothing(y_train)
+    x_train, y_train, x_val, y_val = prepared_data
 
     # Early stopping
     callbacks = [
@@ -615,11 +656,12 @@ def predict(sample):
         return prediction
 
 
-def predictWithCustomClassifier(sample):
+def predictWithCustomClassifier(sample, sample_embeddings=None):
     """Uses the custom classifier to make a prediction.
 
     Args:
         sample: Audio sample.
+        sample_embeddings: Embeddings of the sample if they have already been computed.
 
     Returns:
         The prediction scores for the sample.
@@ -629,11 +671,22 @@ def predictWithCustomClassifier(sample):
     global C_PBMODEL
 
     # Does interpreter exist?
-    if C_INTERPRETER == None and C_PBMODEL == None:
+    if C_INTERPRETER == None and C_PBMODEL == None and C_NUMPY_CLASSIFIER == None:
         loadCustomClassifier()
 
-    if C_PBMODEL == None:
-        vector = embeddings(sample) if C_INPUT_SIZE != 144000 else sample
+    if C_NUMPY_CLASSIFIER is not None:
+        import linear_classifier
+
+        vector = sample_embeddings if sample_embeddings is not None else embeddings(sample)
+
+        return linear_classifier.predict(C_NUMPY_CLASSIFIER, vector)
+    elif C_PBMODEL == None:
+        if C_INPUT_SIZE == 144000:
+            vector = sample
+        elif sample_embeddings is not None:
+            vector = sample_embeddings
+        else:
+            vector = embeddings(sample)
 
         # Reshape input tensor
         C_INTERPRETER.resize_tensor_input(
@@ -653,6 +706,70 @@ def predictWithCustomClassifier(sample):
         return prediction
 
 
+def _predictWithHead(head: dict, sample, sample_embeddings):
+    if head["type"] == "numpy":
+        import linear_classifier
+
+        return linear_classifier.predict(head["classifier"], sample_embeddings)
+    elif head["type"] == "tflite":
+        interpreter = head["interpreter"]
+        vector = sample if head["input_size"] == 144000 else sample_embeddings
+
+        # Reshape input tensor, only if the batch shape changed
+        input_shape = [len(vector), *np.shape(vector[0])]
+
+        if list(interpreter.get_input_details()[0]["shape"]) != input_shape:
+            interpreter.resize_tensor_input(head["input_index"], input_shape)
+            interpreter.allocate_tensors()
+
+        # Make a prediction
+        interpreter.set_tensor(head["input_index"], np.array(vector, dtype="float32"))
+        interpreter.invoke()
+
+        return interpreter.get_tensor(head["output_index"])
+    else:
+        return head["model"].basic(sample)["scores"]
+
+
+def predictWithClassifiers(sample, sample_embeddings, paths: list[str]):
+    """Uses several custom classifiers to make predictions for the same sample.
+
+    Classifiers on top of the embeddings share `sample_embeddings`, the first
+    layers of all NumPy classifiers are evaluated in one matrix product.
+
+    Args:
+        sample: Audio sample.
+        sample_embeddings: Embeddings of the sample.
+        paths: Paths to the classifiers.
+
+    Returns:
+        A list with the prediction scores of each classifier.
+    """
+    # Load heads on first use or if the classifiers changed
+    if C_HEADS is None or C_HEADS["paths"] != list(paths):
+        loadClassifierHeads(paths)
+
+    heads = C_HEADS["heads"]
+    predictions = [None] * len(heads)
+
+    if C_HEADS["stacked"] is not None:
+        w, b, splits = C_HEADS["stacked"]
+        hidden = np.split(np.asarray(sample_embeddings, dtype="float32") @ w + b, splits, axis=1)
+
+        # Remaining layers of each classifier, hidden layers use ReLU
+        for i, h in zip(C_HEADS["numpy_heads"], hidden):
+            for w, b in heads[i]["classifier"]["layers"][1:]:
+                h = np.maximum(h, 0) @ w + b
+
+            predictions[i] = h
+
+    for i, head in enumerate(heads):
+        if predictions[i] is None:
+            predictions[i] = _predictWithHead(head, sample, sample_embeddings)
+
+    return predictions
+
+
 def embeddings(sample):
     """Extracts the embeddings for a sample.
 
@@ -668,13 +785,46 @@ def embeddings(sample):
     if INTERPRETER == None:
         loadModel(False)
 
+    # Reshape input tensor, only if the batch shape changed
+    input_shape = [len(sample), *np.shape(sample[0])]
+
+    if list(INTERPRETER.get_input_details()[0]["shape"]) != input_shape:
+        INTERPRETER.resize_tensor_input(INPUT_LAYER_INDEX, input_shape)
+        INTERPRETER.allocate_tensors()
+
+    # Extract feature embeddings
+    INTERPRETER.set_tensor(INPUT_LAYER_INDEX, np.array(sample, dtype="float32"))
+    INTERPRETER.invoke()
+    features = INTERPRETER.get_tensor(EMBEDDINGS_LAYER_INDEX)
+
+    return features
+
+
+def predictWithEmbeddings(sample):
+    """Uses the main net to predict a sample and extract its embeddings.
+
+    Both outputs are read from the same forward pass.
+
+    Args:
+        sample: Audio sample.
+
+    Returns:
+        A tuple of (prediction scores, embeddings).
+    """
+    global INTERPRETER
+
+    # Does interpreter exist?
+    if INTERPRETER == None:
+        loadModel()
+
     # Reshape input tensor
     INTERPRETER.resize_tensor_input(INPUT_LAYER_INDEX, [len(sample), *sample[0].shape])
     INTERPRETER.allocate_tensors()
 
-    # Extract feature embeddings
+    # Make a prediction and keep the embeddings of the same pass
     INTERPRETER.set_tensor(INPUT_LAYER_INDEX, np.array(sample, dtype="float32"))
     INTERPRETER.invoke()
-    features = INTERPRETER.get_tensor(OUTPUT_LAYER_INDEX)
+    prediction = INTERPRETER.get_tensor(CLASS_OUTPUT_LAYER_INDEX)
+    features = INTERPRETER.get_tensor(EMBEDDINGS_LAYER_INDEX)
 
-    return features
+    return prediction, features
@@ -0,0 +1,495 @@
+"""Module with the writers for the result file formats.
+
+A writer receives the segments of one audio file in order and streams the
+formatted rows into a buffered temporary file, which replaces the result
+file once it is complete. New formats register a writer class with
+`registerWriter` and become available as `--rtype <name>`.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+import audio
+import config as cfg
+import utils
+
+# Size of the write buffer of the result files
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Folder with the Parquet results of all files of an output folder
+PARQUET_DATASET = "BirdNET.results.dataset"
+
+# Maximum number of rows per file of the Parquet dataset
+PARQUET_DATASET_ROWS_PER_FILE = 4 * 1024 * 1024
+
+#                    0       1      2           3             4              5               6                7           8             9           10         11
+RTABLE_HEADER = "Selection\tView\tChannel\tBegin Time (s)\tEnd Time (s)\tLow Freq (Hz)\tHigh Freq (Hz)\tCommon Name\tSpecies Code\tConfidence\tBegin Path\tFile Offset (s)\n"
+
+WRITERS = {}
+
+
+def registerWriter(name: str, writer):
+    """Makes a writer class available as result type `name`."""
+    WRITERS[name] = writer
+
+    return writer
+
+
+def getWriter(result_type: str = None):
+    """Gets the writer class of a result type.
+
+    Args:
+        result_type: The result type. Defaults to cfg.RESULT_TYPE.
+
+    Returns:
+        The writer class, the CSV writer for unknown types.
+    """
+    return WRITERS.get(result_type or cfg.RESULT_TYPE, CsvWriter)
+
+
+class ResultWriter:
+    """Writes the results of one audio file.
+
+    Use as context manager, the result file is only replaced if no exception
+    occurred. Subclasses implement `open`, `writeSegment` and `close`.
+    """
+
+    # Appended to the audio file name, without extension, to get the result file name
+    suffix = ".BirdNET.results.csv"
+
+    def __init__(self, path: str, afile_path: str, model: str = None):
+        """Creates a writer.
+
+        Args:
+            path: The path where the result should be saved.
+            afile_path: The path to audio file.
+            model: Name of the model the scores are from. Defaults to the custom classifier or BirdNET model file.
+        """
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.afile_path = afile_path
+        self.model = model or os.path.basename(os.path.normpath(cfg.CUSTOM_CLASSIFIER or cfg.MODEL_PATH))
+
+        # Lookups for every row
+        self.labels = dict(zip(cfg.LABELS, cfg.TRANSLATED_LABELS))
+        self.species_list = set(cfg.SPECIES_LIST) if cfg.SPECIES_LIST else None
+
+    def detections(self, scores):
+        """Yields (label, translated label, score) of the scores that make it into the result file.
+
+        Args:
+            scores: A list of (label, score), sorted by descending score.
+        """
+        for c in scores:
+            if c[1] > cfg.MIN_CONFIDENCE and (self.species_list is None or c[0] in self.species_list):
+                yield c[0], self.labels[c[0]], c[1]
+
+    def open(self):
+        raise NotImplementedError
+
+    def writeSegment(self, start: str, end: str, scores):
+        """Writes the detections of a segment.
+
+        Args:
+            start: Start of the segment in seconds, as in the result keys.
+            end: End of the segment in seconds.
+            scores: A list of (label, score), sorted by descending score.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        # Make folder if it doesn't exist
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.open()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+            # Write to a temporary file first so that an interrupted
+            # run never leaves a partial result file behind
+            os.replace(self.tmp_path, self.path)
+        else:
+            self.abort()
+
+    def abort(self):
+        """Drops the temporary file after an error."""
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class TextWriter(ResultWriter):
+    """Streams text rows into a buffered file."""
+
+    def header(self):
+        return ""
+
+    def rows(self, start: str, end: str, scores):
+        """Yields the formatted rows of a segment."""
+        raise NotImplementedError
+
+    def footer(self):
+        return ""
+
+    def open(self):
+        header = self.header()
+        self.file = open(self.tmp_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+        self.file.write(header)
+
+    def writeSegment(self, start: str, end: str, scores):
+        self.file.writelines(self.rows(start, end, scores))
+
+    def close(self):
+        self.file.write(self.footer())
+        self.file.close()
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+
+        super().abort()
+
+
+class TableWriter(TextWriter):
+    """Raven selection table."""
+
+    suffix = ".BirdNET.selection.table.txt"
+
+    def header(self):
+        # Read native sample rate
+        high_freq = audio.get_sample_rate(self.afile_path) / 2
+
+        if high_freq > cfg.SIG_FMAX:
+            high_freq = cfg.SIG_FMAX
+
+        self.high_freq = min(high_freq, cfg.BANDPASS_FMAX)
+        self.low_freq = max(cfg.SIG_FMIN, cfg.BANDPASS_FMIN)
+        self.selection_id = 0
+
+        return RTABLE_HEADER
+
+    def rows(self, start, end, scores):
+        for label, translated_label, score in self.detections(scores):
+            self.selection_id += 1
+            code = cfg.CODES[label] if label in cfg.CODES else label
+
+            yield f"{self.selection_id}\tSpectrogram 1\t1\t{start}\t{end}\t{self.low_freq}\t{self.high_freq}\t{translated_label.split('_', 1)[-1]}\t{code}\t{score:.4f}\t{self.afile_path}\t{start}\n"
+
+
+class AudacityWriter(TextWriter):
+    """Audacity timeline labels."""
+
+    suffix = ".BirdNET.results.txt"
+
+    def rows(self, start, end, scores):
+        for _, translated_label, score in self.detections(scores):
+            yield f"{start}\t{end}\t{translated_label.replace('_', ', ')}\t{score:.4f}\n"
+
+
+class RWriter(TextWriter):
+    """Output format for R."""
+
+    def header(self):
+        return "filepath,start,end,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity,min_conf,species_list,model"
+
+    def rows(self, start, end, scores):
+        for _, translated_label, score in self.detections(scores):
+            yield "\n{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{},{},{},{}".format(
+                self.afile_path,
+                start,
+                end,
+                translated_label.split("_", 1)[0],
+                translated_label.split("_", 1)[-1],
+                score,
+                cfg.LATITUDE,
+                cfg.LONGITUDE,
+                cfg.WEEK,
+                cfg.SIG_OVERLAP,
+                (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+                cfg.MIN_CONFIDENCE,
+                cfg.SPECIES_LIST_FILE,
+                os.path.basename(cfg.MODEL_PATH),
+            )
+
+
+class KaleidoscopeWriter(TextWriter):
+    """Output format for Kaleidoscope."""
+
+    def header(self):
+        folder_path, self.filename = os.path.split(self.afile_path)
+        self.parent_folder, self.folder_name = os.path.split(folder_path)
+
+        return "INDIR,FOLDER,IN FILE,OFFSET,DURATION,scientific_name,common_name,confidence,lat,lon,week,overlap,sensitivity"
+
+    def rows(self, start, end, scores):
+        for _, translated_label, score in self.detections(scores):
+            yield "\n{},{},{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{}".format(
+                self.parent_folder.rstrip("/"),
+                self.folder_name,
+                self.filename,
+                start,
+                float(end) - float(start),
+                translated_label.split("_", 1)[0],
+                translated_label.split("_", 1)[-1],
+                score,
+                cfg.LATITUDE,
+                cfg.LONGITUDE,
+                cfg.WEEK,
+                cfg.SIG_OVERLAP,
+                (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+            )
+
+
+class CsvWriter(TextWriter):
+    """Generic CSV file with start, end, species and confidence."""
+
+    def header(self):
+        return "Start (s),End (s),Scientific name,Common name,Confidence\n"
+
+    def rows(self, start, end, scores):
+        formatted_start_time = f"{int(float(start)//60)}m{int(float(start)%60)}s"
+        formatted_end_time = f"{int(float(end)//60)}m{int(float(end)%60)}s"
+
+        for _, translated_label, score in self.detections(scores):
+            yield "{},{},{},{},{:.4f}\n".format(
+                formatted_start_time,
+                formatted_end_time,
+                translated_label.split("_", 1)[0],
+                translated_label.split("_", 1)[-1],
+                score,
+            )
+
+
+class ParquetWriter(ResultWriter):
+    """Parquet file with typed columns.
+
+    Columns are file, start, end, label (index into the labels), scientific_name,
+    common_name, confidence (float32), model and params. Strings are dictionary
+    encoded, so repeated names and the per-file values cost next to nothing.
+    """
+
+    suffix = ".BirdNET.results.parquet"
+
+    def open(self):
+        self.label_index = {label: i for i, label in enumerate(cfg.LABELS)}
+        self.starts, self.ends, self.label_ids, self.confidences = [], [], [], []
+
+    def writeSegment(self, start, end, scores):
+        start, end = float(start), float(end)
+
+        for label, _, score in self.detections(scores):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.label_ids.append(self.label_index[label])
+            self.confidences.append(score)
+
+    def close(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        label_ids = np.array(self.label_ids, dtype="int32")
+        num_rows = len(label_ids)
+
+        # Names of the labels that occur in this file
+        used_ids, indices = np.unique(label_ids, return_inverse=True)
+        names = [self.labels[cfg.LABELS[i]] for i in used_ids]
+        indices = pa.array(indices.astype("int32"), pa.int32())
+
+        def constant(value: str):
+            return pa.DictionaryArray.from_arrays(pa.array(np.zeros(num_rows, dtype="int32")), pa.array([value]))
+
+        params = {
+            "lat": cfg.LATITUDE,
+            "lon": cfg.LONGITUDE,
+            "week": cfg.WEEK,
+            "overlap": cfg.SIG_OVERLAP,
+            "sensitivity": (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+            "min_conf": cfg.MIN_CONFIDENCE,
+            "species_list": cfg.SPECIES_LIST_FILE,
+        }
+
+        table = pa.table(
+            {
+                "file": constant(self.afile_path),
+                "start": pa.array(self.starts, pa.float64()),
+                "end": pa.array(self.ends, pa.float64()),
+                "label": pa.array(label_ids, pa.int32()),
+                "scientific_name": pa.DictionaryArray.from_arrays(
+                    indices, pa.array([n.split("_", 1)[0] for n in names], pa.string())
+                ),
+                "common_name": pa.DictionaryArray.from_arrays(
+                    indices, pa.array([n.split("_", 1)[-1] for n in names], pa.string())
+                ),
+                "confidence": pa.array(np.array(self.confidences, dtype="float32"), pa.float32()),
+                "model": constant(self.model),
+                "params": constant(json.dumps(params)),
+            }
+        )
+
+        pq.write_table(table, self.tmp_path)
+
+
+def mergeEvents(starts, ends, label_ids, scores, gap: float = 0.0):
+    """Merges the detections of each label into events.
+
+    Detections are sorted by label and start. A detection starts a new event
+    if it begins more than `gap` seconds after the latest end of the current
+    event of its label, so the overlapping segments of one call are merged.
+
+    Args:
+        starts: Start of each detection in seconds.
+        ends: End of each detection in seconds.
+        label_ids: Label index of each detection.
+        scores: Confidence of each detection.
+        gap: Largest gap in seconds between detections of one event.
+
+    Returns:
+        A tuple of (starts, ends, label_ids, max scores, mean scores, hits) of the events, sorted by start.
+    """
+    starts = np.asarray(starts, dtype="float64")
+    ends = np.asarray(ends, dtype="float64")
+    label_ids = np.asarray(label_ids, dtype="int32")
+    scores = np.asarray(scores, dtype="float64")
+
+    if len(starts) == 0:
+        return starts, ends, label_ids, scores, scores, np.zeros(0, dtype="int64")
+
+    order = np.lexsort((starts, label_ids))
+    starts, ends, label_ids, scores = starts[order], ends[order], label_ids[order], scores[order]
+
+    # Shift every label to its own time range, so one running maximum
+    # of the ends covers all labels without a Python loop
+    new_label = np.empty(len(starts), dtype=bool)
+    new_label[0] = True
+    new_label[1:] = label_ids[1:] != label_ids[:-1]
+    offsets = (np.cumsum(new_label) - 1) * (ends.max() + gap + 1)
+    latest_end = np.maximum.accumulate(ends + offsets)
+
+    new_event = new_label.copy()
+    new_event[1:] |= starts[1:] + offsets[1:] > latest_end[:-1] + gap
+    first = np.flatnonzero(new_event)
+    hits = np.diff(np.append(first, len(starts)))
+
+    events = (
+        starts[first],
+        np.maximum.reduceat(ends, first),
+        label_ids[first],
+        np.maximum.reduceat(scores, first),
+        np.add.reduceat(scores, first) / hits,
+        hits,
+    )
+    order = np.lexsort((events[2], events[0]))
+
+    return tuple(e[order] for e in events)
+
+
+class EventsWriter(ResultWriter):
+    """CSV file with one row per event, see `mergeEvents`.
+
+    Columns are start and end in seconds, species, the maximum and mean
+    confidence of the merged detections and their number.
+    """
+
+    suffix = ".BirdNET.events.csv"
+
+    def __init__(self, path: str, afile_path: str, model: str = None, gap: float = None):
+        super().__init__(path, afile_path, model)
+        self.gap = cfg.MERGE_GAP if gap is None else gap
+
+    def open(self):
+        self.label_index = {label: i for i, label in enumerate(cfg.LABELS)}
+        self.starts, self.ends, self.label_ids, self.confidences = [], [], [], []
+
+    def writeSegment(self, start, end, scores):
+        start, end = float(start), float(end)
+
+        for label, _, score in self.detections(scores):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.label_ids.append(self.label_index[label])
+            self.confidences.append(score)
+
+    def close(self):
+        starts, ends, label_ids, max_scores, mean_scores, hits = mergeEvents(
+            self.starts, self.ends, self.label_ids, self.confidences, self.gap or 0.0
+        )
+
+        with open(self.tmp_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write("Start (s),End (s),Scientific name,Common name,Confidence,Mean confidence,Hits\n")
+
+            for start, end, label_id, max_score, mean_score, num_hits in zip(
+                starts.tolist(), ends.tolist(), label_ids.tolist(), max_scores.tolist(), mean_scores.tolist(), hits.tolist()
+            ):
+                name = self.labels[cfg.LABELS[label_id]]
+                f.write(
+                    f"{start:.3f},{end:.3f},{name.split('_', 1)[0]},{name.split('_', 1)[-1]},"
+                    f"{max_score:.4f},{mean_score:.4f},{num_hits}\n"
+                )
+
+
+def writeParquetDataset(folder: str, dataset_path: str = None, rows_per_file: int = PARQUET_DATASET_ROWS_PER_FILE):
+    """Combines the Parquet result files of a folder into one dataset directory.
+
+    The per-file results are rewritten into a few large files, so a whole
+    season loads with a single vectorized read. The dataset is built next to
+    the old one and swapped in when it is complete.
+
+    Args:
+        folder: Folder with the result files, searched recursively.
+        dataset_path: Path of the dataset directory, relative to `folder`. Defaults to BirdNET.results.dataset.
+        rows_per_file: Maximum number of rows per dataset file.
+
+    Returns:
+        The number of combined result files.
+    """
+    import pyarrow.dataset as ds
+
+    dataset_path = os.path.join(folder, dataset_path or PARQUET_DATASET)
+    files = [f for f in utils.collect_all_files(folder, ["parquet"]) if ".BirdNET." in os.path.basename(f)]
+
+    if not files:
+        return 0
+
+    tmp_path = dataset_path + ".tmp"
+    old_path = dataset_path + ".old"
+
+    for path in (tmp_path, old_path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    ds.write_dataset(
+        ds.dataset(files, format="parquet"),
+        tmp_path,
+        format="parquet",
+        basename_template="part-{i}.parquet",
+        max_rows_per_file=rows_per_file,
+        min_rows_per_group=min(rows_per_file, 1024 * 1024),
+        max_rows_per_group=min(rows_per_file, 1024 * 1024),
+    )
+
+    # Swap in the new dataset
+    if os.path.isdir(dataset_path):
+        os.replace(dataset_path, old_path)
+
+    os.replace(tmp_path, dataset_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    return len(files)
+
+
+registerWriter("table", TableWriter)
+registerWriter("audacity", AudacityWriter)
+registerWriter("r", RWriter)
+registerWriter("kaleidoscope", KaleidoscopeWriter)
+registerWriter("csv", CsvWriter)
+registerWriter("parquet", ParquetWriter)
@@ -38,7 +38,7 @@ def detectRType(line: str):
         return "audacity"
 
 
-def parseFolders(apath: str, rpath: str, allowed_result_filetypes: list[str] = ["txt", "csv"]) -> list[dict]:
+def parseFolders(apath: str, rpath: str, allowed_result_filetypes: list[str] = ["txt", "csv", "parquet"]) -> list[dict]:
     """Read audio and result files.
 
     Reads all audio files and BirdNET output inside directory recursively.
@@ -140,6 +140,24 @@ def findSegments(afile: str, rfile: str):
     """
     segments: list[dict] = []
 
+    # Columnar results are filtered without parsing any text
+    if rfile.lower().endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(rfile, columns=["start", "end", "common_name", "confidence"])
+        confidence = table["confidence"].to_numpy()
+        rows = np.flatnonzero(confidence >= cfg.MIN_CONFIDENCE)
+
+        for start, end, species, c in zip(
+            table["start"].to_numpy()[rows],
+            table["end"].to_numpy()[rows],
+            table["common_name"].take(rows).to_pylist(),
+            confidence[rows],
+        ):
+            segments.append({"audio": afile, "start": float(start), "end": float(end), "species": species, "confidence": float(c)})
+
+        return segments
+
     # Open and parse result file
     lines = utils.readLines(rfile)
 
@@ -4,9 +4,9 @@ Can be used to train a custom classifier with new training data.
 """
 
 import argparse
+import hashlib
 import multiprocessing
 import os
-from functools import partial
 from multiprocessing.pool import Pool
 
 import numpy as np
@@ -23,11 +23,76 @@ import utils
 # cfg.CUSTOM_CLASSIFIER = "model/default/MODEL"
 
 
-def _loadAudioFile(f, label_vector, config):
+def _getEmbeddingsCachePath(f):
+    """Gets the path of the cached embeddings of a training file.
+
+    The cache key is the hash of the file content and every setting that
+    changes the embeddings, so renamed or moved files are still found and
+    edited files are embedded again.
+
+    Args:
+        f: Path to the audio file.
+
+    Returns:
+        The path of the cache entry.
+    """
+    h = hashlib.sha256()
+
+    with open(f, "rb") as af:
+        for block in iter(lambda: af.read(1024 * 1024), b""):
+            h.update(block)
+
+    # The overlap only matters if the file is split into segments
+    overlap = cfg.SIG_OVERLAP if cfg.SAMPLE_CROP_MODE not in ["center", "first"] else 0
+    settings = [cfg.SAMPLE_CROP_MODE, overlap, cfg.BANDPASS_FMIN, cfg.BANDPASS_FMAX, os.path.basename(cfg.MODEL_PATH)]
+    h.update(repr(settings).encode("utf-8"))
+
+    key = h.hexdigest()
+
+    return os.path.join(cfg.TRAIN_EMBEDDINGS_CACHE_PATH, key[:2], key + ".npy")
+
+
+def _saveToEmbeddingsCache(cache_path, embeddings):
+    """Saves the embeddings of a training file to the per-file cache."""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # Write to a temporary file first so a cancelled run never leaves a broken entry
+    with open(cache_path + ".tmp", "wb") as cf:
+        np.save(cf, np.array(embeddings, dtype="float32"))
+
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def _initWorker(config):
+    """Restores the config and loads the model once per worker process.
+
+    Args:
+        config: The config of the main process.
+    """
+    cfg.setConfig(config)
+    model.loadModel(False)
+
+
+def _loadTask(task):
+    """Loads a single training file in a worker.
+
+    Args:
+        task: (index, filepath, label vector, folder)
+
+    Returns:
+        A tuple of (index, folder, (x_train, y_train)).
+    """
+    index, f, label_vector, folder = task
+
+    return index, folder, _loadAudioFile(f, label_vector)
+
+
+def _loadAudioFile(f, label_vector, config=None):
     """Load an audio file and extract features.
     Args:
         f: Path to the audio file.
         label_vector: The label vector for the file.
+        config: The config to restore, not needed in workers started with _initWorker.
     Returns:
         A tuple of (x_train, y_train).
     """
@@ -36,7 +101,22 @@ def _loadAudioFile(f, label_vector, config):
     y_train = []
 
     # restore config in case we're on Windows to be thread save
-    cfg.setConfig(config)
+    if config is not None:
+        cfg.setConfig(config)
+
+    # Use the cached embeddings if the file has not changed
+    cache_path = None
+
+    if cfg.TRAIN_EMBEDDINGS_CACHE_PATH:
+        try:
+            cache_path = _getEmbeddingsCachePath(f)
+
+            if os.path.isfile(cache_path):
+                embeddings = np.load(cache_path)
+
+                return list(embeddings), [label_vector] * len(embeddings)
+        except Exception as e:
+            print(f"\t Error when reading embeddings cache for file {f}: {e}", flush=True)
 
     # Try to load the audio file
     try:
@@ -70,7 +150,8 @@ def _loadAudioFile(f, label_vector, config):
         )
 
     # Get feature embeddings
-    batch_size = 1  # turns out that batch size 1 is the fastest, probably because of having to resize the model input when the number of samples in a batch changes
+    # The model input is only resized if the batch size changes, i.e. at most for the last batch of a file
+    batch_size = max(1, cfg.BATCH_SIZE)
     for i in range(0, len(sig_splits), batch_size):
         batch_sig = sig_splits[i : i + batch_size]
         batch_label = [label_vector] * len(batch_sig)
@@ -80,6 +161,13 @@ def _loadAudioFile(f, label_vector, config):
         x_train.extend(embeddings)
         y_train.extend(batch_label)
 
+    # Save to cache
+    if cache_path:
+        try:
+            _saveToEmbeddingsCache(cache_path, x_train)
+        except Exception as e:
+            print(f"\t Error when saving embeddings cache for file {f}: {e}", flush=True)
+
     return x_train, y_train
 
 
@@ -155,9 +243,8 @@ def _loadTrainingData(cache_mode="none", cache_file="", progress_callback=None):
     if cfg.MULTI_LABEL and cfg.UPSAMPLING_RATIO > 0 and cfg.UPSAMPLING_MODE != "repeat":
         raise Exception("Only repeat-upsampling ist available for multi-label")
 
-    # Load training data
-    x_train = []
-    y_train = []
+    # Collect the files of all folders
+    tasks = []
 
     for folder in folders:
         # Get label vector
@@ -185,33 +272,28 @@ def _loadTrainingData(cache_mode="none", cache_file="", progress_callback=None):
             ),
         )
 
-        # Load files using thread pool
-        with Pool(cfg.CPU_THREADS) as p:
-            tasks = []
-            for f in files:
-                task = p.apply_async(
-                    partial(
-                        _loadAudioFile,
-                        f=f,
-                        label_vector=label_vector,
-                        config=cfg.getConfig(),
-                    )
-                )
-                tasks.append(task)
-
-            # Wait for tasks to complete and monitor progress with tqdm
-            num_files_processed = 0
-            with tqdm.tqdm(
-                total=len(tasks), desc=f" - loading '{folder}'", unit="f"
-            ) as progress_bar:
-                for task in tasks:
-                    result = task.get()
-                    x_train += result[0]
-                    y_train += result[1]
-                    num_files_processed += 1
-                    progress_bar.update(1)
-                    if progress_callback:
-                        progress_callback(num_files_processed, len(tasks), folder)
+        tasks.extend((index, f, label_vector, folder) for index, f in enumerate(files, start=len(tasks)))
+
+    # Largest files first, so no worker is left with a long file at the end
+    work_list = sorted(tasks, key=lambda t: os.path.getsize(t[1]), reverse=True)
+    results = [None] * len(tasks)
+
+    # Load files using one pool for all folders, every worker loads the model once
+    with Pool(cfg.CPU_THREADS, initializer=_initWorker, initargs=(cfg.getConfig(),)) as p:
+        num_files_processed = 0
+        with tqdm.tqdm(
+            total=len(tasks), desc=" - loading training data", unit="f"
+        ) as progress_bar:
+            for index, folder, result in p.imap_unordered(_loadTask, work_list):
+                results[index] = result
+                num_files_processed += 1
+                progress_bar.update(1)
+                if progress_callback:
+                    progress_callback(num_files_processed, len(tasks), folder)
+
+    # Keep the order of folders and files
+    x_train = [x for result in results for x in result[0]]
+    y_train = [y for result in results for y in result[1]]
 
     # Convert to numpy arrays
     x_train = np.array(x_train, dtype="float32")
@@ -250,7 +332,16 @@ def trainModel(on_epoch_end=None, on_trial_result=None, on_data_load_end=None):
         flush=True,
     )
 
-    if cfg.AUTOTUNE:
+    if cfg.AUTOTUNE and cfg.AUTOTUNE_PROCESSES > 1:
+        import autotune
+
+        # Call callback to initialize progress bar
+        if on_trial_result:
+            on_trial_result(0)
+
+        best_params = autotune.runAutotune(x_train, y_train, cfg.AUTOTUNE_PROCESSES, on_trial_result)
+
+    elif cfg.AUTOTUNE:
         import gc
 
         import keras
@@ -388,6 +479,8 @@ def trainModel(on_epoch_end=None, on_trial_result=None, on_data_load_end=None):
         )
         tuner.search()
         best_params = tuner.get_best_hyperparameters()[0]
+
+    if cfg.AUTOTUNE:
         print("Best params: ")
         print("hidden_units: ", best_params["hidden_units"])
         print("dropout: ", best_params["dropout"])
@@ -406,16 +499,24 @@ def trainModel(on_epoch_end=None, on_trial_result=None, on_data_load_end=None):
         cfg.TRAIN_WITH_MIXUP = best_params["mixup"]
         cfg.TRAIN_WITH_LABEL_SMOOTHING = best_params["label_smoothing"]
 
+    # NumPy classifiers are trained and saved without TensorFlow
+    if cfg.TRAINED_MODEL_OUTPUT_FORMAT == "numpy":
+        import linear_classifier
+
+        build_fn, train_fn = linear_classifier.buildClassifier, linear_classifier.trainClassifier
+    else:
+        build_fn, train_fn = model.buildLinearClassifier, model.trainLinearClassifier
+
     # Build model
     print("Building model...", flush=True)
-    classifier = model.buildLinearClassifier(
+    classifier = build_fn(
         y_train.shape[1], x_train.shape[1], cfg.TRAIN_HIDDEN_UNITS, cfg.TRAIN_DROPOUT
     )
     print("...Done.", flush=True)
 
     # Train model
     print("Training model...", flush=True)
-    classifier, history = model.trainLinearClassifier(
+    classifier, history = train_fn(
         classifier,
         x_train,
         y_train,
@@ -449,6 +550,10 @@ def trainModel(on_epoch_end=None, on_trial_result=None, on_data_load_end=None):
         )
     elif cfg.TRAINED_MODEL_OUTPUT_FORMAT == "raven":
         model.save_raven_model(classifier, cfg.CUSTOM_CLASSIFIER, labels)
+    elif cfg.TRAINED_MODEL_OUTPUT_FORMAT == "numpy":
+        linear_classifier.saveClassifier(
+            classifier, cfg.CUSTOM_CLASSIFIER, labels, mode=cfg.TRAINED_MODEL_SAVE_MODE
+        )
     else:
         raise ValueError(
             f"Unknown model output format: {cfg.TRAINED_MODEL_OUTPUT_FORMAT}"
@@ -538,7 +643,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model_format",
         default="tflite",
-        help="Model output format. Can be 'tflite', 'raven' or 'both'. Defaults to 'tflite'.",
+        help="Model output format. Can be 'tflite', 'raven', 'both' or 'numpy'. 'numpy' trains and saves the classifier without TensorFlow. Defaults to 'tflite'.",
     )
     parser.add_argument(
         "--model_save_mode",
@@ -555,6 +660,19 @@ if __name__ == "__main__":
         default="train_cache.npz",
         help="Path to cache file. Defaults to 'train_cache.npz'.",
     )
+    parser.add_argument(
+        "--batchsize",
+        type=int,
+        default=8,
+        help="Number of segments of a file to embed at the same time. Defaults to 8.",
+    )
+    parser.add_argument(
+        "--embeddings_cache",
+        default=cfg.TRAIN_EMBEDDINGS_CACHE_PATH,
+        help="Folder for the per-file embeddings cache, only new or changed files are embedded. Set to '' to disable. Defaults to '{}'.".format(
+            cfg.TRAIN_EMBEDDINGS_CACHE_PATH
+        ),
+    )
     parser.add_argument(
         "--threads",
         type=int,
@@ -590,6 +708,12 @@ if __name__ == "__main__":
         default=50,
         help="Number of training runs for hyperparameter tuning. Defaults to 50.",
     )
+    parser.add_argument(
+        "--autotune_processes",
+        type=int,
+        default=1,
+        help="Number of hyperparameter tuning runs to execute in parallel. If >1, trials are drawn at random and poor trials are stopped early. Defaults to 1.",
+    )
     parser.add_argument(
         "--autotune_executions_per_trial",
         type=int,
@@ -620,8 +744,10 @@ if __name__ == "__main__":
     cfg.TRAINED_MODEL_SAVE_MODE = args.model_save_mode
     cfg.TRAIN_CACHE_MODE = args.cache_mode.lower()
     cfg.TRAIN_CACHE_FILE = args.cache_file
+    cfg.TRAIN_EMBEDDINGS_CACHE_PATH = args.embeddings_cache
     cfg.TFLITE_THREADS = 1
     cfg.CPU_THREADS = max(1, int(args.threads))
+    cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
     cfg.BANDPASS_FMIN = max(0, min(cfg.SIG_FMAX, int(args.fmin)))
     cfg.BANDPASS_FMAX = max(cfg.SIG_FMIN, min(cfg.SIG_FMAX, int(args.fmax)))
@@ -629,6 +755,7 @@ if __name__ == "__main__":
     cfg.AUTOTUNE = True
     cfg.AUTOTUNE_TRIALS = args.autotune_trials
     cfg.AUTOTUNE_EXECUTIONS_PER_TRIAL = args.autotune_executions_per_trial
+    cfg.AUTOTUNE_PROCESSES = max(1, args.autotune_processes)
 
     # Train model
     print("-----EPOCHS------", cfg.TRAIN_EPOCHS)
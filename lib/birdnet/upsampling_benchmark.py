@@ -0,0 +1,278 @@
+"""Module to benchmark utils.upsampling against the previous loop implementation.
+
+Both versions create the same number of new samples per class from a
+synthetic dataset of random embeddings, so only the run times differ.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import config as cfg
+import utils
+
+
+def upsamplingLoop(x, y, ratio=0.5, mode="repeat"):
+    """Previous implementation of utils.upsampling, one new sample per loop iteration.
+
+    We upsample minority classes to have at least 10% (ratio=0.1) of the samples of the majority class.
+
+    Args:
+        x: Samples.
+        y: One-hot labels.
+        ratio: The minimum ratio of minority to majority samples.
+        mode: The upsampling mode. Either 'repeat', 'mean', 'linear' or 'smote'.
+
+    Returns:
+        Upsampled data.
+    """
+
+    # Set numpy random seed
+    np.random.seed(cfg.RANDOM_SEED)
+
+    # Determine min number of samples
+    if cfg.BINARY_CLASSIFICATION:
+        min_samples = int(max(y.sum(axis=0), len(y) - y.sum(axis=0)) * ratio)
+    else:
+        min_samples = int(np.max(y.sum(axis=0)) * ratio)
+
+    x_temp = []
+    y_temp = []
+    if mode == "repeat":
+        if cfg.BINARY_CLASSIFICATION:
+            # Determine if 1 or 0 is the minority class
+            if y.sum(axis=0) < len(y) - y.sum(axis=0):
+                minority_label = 1
+            else:
+                minority_label = 0
+            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
+                # Randomly choose a sample from the minority class
+                random_index = np.random.choice(np.where(y == minority_label)[0])
+
+                # Append the sample and label to a temp list
+                x_temp.append(x[random_index])
+                y_temp.append(y[random_index])
+        else:
+            # For each class with less than min_samples ranomdly repeat samples
+            for i in range(y.shape[1]):
+                while y[:, i].sum() + len(y_temp) < min_samples:
+                    # Randomly choose a sample from the minority class
+                    random_index = np.random.choice(np.where(y[:, i] == 1)[0])
+
+                    # Append the sample and label to a temp list
+                    x_temp.append(x[random_index])
+                    y_temp.append(y[random_index])
+
+    elif mode == "mean":
+        # For each class with less than min_samples
+        # select two random samples and calculate the mean
+        def applyMean(x, y, random_indices):
+            # Calculate the mean of the two samples
+            mean = np.mean(x[random_indices], axis=0)
+
+            # Append the mean and label to a temp list
+            x_temp.append(mean)
+            y_temp.append(y[random_indices[0]])
+
+        if cfg.BINARY_CLASSIFICATION:
+            # Determine if 1 or 0 is the minority class
+            if y.sum(axis=0) < len(y) - y.sum(axis=0):
+                minority_label = 1
+            else:
+                minority_label = 0
+            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
+                # Randomly choose two samples from the minority class
+                random_indices = np.random.choice(np.where(y == minority_label)[0], 2)
+
+                # Calculate the mean of the two samples
+                applyMean(x, y, random_indices)
+
+        else:
+            for i in range(y.shape[1]):
+                while y[:, i].sum() + len(y_temp) < min_samples:
+                    # Randomly choose two samples from the minority class
+                    random_indices = np.random.choice(np.where(y[:, i] == 1)[0], 2)
+
+                    # Calculate the mean of the two samples
+                    applyMean(x, y, random_indices)
+
+    elif mode == "linear":
+        # For each class with less than min_samples
+        # select two random samples and calculate the linear combination
+        def applyLinearCombination(x, y, random_indices):
+            # Calculate the linear combination of the two samples
+            alpha = np.random.uniform(0, 1)
+            new_sample = alpha * x[random_indices[0]] + (1 - alpha) * x[random_indices[1]]
+
+            # Append the new sample and label to a temp list
+            x_temp.append(new_sample)
+            y_temp.append(y[random_indices[0]])
+
+        if cfg.BINARY_CLASSIFICATION:
+            # Determine if 1 or 0 is the minority class
+            if y.sum(axis=0) < len(y) - y.sum(axis=0):
+                minority_label = 1
+            else:
+                minority_label = 0
+            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
+
+                # Randomly choose two samples from the minority class
+                random_indices = np.random.choice(np.where(y == minority_label)[0], 2)
+
+                # Apply linear combination
+                applyLinearCombination(x, y, random_indices)
+
+        else:
+            for i in range(y.shape[1]):
+                while y[:, i].sum() + len(y_temp) < min_samples:
+                    # Randomly choose two samples from the minority class
+                    random_indices = np.random.choice(np.where(y[:, i] == 1)[0], 2)
+
+                    # Apply linear combination
+                    applyLinearCombination(x, y, random_indices)
+
+    elif mode == "smote":
+        # For each class with less than min_samples apply SMOTE
+        def applySmote(x, y, random_index, k=5):
+
+            # Get the k nearest neighbors
+            distances = np.sqrt(np.sum((x - x[random_index]) ** 2, axis=1))
+            indices = np.argsort(distances)[1 : k + 1]
+
+            # Randomly choose one of the neighbors
+            random_neighbor = np.random.choice(indices)
+
+            # Calculate the difference vector
+            diff = x[random_neighbor] - x[random_index]
+
+            # Randomly choose a weight between 0 and 1
+            weight = np.random.uniform(0, 1)
+
+            # Calculate the new sample
+            new_sample = x[random_index] + weight * diff
+
+            # Append the new sample and label to a temp list
+            x_temp.append(new_sample)
+            y_temp.append(y[random_index])
+
+        if cfg.BINARY_CLASSIFICATION:
+            # Determine if 1 or 0 is the minority class
+            if y.sum(axis=0) < len(y) - y.sum(axis=0):
+                minority_label = 1
+            else:
+                minority_label = 0
+            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
+                # Randomly choose a sample from the minority class
+                random_index = np.random.choice(np.where(y == minority_label)[0])
+
+                # Apply SMOTE
+                applySmote(x, y, random_index)
+
+        else:
+            for i in range(y.shape[1]):
+                while y[:, i].sum() + len(y_temp) < min_samples:
+                    # Randomly choose a sample from the minority class
+                    random_index = np.random.choice(np.where(y[:, i] == 1)[0])
+
+                    # Apply SMOTE
+                    applySmote(x, y, random_index)
+
+    # Append the temp list to the original data
+    if len(x_temp) > 0:
+        x = np.vstack((x, np.array(x_temp)))
+        y = np.vstack((y, np.array(y_temp)))
+
+    # Shuffle data
+    indices = np.arange(len(x))
+    np.random.shuffle(indices)
+    x = x[indices]
+    y = y[indices]
+
+    del x_temp
+    del y_temp
+
+    return x, y
+
+
+def makeDataset(num_samples: int = 20000, num_minority: int = 2500, num_classes: int = 4, dim: int = 1024):
+    """Creates random embeddings with one majority class and several minority classes.
+
+    Args:
+        num_samples: Number of samples of the majority class.
+        num_minority: Number of samples of the smallest minority class, the others get 2x, 3x, ...
+        num_classes: Number of classes.
+        dim: Dimension of the embeddings.
+
+    Returns:
+        A tuple of (samples, one-hot labels).
+    """
+    counts = [num_samples] + [num_minority * (i + 1) for i in range(num_classes - 1)]
+    labels = np.repeat(np.arange(num_classes), counts)
+    x = np.random.RandomState(0).normal(size=(len(labels), dim)).astype("float32")
+
+    return x, np.eye(num_classes, dtype="float32")[labels]
+
+
+def benchmark(x, y, modes: list[str], ratio: float = 0.5):
+    """Times both implementations for each upsampling mode.
+
+    Args:
+        x: Samples.
+        y: One-hot labels.
+        modes: The upsampling modes.
+        ratio: The minimum ratio of minority to majority samples.
+
+    Returns:
+        A dictionary with {mode: (new samples, loop seconds, vectorized seconds)}.
+    """
+    results = {}
+
+    for mode in modes:
+        start_time = time.perf_counter()
+        loop_size = len(upsamplingLoop(x, y, ratio, mode)[0])
+        loop_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        size = len(utils.upsampling(x, y, ratio, mode)[0])
+        vectorized_time = time.perf_counter() - start_time
+
+        if size != loop_size:
+            raise RuntimeError(f"Mode {mode} created {size - len(x)} samples, the loop {loop_size - len(x)}")
+
+        results[mode] = (size - len(x), loop_time, vectorized_time)
+
+    return results
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized upsampling against the loop implementation")
+    parser.add_argument("--samples", type=int, default=20000, help="Samples of the majority class. Defaults to 20000.")
+    parser.add_argument(
+        "--minority", type=int, default=2500, help="Samples of the smallest minority class. Defaults to 2500."
+    )
+    parser.add_argument("--classes", type=int, default=4, help="Number of classes. Defaults to 4.")
+    parser.add_argument("--dim", type=int, default=1024, help="Dimension of the embeddings. Defaults to 1024.")
+    parser.add_argument(
+        "--smote_samples",
+        type=int,
+        default=5000,
+        help="Samples of the majority class for SMOTE, which is slow in the loop implementation. Defaults to 5000.",
+    )
+
+    args = parser.parse_args()
+
+    runs = [
+        (makeDataset(args.samples, args.minority, args.classes, args.dim), ["repeat", "mean", "linear"]),
+        (makeDataset(args.smote_samples, args.smote_samples // 5, 2, args.dim), ["smote"]),
+    ]
+
+    for (x, y), modes in runs:
+        for mode, (num_new, loop_time, vectorized_time) in benchmark(x, y, modes).items():
+            print(
+                f"{mode}: {num_new} new samples from {len(x)}, loop {loop_time:.2f}s, "
+                f"vectorized {vectorized_time:.2f}s ({loop_time / vectorized_time:.0f}x)"
+            )
+
+    # python3 upsampling_benchmark.py --samples 20000 --smote_samples 5000
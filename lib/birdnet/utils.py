@@ -2,7 +2,9 @@
 """
 
 import os
+import struct
 import traceback
+import zipfile
 from pathlib import Path
 
 import numpy as np
@@ -310,6 +312,41 @@ def label_smoothing(y, alpha=0.1):
     return y
 
 
+def nearestNeighbors(x, k=5, block_size=1024):
+    """Finds the k nearest neighbors of every sample.
+
+    Squared euclidean distances are computed block by block, so memory use
+    is limited to `block_size` rows of the distance matrix.
+
+    Args:
+        x: Samples.
+        k: Number of neighbors.
+        block_size: Number of samples per distance matrix block.
+
+    Returns:
+        The indices of the neighbors of shape (samples, k), unsorted.
+        Samples without neighbors are their own neighbor.
+    """
+    k = min(k, len(x) - 1)
+
+    if k < 1:
+        return np.arange(len(x))[:, np.newaxis]
+
+    squared_norms = np.einsum("ij,ij->i", x, x)
+    neighbors = np.empty((len(x), k), dtype="int64")
+
+    for start in range(0, len(x), block_size):
+        block = x[start : start + block_size]
+        rows = np.arange(len(block))
+        distances = squared_norms[start : start + block_size, np.newaxis] + squared_norms - 2 * block @ x.T
+
+        # A sample is not its own neighbor
+        distances[rows, start + rows] = np.inf
+        neighbors[start : start + len(block)] = np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+    return neighbors
+
+
 def upsampling(x, y, ratio=0.5, mode="repeat"):
     """Balance data through upsampling.
 
@@ -334,151 +371,71 @@ def upsampling(x, y, ratio=0.5, mode="repeat"):
     else:
         min_samples = int(np.max(y.sum(axis=0)) * ratio)
 
-    x_temp = []
-    y_temp = []
-    if mode == "repeat":
-        if cfg.BINARY_CLASSIFICATION:
-            # Determine if 1 or 0 is the minority class
-            if y.sum(axis=0) < len(y) - y.sum(axis=0):
-                minority_label = 1
-            else:
-                minority_label = 0
-            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
-                # Randomly choose a sample from the minority class
-                random_index = np.random.choice(np.where(y == minority_label)[0])
-
-                # Append the sample and label to a temp list
-                x_temp.append(x[random_index])
-                y_temp.append(y[random_index])
-        else:
-            # For each class with less than min_samples ranomdly repeat samples
-            for i in range(y.shape[1]):
-                while y[:, i].sum() + len(y_temp) < min_samples:
-                    # Randomly choose a sample from the minority class
-                    random_index = np.random.choice(np.where(y[:, i] == 1)[0])
-
-                    # Append the sample and label to a temp list
-                    x_temp.append(x[random_index])
-                    y_temp.append(y[random_index])
-
-    elif mode == "mean":
-        # For each class with less than min_samples
-        # select two random samples and calculate the mean
-        def applyMean(x, y, random_indices):
-            # Calculate the mean of the two samples
-            mean = np.mean(x[random_indices], axis=0)
-
-            # Append the mean and label to a temp list
-            x_temp.append(mean)
-            y_temp.append(y[random_indices[0]])
-
-        if cfg.BINARY_CLASSIFICATION:
-            # Determine if 1 or 0 is the minority class
-            if y.sum(axis=0) < len(y) - y.sum(axis=0):
-                minority_label = 1
-            else:
-                minority_label = 0
-            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
-                # Randomly choose two samples from the minority class
-                random_indices = np.random.choice(np.where(y == minority_label)[0], 2)
-
-                # Calculate the mean of the two samples
-                applyMean(x, y, random_indices)
-
-        else:
-            for i in range(y.shape[1]):
-                while y[:, i].sum() + len(y_temp) < min_samples:
-                    # Randomly choose two samples from the minority class
-                    random_indices = np.random.choice(np.where(y[:, i] == 1)[0], 2)
-
-                    # Calculate the mean of the two samples
-                    applyMean(x, y, random_indices)
-
-    elif mode == "linear":
-        # For each class with less than min_samples
-        # select two random samples and calculate the linear combination
-        def applyLinearCombination(x, y, random_indices):
-            # Calculate the linear combination of the two samples
-            alpha = np.random.uniform(0, 1)
-            new_sample = alpha * x[random_indices[0]] + (1 - alpha) * x[random_indices[1]]
-
-            # Append the new sample and label to a temp list
-            x_temp.append(new_sample)
-            y_temp.append(y[random_indices[0]])
-
-        if cfg.BINARY_CLASSIFICATION:
-            # Determine if 1 or 0 is the minority class
-            if y.sum(axis=0) < len(y) - y.sum(axis=0):
-                minority_label = 1
-            else:
-                minority_label = 0
-            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
-
-                # Randomly choose two samples from the minority class
-                random_indices = np.random.choice(np.where(y == minority_label)[0], 2)
-
-                # Apply linear combination
-                applyLinearCombination(x, y, random_indices)
-
+    # Get the samples of each class that needs upsampling
+    if cfg.BINARY_CLASSIFICATION:
+        # Determine if 1 or 0 is the minority class
+        if y.sum(axis=0) < len(y) - y.sum(axis=0):
+            minority_label = 1
         else:
-            for i in range(y.shape[1]):
-                while y[:, i].sum() + len(y_temp) < min_samples:
-                    # Randomly choose two samples from the minority class
-                    random_indices = np.random.choice(np.where(y[:, i] == 1)[0], 2)
+            minority_label = 0
 
-                    # Apply linear combination
-                    applyLinearCombination(x, y, random_indices)
+        class_indices = [np.where(y == minority_label)[0]]
+        class_counts = [len(class_indices[0])]
+    else:
+        class_indices = [np.where(y[:, i] == 1)[0] for i in range(y.shape[1])]
+        class_counts = [y[:, i].sum() for i in range(y.shape[1])]
 
-    elif mode == "smote":
-        # For each class with less than min_samples apply SMOTE
-        def applySmote(x, y, random_index, k=5):
+    x_temp = []
+    y_temp = []
+    num_upsampled = 0
 
-            # Get the k nearest neighbors
-            distances = np.sqrt(np.sum((x - x[random_index]) ** 2, axis=1))
-            indices = np.argsort(distances)[1 : k + 1]
+    for indices, count in zip(class_indices, class_counts):
+        # Number of new samples, new samples of previous classes count as well
+        num_new = int(max(0, np.ceil(min_samples - count - num_upsampled)))
 
-            # Randomly choose one of the neighbors
-            random_neighbor = np.random.choice(indices)
+        if num_new == 0 or len(indices) == 0:
+            continue
 
-            # Calculate the difference vector
-            diff = x[random_neighbor] - x[random_index]
+        num_upsampled += num_new
 
-            # Randomly choose a weight between 0 and 1
-            weight = np.random.uniform(0, 1)
+        if mode == "repeat":
+            # Randomly repeat samples of the class
+            source_indices = np.random.choice(indices, num_new)
+            new_samples = x[source_indices]
 
-            # Calculate the new sample
-            new_sample = x[random_index] + weight * diff
+        elif mode == "mean":
+            # Mean of two random samples of the class
+            pairs = np.random.choice(indices, (num_new, 2))
+            source_indices = pairs[:, 0]
+            new_samples = np.mean(x[pairs], axis=1)
 
-            # Append the new sample and label to a temp list
-            x_temp.append(new_sample)
-            y_temp.append(y[random_index])
+        elif mode == "linear":
+            # Random linear combination of two samples of the class
+            pairs = np.random.choice(indices, (num_new, 2))
+            source_indices = pairs[:, 0]
+            alpha = np.random.uniform(0, 1, (num_new, 1))
+            new_samples = alpha * x[pairs[:, 0]] + (1 - alpha) * x[pairs[:, 1]]
 
-        if cfg.BINARY_CLASSIFICATION:
-            # Determine if 1 or 0 is the minority class
-            if y.sum(axis=0) < len(y) - y.sum(axis=0):
-                minority_label = 1
-            else:
-                minority_label = 0
-            while np.where(y == minority_label)[0].shape[0] + len(y_temp) < min_samples:
-                # Randomly choose a sample from the minority class
-                random_index = np.random.choice(np.where(y == minority_label)[0])
+        elif mode == "smote":
+            # Move random samples towards one of their k nearest neighbors within the class
+            neighbors = nearestNeighbors(x[indices], k=5)
+            base = np.random.randint(len(indices), size=num_new)
+            neighbor = neighbors[base, np.random.randint(neighbors.shape[1], size=num_new)]
+            weight = np.random.uniform(0, 1, (num_new, 1))
 
-                # Apply SMOTE
-                applySmote(x, y, random_index)
+            source_indices = indices[base]
+            new_samples = x[source_indices] + weight * (x[indices[neighbor]] - x[source_indices])
 
         else:
-            for i in range(y.shape[1]):
-                while y[:, i].sum() + len(y_temp) < min_samples:
-                    # Randomly choose a sample from the minority class
-                    random_index = np.random.choice(np.where(y[:, i] == 1)[0])
+            continue
 
-                    # Apply SMOTE
-                    applySmote(x, y, random_index)
+        x_temp.append(new_samples)
+        y_temp.append(y[source_indices])
 
     # Append the temp list to the original data
     if len(x_temp) > 0:
-        x = np.vstack((x, np.array(x_temp)))
-        y = np.vstack((y, np.array(y_temp)))
+        x = np.vstack((x, *x_temp))
+        y = np.vstack((y, *y_temp))
 
     # Shuffle data
     indices = np.arange(len(x))
@@ -492,32 +449,152 @@ def upsampling(x, y, ratio=0.5, mode="repeat"):
     return x, y
 
 
+def prepareTrainingData(
+    x_train,
+    y_train,
+    val_split,
+    upsampling_ratio,
+    upsampling_mode,
+    train_with_mixup,
+    train_with_label_smoothing,
+):
+    """Shuffles, splits and augments the training data.
+
+    The result only depends on the data, the arguments and the random seed,
+    so it can be reused by trainings with the same augmentation settings.
+
+    Args:
+        x_train: Samples.
+        y_train: Labels.
+        val_split: Ratio of the validation data.
+        upsampling_ratio: Balance train data and upsample minority classes.
+        upsampling_mode: The upsampling mode.
+        train_with_mixup: Whether to apply mixup.
+        train_with_label_smoothing: Whether to apply label smoothing.
+
+    Returns:
+        A tuple of (x_train, y_train, x_val, y_val).
+    """
+    # Set random seed
+    np.random.seed(cfg.RANDOM_SEED)
+
+    # Shuffle data
+    idx = np.arange(x_train.shape[0])
+    np.random.shuffle(idx)
+    x_train = x_train[idx]
+    y_train = y_train[idx]
+
+    # Random val split
+    if not cfg.MULTI_LABEL:
+        x_train, y_train, x_val, y_val = random_split(x_train, y_train, val_split)
+    else:
+        x_train, y_train, x_val, y_val = random_multilabel_split(
+            x_train, y_train, val_split
+        )
+
+    print(
+        f"Training on {x_train.shape[0]} samples, validating on {x_val.shape[0]} samples.",
+        flush=True,
+    )
+
+    # Upsample training data
+    if upsampling_ratio > 0:
+        x_train, y_train = upsampling(
+            x_train, y_train, upsampling_ratio, upsampling_mode
+        )
+        print(f"Upsampled training data to {x_train.shape[0]} samples.", flush=True)
+
+    # Apply mixup to training data
+    if train_with_mixup and not cfg.BINARY_CLASSIFICATION:
+        x_train, y_train = mixup(x_train, y_train)
+
+    # Apply label smoothing
+    if train_with_label_smoothing and not cfg.BINARY_CLASSIFICATION:
+        y_train = label_smoothing(y_train)
+
+    return x_train, y_train, x_val, y_val
+
+
 def saveToCache(cache_file: str, x_train: np.ndarray, y_train: np.ndarray, labels: list[str]):
     """Saves the training data to a cache file.
 
+    The arrays are stored uncompressed, so they can be memory-mapped when loading.
+
     Args:
         cache_file: The path to the cache file.
         x_train: The training samples.
         y_train: The training labels.
         labels: The list of labels.
     """
+    # Append .npz if necessary, like np.savez does
+    if not cache_file.endswith(".npz"):
+        cache_file += ".npz"
+
     # Create cache directory
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-
-    # Save to cache
-    np.savez_compressed(
-        cache_file,
-        x_train=x_train,
-        y_train=y_train,
-        labels=labels,
-        binary_classification=cfg.BINARY_CLASSIFICATION,
-        multi_label=cfg.MULTI_LABEL,
-    )
+    if os.path.dirname(cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+    # Save to cache, labels are stored as strings so no pickling is needed
+    with open(cache_file + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            x_train=np.ascontiguousarray(x_train, dtype="float32"),
+            y_train=np.ascontiguousarray(y_train, dtype="float32"),
+            labels=np.array(labels, dtype=str),
+            binary_classification=cfg.BINARY_CLASSIFICATION,
+            multi_label=cfg.MULTI_LABEL,
+        )
+
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+def _mapCachedArray(cache_file: str, zf: zipfile.ZipFile, name: str):
+    """Memory-maps an uncompressed array of a .npz file.
+
+    Args:
+        cache_file: The path to the cache file.
+        zf: The opened cache file.
+        name: The name of the array.
+
+    Returns:
+        The read-only memory map or None if the array cannot be mapped.
+    """
+    info = zf.getinfo(name + ".npy")
+
+    # Caches of older versions are compressed
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(cache_file, "rb") as f:
+        # Skip the local file header of the zip entry
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+
+        # Read the .npy header
+        version = np.lib.format.read_magic(f)
+
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return None
+
+        offset = f.tell()
+
+    if dtype.hasobject or 0 in shape:
+        return None
+
+    return np.memmap(cache_file, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
 
 
 def loadFromCache(cache_file: str):
     """Loads the training data from a cache file.
 
+    x_train and y_train are memory-mapped, so opening even large caches is
+    instant and only the rows that are used get read from disk.
+
     Args:
         cache_file: The path to the cache file.
 
@@ -526,14 +603,15 @@ def loadFromCache(cache_file: str):
 
     """
     # Load from cache
-    cache = np.load(cache_file, allow_pickle=True)
-
-    # Get data
-    x_train = cache["x_train"]
-    y_train = cache["y_train"]
-    labels = cache["labels"]
-    binary_classification = bool(cache["binary_classification"]) if "binary_classification" in cache.keys() else False
-    multi_label = bool(cache["multi_label"]) if "multi_label" in cache.keys() else False
+    with np.load(cache_file, allow_pickle=False) as cache, zipfile.ZipFile(cache_file) as zf:
+        # Get data
+        x_train = _mapCachedArray(cache_file, zf, "x_train")
+        y_train = _mapCachedArray(cache_file, zf, "y_train")
+        x_train = cache["x_train"] if x_train is None else x_train
+        y_train = cache["y_train"] if y_train is None else y_train
+        labels = cache["labels"]
+        binary_classification = bool(cache["binary_classification"]) if "binary_classification" in cache.keys() else False
+        multi_label = bool(cache["multi_label"]) if "multi_label" in cache.keys() else False
 
     return x_train, y_train, labels, binary_classification, multi_label
 
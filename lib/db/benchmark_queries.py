@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+検出結果のページ取得のベンチマーク
+合成データのデータベースを作成し、キーセット・ページネーション (query_detections) と
+OFFSET によるページ取得の時間を、ページの深さごとに比較する
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# プロジェクトのlibディレクトリをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from db.simple_database import BirdNetSimpleDB, DETECTION_ORDERS, Detection
+
+
+def create_synthetic_database(db_path: str, num_detections: int = 2000000, num_sessions: int = 20,
+                              num_species: int = 300, detections_per_file: int = 500, seed: int = 0) -> BirdNetSimpleDB:
+    """ランダムな検出結果のデータベースを作成（既存のファイルは上書き）
+    
+    1ファイルは1時間の録音とし、検出は3秒ごとの区間に置く。
+    信頼度は実際の結果と同じく低い値ほど多くなるように分布させる。
+    """
+    db_path = Path(db_path)
+    
+    if db_path.exists():
+        db_path.unlink()
+    
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    db = BirdNetSimpleDB(str(db_path))
+    rng = random.Random(seed)
+    species = [(f"Genus{i:03d} species{i:03d}", f"Bird {i:03d}") for i in range(num_species)]
+    recording_start = datetime(2024, 4, 1)
+    created_at = datetime.now().isoformat()
+    
+    def records():
+        for i in range(num_detections):
+            file_index, position = divmod(i, detections_per_file)
+            session_name = f"Site{file_index % num_sessions:02d}_audio_analysis_20240401"
+            filename = f"{recording_start + timedelta(hours=file_index):%Y%m%d_%H%M%S}.BirdNET.results.csv"
+            start = float(position * 3 % 3600)
+            scientific_name, common_name = species[(int(rng.paretovariate(1.2)) - 1) % num_species]
+            detection_time = recording_start + timedelta(hours=file_index, seconds=start)
+            
+            yield (session_name, 'BirdNET', 'default', filename, f"/data/{session_name}/{filename}",
+                   start, start + 3.0, scientific_name, common_name, round(1 - rng.random() ** 0.3, 4),
+                   f"Site{file_index % num_sessions:02d}", None, '20240401', created_at,
+                   detection_time.isoformat(sep=' ', timespec='milliseconds'))
+    
+    with sqlite3.connect(db.db_path) as conn:
+        conn.executemany("""
+            INSERT INTO bird_detections (
+                session_name, model_name, model_type, filename, file_path,
+                start_time_seconds, end_time_seconds, scientific_name, common_name, confidence,
+                location, species, analysis_date, created_at, detection_time_utc
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, records())
+        
+        # 集計テーブルも作っておく（次に開いたときに作り直さないように）
+        db._rebuild_activity_rollup(conn)
+        conn.commit()
+        conn.execute("ANALYZE")
+    
+    return db
+
+
+def _offset_page(db: BirdNetSimpleDB, filters: dict, order: str, offset: int, limit: int) -> list:
+    """OFFSETでページを取得（比較用、query_detections と同じ条件・並び順）"""
+    key_columns, direction = DETECTION_ORDERS[order]
+    conditions = [f"{column} = ?" for column in ('session_name', 'scientific_name') if filters.get(column) is not None]
+    params = [filters[column] for column in ('session_name', 'scientific_name') if filters.get(column) is not None]
+    
+    if filters.get('min_confidence') is not None:
+        conditions.append("confidence >= ?")
+        params.append(filters['min_confidence'])
+    
+    if order == 'time':
+        conditions.append("detection_time_utc IS NOT NULL")
+    
+    query = f"""
+        SELECT {', '.join(Detection._fields)}
+        FROM bird_detections
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY {', '.join(f"{column} {direction}" for column in key_columns)}
+        LIMIT ? OFFSET ?
+    """
+    
+    with sqlite3.connect(db.db_path) as conn:
+        return conn.execute(query, (*params, limit, offset)).fetchall()
+
+
+def benchmark_pages(db: BirdNetSimpleDB, filters: dict, order: str = 'confidence', page_size: int = 5000,
+                    depths: list = None) -> tuple:
+    """全ページをキーセットで読み、指定した深さのページをOFFSETでも読んで時間を比較
+    
+    Returns:
+        ([{'page': ページ番号, 'keyset_ms': ミリ秒, 'offset_ms': ミリ秒}, ...], 全件数, 全ページの秒数)
+    """
+    depths = set(depths or [])
+    timings = []
+    cursor = None
+    page = 0
+    total_rows = 0
+    total_start = time.perf_counter()
+    
+    while True:
+        start = time.perf_counter()
+        rows, next_cursor = db.query_detections(order=order, after=cursor, limit=page_size, **filters)
+        keyset_ms = (time.perf_counter() - start) * 1000
+        
+        if page in depths:
+            start = time.perf_counter()
+            offset_rows = _offset_page(db, filters, order, page * page_size, page_size)
+            offset_ms = (time.perf_counter() - start) * 1000
+            
+            # 両方の方法で同じページが返ることを確認
+            if [row.id for row in rows] != [row[0] for row in offset_rows]:
+                raise RuntimeError(f"ページ {page} の内容がOFFSETの結果と一致しません")
+            
+            timings.append({'page': page, 'keyset_ms': keyset_ms, 'offset_ms': offset_ms})
+        
+        total_rows += len(rows)
+        page += 1
+        
+        if next_cursor is None:
+            break
+        
+        cursor = next_cursor
+    
+    return timings, total_rows, time.perf_counter() - total_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='検出結果のページ取得のベンチマーク（キーセットとOFFSETの比較）')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'birdnet_benchmark_queries.db'),
+                        help='合成データのデータベース（既定: 一時フォルダの birdnet_benchmark_queries.db）')
+    parser.add_argument('--detections', type=int, default=2000000, help='検出の件数（既定: 2000000）')
+    parser.add_argument('--reuse', action='store_true', help='既存の合成データベースを使う（作り直さない）')
+    parser.add_argument('--page-size', type=int, default=5000, help='1ページの件数（既定: 5000）')
+    parser.add_argument('--order', choices=list(DETECTION_ORDERS), help='並び順（既定: すべて）')
+    
+    args = parser.parse_args()
+    
+    if args.reuse and Path(args.db).exists():
+        db = BirdNetSimpleDB(args.db)
+    else:
+        print(f"[INFO] 合成データを作成しています: {args.detections} 件 -> {args.db}")
+        start = time.perf_counter()
+        db = create_synthetic_database(args.db, args.detections)
+        print(f"[INFO] 作成時間: {time.perf_counter() - start:.1f} 秒")
+    
+    # 条件なし、セッション＋信頼度、種名＋信頼度
+    cases = [
+        ('all', {}),
+        ('session, confidence >= 0.5', {'session_name': 'Site03_audio_analysis_20240401', 'min_confidence': 0.5}),
+        ('species, confidence >= 0.3', {'scientific_name': 'Genus000 species000', 'min_confidence': 0.3}),
+    ]
+    
+    for order in ([args.order] if args.order else list(DETECTION_ORDERS)):
+        for name, filters in cases:
+            timings, total_rows, total_seconds = benchmark_pages(
+                db, filters, order, args.page_size, depths=[0, 10, 100, 300]
+            )
+            
+            print(f"\n[{order}] {name}: {total_rows} 件, 全ページ {total_seconds:.2f} 秒")
+            
+            for timing in timings:
+                print(f"  ページ {timing['page']:4d}: キーセット {timing['keyset_ms']:7.1f} ms, "
+                      f"OFFSET {timing['offset_ms']:7.1f} ms")
+    
+    # python lib/db/benchmark_queries.py --detections 2000000 --page-size 5000
+
+
+if __name__ == "__main__":
+    main()
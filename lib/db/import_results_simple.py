@@ -13,20 +13,66 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from simple_database import BirdNetSimpleDB
 from session_manager import LocationSpeciesDateManager, interactive_session_naming
+from recording_time import get_recording_start, assign_recording_times
 
+# 結果ファイル: <音声ファイル名>.BirdNET.results.csv (--rtype parquet の場合は .parquet)
+# 複数モデルを同時に解析した場合: <音声ファイル名>.BirdNET.<モデル名>.results.csv
+RESULT_FILE_PATTERNS = ['*.BirdNET.*results.csv', '*.BirdNET.*results.parquet']
 
-def import_results_from_directory(directory_path: str, session_name: str = None, interactive: bool = False) -> dict:
+
+def get_model_from_filename(csv_name: str, model_name: str = None) -> tuple:
+    """結果ファイル名からモデル名とモデル種別を取得"""
+    tag = csv_name.rsplit('.BirdNET.', 1)[-1].rsplit('results.', 1)[0].rstrip('.')
+    name = tag or model_name
+    
+    if name is None:
+        return "BirdNET", "default"
+    
+    return name, "default" if name in ("default", "BirdNET") else "custom"
+
+
+def find_result_files(directory: Path) -> list:
+    """ディレクトリ内の結果ファイルを検索"""
+    return sorted(f for pattern in RESULT_FILE_PATTERNS for f in directory.glob(pattern))
+
+
+def import_result_file(db: BirdNetSimpleDB, result_file: Path, session_name: str, model_name: str = None, time_options: dict = None, force: bool = False) -> dict:
+    """結果ファイルを形式に応じてインポートし、録音開始時刻が分かれば検出の絶対時刻を設定
+    
+    インポート済みで変更のないファイルはスキップする（force=True で再インポート）
+    time_options: get_recording_start の引数 (patterns, audio_dir, utc_offset)
+    """
+    # 実行場所に関係なく同じファイルを同じパスで台帳に記録する
+    result_file = Path(result_file).resolve()
+    file_model_name, file_model_type = get_model_from_filename(result_file.name, model_name)
+    
+    if result_file.suffix == '.parquet':
+        result = db.import_parquet_results(str(result_file), session_name, file_model_name, file_model_type, force)
+    else:
+        result = db.import_csv_results(str(result_file), session_name, file_model_name, file_model_type, force)
+    
+    if result['success'] and not result.get('skipped'):
+        start = get_recording_start(str(result_file), **(time_options or {}))
+        
+        if start is not None:
+            db.set_recording_start(session_name, str(result_file), start['recording_start'], start['source'], start['audio_path'])
+            result['recording_start_utc'] = start['recording_start'].isoformat()
+    
+    return result
+
+
+def import_results_from_directory(directory_path: str, session_name: str = None, interactive: bool = False, model_name: str = None, time_options: dict = None, force: bool = False) -> dict:
     """ディレクトリ内の全CSVファイルをインポート"""
     
     directory = Path(directory_path)
     if not directory.exists():
         return {'success': False, 'error': f'Directory not found: {directory_path}'}
     
-    # BirdNET結果CSVファイルを検索
-    csv_files = list(directory.glob('*.BirdNET.results.csv'))
+    # BirdNET結果ファイルを検索（モデル名付きのファイルも含む）
+    csv_files = find_result_files(directory)
     
     if not csv_files:
-        return {'success': False, 'error': 'No BirdNET result CSV files found'}
+        return {'success': False, 'error': 'No BirdNET result files found'}
     
     db = BirdNetSimpleDB()
     
@@ -46,6 +92,7 @@ def import_results_from_directory(directory_path: str, session_name: str = None,
         'session_name': session_name,
         'total_files': len(csv_files),
         'imported_files': 0,
+        'skipped_files': 0,
         'failed_files': 0,
         'total_detections': 0,
         'details': []
@@ -57,12 +104,19 @@ def import_results_from_directory(directory_path: str, session_name: str = None,
         print(f"Processing: {csv_file.name}")
         
         try:
-            import_result = db.import_csv_results(str(csv_file), session_name)
+            import_result = import_result_file(db, csv_file, session_name, model_name, time_options, force)
             
-            if import_result['success']:
+            if import_result.get('skipped'):
+                results['skipped_files'] += 1
+                print(f"  [SKIP] Already imported (session '{import_result['session_name']}')")
+            elif import_result['success']:
                 results['imported_files'] += 1
                 results['total_detections'] += import_result['detections_imported']
                 print(f"  [OK] Imported {import_result['detections_imported']} detections")
+                if import_result['detections_replaced']:
+                    print(f"  [INFO] Replaced {import_result['detections_replaced']} detections of the previous import")
+                if 'recording_start_utc' not in import_result:
+                    print("  [WARN] 録音開始時刻が分かりません（--time-pattern, --audio-dir, --assign-times を参照）")
             else:
                 results['failed_files'] += 1
                 print(f"  [ERROR] Failed: {import_result.get('error', 'Unknown error')}")
@@ -81,7 +135,7 @@ def import_results_from_directory(directory_path: str, session_name: str = None,
     
     print(f"\\nImport completed:")
     print(f"  Session: '{session_name}'")
-    print(f"  Files: {results['imported_files']}/{results['total_files']} successful")
+    print(f"  Files: {results['imported_files']}/{results['total_files']} successful, {results['skipped_files']} unchanged")
     print(f"  Detections: {results['total_detections']} total")
     
     # セッション名の解析結果を表示
@@ -95,7 +149,7 @@ def import_results_from_directory(directory_path: str, session_name: str = None,
     return results
 
 
-def import_single_file(csv_file_path: str, session_name: str = None, interactive: bool = False) -> dict:
+def import_single_file(csv_file_path: str, session_name: str = None, interactive: bool = False, model_name: str = None, time_options: dict = None, force: bool = False) -> dict:
     """単一CSVファイルをインポート"""
     
     csv_path = Path(csv_file_path)
@@ -118,9 +172,11 @@ def import_single_file(csv_file_path: str, session_name: str = None, interactive
     print(f"Importing {csv_path.name} into session '{session_name}'...")
     
     try:
-        import_result = db.import_csv_results(str(csv_path), session_name)
+        import_result = import_result_file(db, csv_path, session_name, model_name, time_options, force)
         
-        if import_result['success']:
+        if import_result.get('skipped'):
+            print(f"[SKIP] Already imported (session '{import_result['session_name']}'), use --force to import again")
+        elif import_result['success']:
             print(f"[OK] Successfully imported {import_result['detections_imported']} detections")
         else:
             print(f"[ERROR] Import failed: {import_result.get('error', 'Unknown error')}")
@@ -239,7 +295,14 @@ def main():
     parser.add_argument('--list', action='store_true', help='List all sessions')
     parser.add_argument('--stats', action='store_true', help='Show database statistics')
     parser.add_argument('--help-naming', action='store_true', help='Show session naming help')
-    parser.add_argument('--export', help='Export to CSV file')
+    parser.add_argument('--export', help='Export to CSV file (.csv.gz for gzip, .parquet for Parquet)')
+    parser.add_argument('--model', '-m', help='Model name for result files without a model name (e.g. default)')
+    parser.add_argument('--time-pattern', action='append', help='Regex with named groups year, month, day, hour, minute, second for the recording start in file names (repeatable)')
+    parser.add_argument('--audio-dir', help='Folder with the audio files, for WAV metadata timestamps')
+    parser.add_argument('--utc-offset', type=float, default=0.0, help='UTC offset in hours of timestamps without time zone (default: 0, e.g. AudioMoth)')
+    parser.add_argument('--assign-times', action='store_true', help='Set absolute detection times of already imported detections')
+    parser.add_argument('--force', action='store_true', help='Import result files again even if they are unchanged (replaces their detections)')
+    parser.add_argument('--merge-gap', type=float, help='After import, merge detections of a species at most this many seconds apart into events (bird_events)')
     
     args = parser.parse_args()
     
@@ -257,19 +320,30 @@ def main():
         show_stats()
         return
     
+    time_options = {'patterns': args.time_pattern, 'audio_dir': args.audio_dir, 'utc_offset': args.utc_offset}
+    
+    # インポート済みの検出に絶対時刻を設定
+    if args.assign_times:
+        summary = assign_recording_times(BirdNetSimpleDB(), args.session, **time_options)
+        print(f"[OK] {summary['assigned_files']}/{summary['files']} files, {summary['detections']} detections")
+        for file_path in summary['missing']:
+            print(f"  [WARN] 録音開始時刻が分かりません: {file_path}")
+        return
+    
     # CSVエクスポート
     if args.export:
         db = BirdNetSimpleDB()
         session_name = args.session if hasattr(args, 'session') else None
-        if db.export_to_csv(args.export, session_name):
-            print(f"[OK] Exported to {args.export}")
+        result = db.export_detections(args.export, session_name, progress=True)
+        if result['success']:
+            print(f"[OK] Exported {result['rows']} rows to {args.export} ({result['rows_per_second']:.0f} rows/s)")
         else:
-            print(f"[ERROR] Export failed")
+            print(f"[ERROR] Export failed: {result['error']}")
         return
     
     # pathが必要な場合のチェック
     if not args.path:
-        print("Error: path argument is required when not using --list, --stats, --export, or --help-naming")
+        print("Error: path argument is required when not using --list, --stats, --export, --assign-times, or --help-naming")
         parser.print_help()
         sys.exit(1)
     
@@ -281,9 +355,9 @@ def main():
     path = Path(args.path)
     
     if path.is_file():
-        result = import_single_file(str(path), args.session, args.interactive)
+        result = import_single_file(str(path), args.session, args.interactive, args.model, time_options, args.force)
     elif path.is_dir():
-        result = import_results_from_directory(str(path), args.session, args.interactive)
+        result = import_results_from_directory(str(path), args.session, args.interactive, args.model, time_options, args.force)
     else:
         print(f"Error: Path not found: {args.path}")
         return
@@ -291,6 +365,15 @@ def main():
     if not result['success']:
         print(f"Import failed: {result['error']}")
         sys.exit(1)
+    
+    # 重なり合うセグメントの検出をイベントにまとめる
+    if args.merge_gap is not None:
+        events = BirdNetSimpleDB().materialize_events(result['session_name'], max(0.0, args.merge_gap))
+        
+        if events['success']:
+            print(f"[OK] Merged {events['detections']} detections into {events['events']} events")
+        else:
+            print(f"[ERROR] Event merging failed: {events['error']}")
 
 
 if __name__ == "__main__":
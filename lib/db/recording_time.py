@@ -0,0 +1,238 @@
+"""
+録音開始時刻の抽出
+ファイル名（AudioMoth / Song Meter 形式や任意の正規表現）とWAVメタデータから
+各録音ファイルの絶対開始時刻（UTC）を求める
+"""
+
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# ファイル名の日時パターン（名前付きグループ year, month, day, hour, minute, second）
+# AudioMoth: 20240629_043000.WAV
+# Song Meter: SMA01234_20240629_043000.wav, S4A01234_20240629$043000.wav
+DEFAULT_PATTERNS = [
+    r'(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})[_T$-](?P<hour>\d{2})(?P<minute>\d{2})(?P<second>\d{2})',
+    r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})[ _T](?P<hour>\d{2})[-:.]?(?P<minute>\d{2})[-:.]?(?P<second>\d{2})',
+]
+
+# 解析結果ファイルから音声ファイルを探すときの拡張子
+AUDIO_EXTENSIONS = ['.wav', '.WAV']
+
+# AudioMothのコメント: "Recorded at 04:30:00 29/06/2024 (UTC+9) by AudioMoth ..."
+AUDIOMOTH_COMMENT = re.compile(
+    r'(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2}) (?P<day>\d{2})/(?P<month>\d{2})/(?P<year>\d{4}) '
+    r'\(UTC(?:(?P<sign>[+-])(?P<tz_hour>\d{1,2})(?::(?P<tz_minute>\d{2}))?)?\)'
+)
+
+# ISO形式の日時（bext, ICRD, Song Meter の wamd チャンク）
+ISO_TIME = re.compile(
+    r'(?P<year>\d{4})[-:](?P<month>\d{2})[-:](?P<day>\d{2})[ T](?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})'
+    r'(?:(?P<sign>[+-])(?P<tz_hour>\d{2}):?(?P<tz_minute>\d{2}))?'
+)
+
+
+def _to_datetime(match) -> datetime:
+    """正規表現のマッチから日時を作成（タイムゾーンがあればaware）"""
+    groups = match.groupdict()
+    year = int(groups['year'])
+
+    # 2桁の年 (240629) と秒のないパターンにも対応
+    value = datetime(
+        year + 2000 if year < 100 else year,
+        int(groups['month']),
+        int(groups['day']),
+        *(int(groups.get(key) or 0) for key in ('hour', 'minute', 'second'))
+    )
+
+    if groups.get('sign'):
+        offset = timedelta(hours=int(groups['tz_hour']), minutes=int(groups.get('tz_minute') or 0))
+        value = value.replace(tzinfo=timezone(-offset if groups['sign'] == '-' else offset))
+    elif 'sign' in groups and match.re is AUDIOMOTH_COMMENT:
+        # "(UTC)" のみの場合
+        value = value.replace(tzinfo=timezone.utc)
+
+    return value
+
+
+def parse_filename_time(name: str, patterns: List[str] = None) -> Optional[datetime]:
+    """ファイル名から録音開始時刻を取得（見つからなければNone）"""
+    # 解析結果ファイルの場合は音声ファイル名の部分だけを使う
+    name = Path(name).name.split('.BirdNET.', 1)[0]
+
+    for pattern in (patterns or DEFAULT_PATTERNS):
+        for match in re.finditer(pattern, name):
+            try:
+                return _to_datetime(match)
+            except (ValueError, KeyError, TypeError):
+                # 日付として正しくない数字の並び
+                continue
+
+    return None
+
+
+def _read_chunks(path: Path) -> Dict[bytes, bytes]:
+    """WAVファイルのメタデータチャンクを読み込む（音声データは読まない）"""
+    chunks = {}
+
+    with open(path, 'rb') as f:
+        header = f.read(12)
+
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return chunks
+
+        while True:
+            chunk_header = f.read(8)
+
+            if len(chunk_header) < 8:
+                break
+
+            chunk_id, size = chunk_header[:4], struct.unpack('<I', chunk_header[4:])[0]
+
+            if chunk_id in (b'LIST', b'bext', b'wamd'):
+                chunks[chunk_id] = f.read(size)
+            else:
+                f.seek(size, 1)
+
+            # チャンクは2バイト境界に揃えられている
+            if size % 2:
+                f.seek(1, 1)
+
+    return chunks
+
+
+def _info_fields(data: bytes) -> Dict[bytes, str]:
+    """LIST/INFOチャンクの項目（ICMT, ICRDなど）を取得"""
+    fields = {}
+
+    if data[:4] != b'INFO':
+        return fields
+
+    position = 4
+
+    while position + 8 <= len(data):
+        field_id, size = data[position:position + 4], struct.unpack('<I', data[position + 4:position + 8])[0]
+        fields[field_id] = data[position + 8:position + 8 + size].split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+        position += 8 + size + size % 2
+
+    return fields
+
+
+def read_wav_time(path: str) -> Optional[datetime]:
+    """WAVメタデータから録音開始時刻を取得（見つからなければNone）
+
+    AudioMothのコメント（ICMT）、BWFのbextチャンク、Song Meterのwamdチャンク、
+    INFOの作成日時（ICRD）の順に探す。
+    """
+    try:
+        chunks = _read_chunks(Path(path))
+    except OSError:
+        return None
+
+    info = _info_fields(chunks.get(b'LIST', b''))
+    candidates = []
+
+    if b'ICMT' in info:
+        candidates.append((AUDIOMOTH_COMMENT, info[b'ICMT']))
+
+    if b'bext' in chunks and len(chunks[b'bext']) >= 338:
+        # OriginationDate (10) と OriginationTime (8) は先頭から320バイト目
+        date = chunks[b'bext'][320:330].decode('ascii', errors='replace')
+        time = chunks[b'bext'][330:338].decode('ascii', errors='replace').replace('-', ':')
+        candidates.append((ISO_TIME, f"{date} {time}"))
+
+    if b'wamd' in chunks:
+        candidates.append((ISO_TIME, chunks[b'wamd'].decode('latin-1')))
+
+    if b'ICRD' in info:
+        candidates.append((ISO_TIME, info[b'ICRD']))
+
+    for pattern, text in candidates:
+        match = pattern.search(text)
+
+        if match:
+            try:
+                return _to_datetime(match)
+            except ValueError:
+                continue
+
+    return None
+
+
+def find_audio_file(result_path: str, audio_dir: str = None) -> Optional[Path]:
+    """解析結果ファイルに対応するWAVファイルを探す"""
+    result_path = Path(result_path)
+    base = result_path.name.split('.BirdNET.', 1)[0]
+
+    for directory in ([Path(audio_dir)] if audio_dir else []) + [result_path.parent]:
+        for extension in AUDIO_EXTENSIONS:
+            candidate = directory / (base + extension)
+
+            if candidate.exists():
+                return candidate
+
+    return None
+
+
+def to_utc(value: datetime, utc_offset: float = 0.0) -> datetime:
+    """日時をUTCに変換（タイムゾーンのない日時は utc_offset 時間の現地時刻とみなす）"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone(timedelta(hours=utc_offset)))
+
+    return value.astimezone(timezone.utc)
+
+
+def get_recording_start(result_path: str, patterns: List[str] = None, audio_dir: str = None, utc_offset: float = 0.0) -> Optional[Dict]:
+    """解析結果ファイルの録音開始時刻（UTC）を取得
+
+    指定された正規表現、標準のファイル名パターン、WAVメタデータの順に探す。
+
+    Returns:
+        {'recording_start': UTCの日時, 'source': 取得元, 'audio_path': 音声ファイル} または None
+    """
+    audio_path = find_audio_file(result_path, audio_dir)
+
+    for source, custom_patterns in (('regex', patterns), ('filename', DEFAULT_PATTERNS)):
+        if not custom_patterns:
+            continue
+
+        for name in [Path(result_path).name] + ([audio_path.name] if audio_path else []):
+            value = parse_filename_time(name, custom_patterns)
+
+            if value is not None:
+                return {
+                    'recording_start': to_utc(value, utc_offset),
+                    'source': source,
+                    'audio_path': str(audio_path) if audio_path else None
+                }
+
+    if audio_path is not None and audio_path.suffix.lower() == '.wav':
+        value = read_wav_time(str(audio_path))
+
+        if value is not None:
+            return {'recording_start': to_utc(value, utc_offset), 'source': 'wav', 'audio_path': str(audio_path)}
+
+    return None
+
+
+def assign_recording_times(db, session_name: str = None, patterns: List[str] = None, audio_dir: str = None, utc_offset: float = 0.0) -> Dict:
+    """絶対時刻のない検出結果にファイルごとの録音開始時刻を設定"""
+    summary = {'files': 0, 'assigned_files': 0, 'detections': 0, 'missing': []}
+
+    for file_info in db.get_files_without_recording_start(session_name):
+        summary['files'] += 1
+        start = get_recording_start(file_info['file_path'], patterns, audio_dir, utc_offset)
+
+        if start is None:
+            summary['missing'].append(file_info['file_path'])
+            continue
+
+        summary['assigned_files'] += 1
+        summary['detections'] += db.set_recording_start(
+            file_info['session_name'], file_info['file_path'],
+            start['recording_start'], start['source'], start['audio_path']
+        )
+
+    return summary
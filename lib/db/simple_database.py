@@ -3,13 +3,135 @@ BirdNet Simple Database Manager
 1テーブル構造でシンプルに管理
 """
 
+import csv
+import gzip
+import hashlib
+import io
 import sqlite3
 import pandas as pd
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 import re
-from typing import Dict, List, Optional
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# 集計テーブルの信頼度の下限（0.00, 0.05, ..., 0.95）と列名
+ROLLUP_LEVELS = list(range(0, 100, 5))
+ROLLUP_COLUMNS = [f"count_{level:02d}" for level in ROLLUP_LEVELS]
+
+# get_activity の集計単位（現地時刻 local_time から計算）
+ACTIVITY_BUCKETS = {
+    'hour': "CAST(strftime('%H', local_time) AS INTEGER)",
+    'day': "date(local_time)",
+    'week': "strftime('%Y-W%W', local_time)",
+}
+
+# エクスポートする列（データベースの列, 出力の列名）
+EXPORT_COLUMNS = [
+    ('start_time_seconds', 'Start (s)'),
+    ('end_time_seconds', 'End (s)'),
+    ('scientific_name', 'Scientific name'),
+    ('common_name', 'Common name'),
+    ('confidence', 'Confidence'),
+    ('session_name', 'session_name'),
+    ('filename', 'filename'),
+    ('location', 'location'),
+    ('species', 'species'),
+    ('analysis_date', 'analysis_date'),
+]
+
+# エクスポート時に1回に読み込む行数
+EXPORT_CHUNK_SIZE = 50000
+
+# query_detections の並び順（列, 方向）。最後の id で順序が一意に決まる
+DETECTION_ORDERS = {
+    'confidence': (('confidence', 'id'), 'DESC'),
+    'file': (('session_name', 'file_path', 'id'), 'ASC'),
+    'time': (('detection_time_utc', 'id'), 'ASC'),
+}
+
+
+class Detection(NamedTuple):
+    """bird_detections の1行"""
+    id: int
+    session_name: str
+    model_name: Optional[str]
+    model_type: Optional[str]
+    filename: str
+    file_path: Optional[str]
+    start_time_seconds: float
+    end_time_seconds: float
+    scientific_name: Optional[str]
+    common_name: Optional[str]
+    confidence: float
+    location: Optional[str]
+    species: Optional[str]
+    analysis_date: Optional[str]
+    created_at: Optional[str]
+    detection_time_utc: Optional[str]
+
+
+def _parse_seconds(value) -> float:
+    """CSV結果の '1m23s' 形式の時刻を秒に変換"""
+    match = re.match(r'^(\d+)m(\d+(?:\.\d+)?)s$', value)
+    return int(match.group(1)) * 60 + float(match.group(2)) if match else float('nan')
+
+
+def _detection_row(cursor, row) -> Detection:
+    """sqlite3 の row_factory: 行を Detection に変換（時刻は秒に揃える）"""
+    if row[6].__class__ is str or row[7].__class__ is str:
+        row = row[:6] + tuple(_parse_seconds(v) if v.__class__ is str else v for v in row[6:8]) + row[8:]
+    
+    return Detection._make(row)
+
+
+class _CsvChunkWriter:
+    """行のチャンクをCSVに書き込む（pandasの to_csv と同じ形式）"""
+    
+    def __init__(self, path: Path, names: List[str], compress: bool = False):
+        if compress:
+            self.file = gzip.open(path, 'wt', encoding='utf-8-sig', newline='')
+        else:
+            self.file = open(path, 'w', encoding='utf-8-sig', newline='')
+        
+        self.writer = csv.writer(self.file, lineterminator=os.linesep)
+        self.writer.writerow(names)
+    
+    def write(self, rows: list):
+        self.writer.writerows(rows)
+    
+    def close(self):
+        self.file.close()
+
+
+class _ParquetChunkWriter:
+    """行のチャンクをParquetの行グループとして書き込む"""
+    
+    def __init__(self, path: Path, names: List[str]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        # 時刻と信頼度は数値、それ以外は文字列
+        numeric = {'Start (s)', 'End (s)', 'Confidence'}
+        self.names = names
+        self.schema = pa.schema([(name, pa.float64() if name in numeric else pa.string()) for name in names])
+        self.writer = pq.ParquetWriter(path, self.schema)
+    
+    def write(self, rows: list):
+        import pyarrow as pa
+        
+        df = pd.DataFrame.from_records(rows, columns=self.names)
+        
+        # CSVからインポートした '1m23s' 形式の時刻は秒に変換
+        for name in ('Start (s)', 'End (s)'):
+            df[name] = BirdNetSimpleDB._to_seconds(df[name])
+        
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+    
+    def close(self):
+        self.writer.close()
+
 
 class BirdNetSimpleDB:
     """シンプルな1テーブル構造のBirdNetデータベース"""
@@ -23,6 +145,9 @@ class BirdNetSimpleDB:
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         
+        # セッションごとの台帳のない古いインポートの結果ファイル {ファイル名: [保存されたパス]}
+        self._legacy_files = {}
+        
         self._initialize_database()
     
     def _initialize_database(self):
@@ -30,6 +155,9 @@ class BirdNetSimpleDB:
         schema_path = self.db_path.parent / "schema_simple.sql"
         
         with sqlite3.connect(self.db_path) as conn:
+            # 既存のデータベースに新しい列を追加（インデックス作成より先に行う）
+            self._migrate_database(conn)
+            
             if schema_path.exists():
                 with open(schema_path, 'r', encoding='utf-8') as f:
                     conn.executescript(f.read())
@@ -51,24 +179,265 @@ class BirdNetSimpleDB:
                         location TEXT,
                         species TEXT,
                         analysis_date TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        detection_time_utc TEXT
                     );
                     
                     CREATE INDEX IF NOT EXISTS idx_session_name ON bird_detections(session_name);
                     CREATE INDEX IF NOT EXISTS idx_species ON bird_detections(scientific_name, common_name);
                     CREATE INDEX IF NOT EXISTS idx_confidence ON bird_detections(confidence);
+                    CREATE INDEX IF NOT EXISTS idx_detection_time ON bird_detections(detection_time_utc);
+                    CREATE INDEX IF NOT EXISTS idx_species_time ON bird_detections(scientific_name, detection_time_utc);
+                    CREATE INDEX IF NOT EXISTS idx_file ON bird_detections(session_name, file_path);
+                    CREATE INDEX IF NOT EXISTS idx_session_confidence ON bird_detections(session_name, confidence);
+                    CREATE INDEX IF NOT EXISTS idx_species_confidence ON bird_detections(scientific_name, confidence);
+                    CREATE INDEX IF NOT EXISTS idx_species_file ON bird_detections(scientific_name, session_name, file_path);
+                    
+                    CREATE TABLE IF NOT EXISTS recording_files (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        session_name TEXT NOT NULL,
+                        file_path TEXT NOT NULL,
+                        audio_path TEXT,
+                        recording_start_utc TEXT NOT NULL,
+                        timestamp_source TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE(session_name, file_path)
+                    );
+                    
+                    CREATE TABLE IF NOT EXISTS bird_events (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        session_name TEXT NOT NULL,
+                        model_name TEXT,
+                        model_type TEXT DEFAULT 'default',
+                        filename TEXT NOT NULL,
+                        file_path TEXT,
+                        start_time_seconds REAL NOT NULL,
+                        end_time_seconds REAL NOT NULL,
+                        scientific_name TEXT,
+                        common_name TEXT,
+                        max_confidence REAL NOT NULL,
+                        mean_confidence REAL NOT NULL,
+                        hit_count INTEGER NOT NULL,
+                        gap_seconds REAL NOT NULL,
+                        location TEXT,
+                        species TEXT,
+                        analysis_date TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                    
+                    CREATE INDEX IF NOT EXISTS idx_events_session_name ON bird_events(session_name);
+                    CREATE INDEX IF NOT EXISTS idx_events_species ON bird_events(scientific_name, common_name);
+                    CREATE INDEX IF NOT EXISTS idx_events_confidence ON bird_events(max_confidence);
+                    
+                    CREATE TABLE IF NOT EXISTS activity_rollup (
+                        session_name TEXT NOT NULL,
+                        scientific_name TEXT NOT NULL,
+                        common_name TEXT,
+                        day TEXT NOT NULL,
+                        hour INTEGER NOT NULL,
+                        -- count_XX: 信頼度 >= 0.XX の検出数
+                        count_00 INTEGER NOT NULL DEFAULT 0, count_05 INTEGER NOT NULL DEFAULT 0, count_10 INTEGER NOT NULL DEFAULT 0, count_15 INTEGER NOT NULL DEFAULT 0,
+                        count_20 INTEGER NOT NULL DEFAULT 0, count_25 INTEGER NOT NULL DEFAULT 0, count_30 INTEGER NOT NULL DEFAULT 0, count_35 INTEGER NOT NULL DEFAULT 0,
+                        count_40 INTEGER NOT NULL DEFAULT 0, count_45 INTEGER NOT NULL DEFAULT 0, count_50 INTEGER NOT NULL DEFAULT 0, count_55 INTEGER NOT NULL DEFAULT 0,
+                        count_60 INTEGER NOT NULL DEFAULT 0, count_65 INTEGER NOT NULL DEFAULT 0, count_70 INTEGER NOT NULL DEFAULT 0, count_75 INTEGER NOT NULL DEFAULT 0,
+                        count_80 INTEGER NOT NULL DEFAULT 0, count_85 INTEGER NOT NULL DEFAULT 0, count_90 INTEGER NOT NULL DEFAULT 0, count_95 INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (session_name, scientific_name, day, hour)
+                    );
+                    
+                    CREATE INDEX IF NOT EXISTS idx_rollup_species ON activity_rollup(scientific_name, day);
+                    
+                    CREATE TABLE IF NOT EXISTS import_ledger (
+                        session_name TEXT NOT NULL,
+                        file_path TEXT NOT NULL,
+                        file_size INTEGER NOT NULL,
+                        file_mtime_ns INTEGER NOT NULL,
+                        content_hash TEXT NOT NULL,
+                        row_count INTEGER NOT NULL,
+                        imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (session_name, file_path)
+                    );
                 """)
+            
+            # 集計テーブルが空の場合（古いデータベース）は検出結果から作成
+            if conn.execute("SELECT 1 FROM activity_rollup LIMIT 1").fetchone() is None:
+                self._rebuild_activity_rollup(conn)
+    
+    def _migrate_database(self, conn):
+        """古いスキーマのデータベースに不足している列を追加"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(bird_detections)")}
+        
+        if columns and 'detection_time_utc' not in columns:
+            conn.execute("ALTER TABLE bird_detections ADD COLUMN detection_time_utc TEXT")
+    
+    def _update_activity_rollup(self, conn, where: str, params: tuple, sign: int = 1):
+        """条件に合う検出を集計テーブルに加算（sign=-1 で減算）
+        
+        検出の絶対時刻を変更・削除する前に -1、変更後に +1 で呼び出す。
+        """
+        counts = ", ".join(f"? * SUM(confidence >= {level / 100})" for level in ROLLUP_LEVELS)
+        updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in ROLLUP_COLUMNS)
+        
+        conn.execute(f"""
+            INSERT INTO activity_rollup (
+                session_name, scientific_name, common_name, day, hour, {", ".join(ROLLUP_COLUMNS)}
+            )
+            SELECT
+                session_name,
+                COALESCE(scientific_name, ''),
+                MAX(common_name),
+                substr(detection_time_utc, 1, 10),
+                CAST(substr(detection_time_utc, 12, 2) AS INTEGER),
+                {counts}
+            FROM bird_detections
+            WHERE detection_time_utc IS NOT NULL AND ({where})
+            GROUP BY 1, 2, 4, 5
+            ON CONFLICT (session_name, scientific_name, day, hour)
+            DO UPDATE SET {updates}, common_name = COALESCE(excluded.common_name, common_name)
+        """, (*[sign] * len(ROLLUP_LEVELS), *params))
+        
+        if sign < 0 and conn.execute("SELECT changes()").fetchone()[0]:
+            conn.execute(f"DELETE FROM activity_rollup WHERE {ROLLUP_COLUMNS[0]} <= 0")
+    
+    def _rebuild_activity_rollup(self, conn):
+        """集計テーブルを全検出から作り直す"""
+        conn.execute("DELETE FROM activity_rollup")
+        self._update_activity_rollup(conn, "1", ())
+    
+    def _check_import_ledger(self, path: Path, session_name: str, force: bool = False) -> Dict:
+        """インポート台帳と照合し、ファイルを読み込む必要があるかを判定
+        
+        台帳は (セッション, ファイル) ごとに記録する。別のセッションへのインポートは新規のインポートになる。
+        サイズと更新時刻が台帳と同じならファイルを読まずに、内容のハッシュが同じなら読み込んだ上でスキップする。
+        
+        Returns:
+            {'skip': bool, 'entry': 台帳の行, 'data': ファイルの内容, 'content_hash', 'stat'}
+        """
+        stat = path.stat()
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            entry = conn.execute(
+                "SELECT * FROM import_ledger WHERE session_name = ? AND file_path = ?",
+                (session_name, str(path))
+            ).fetchone()
+            
+            if not force and entry is not None and (entry['file_size'], entry['file_mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                return {'skip': True, 'entry': entry}
+            
+            data = path.read_bytes()
+            content_hash = hashlib.sha256(data).hexdigest()
+            
+            if not force and entry is not None and entry['content_hash'] == content_hash:
+                # 内容は同じ（touchなどで更新時刻だけが変わった）
+                conn.execute(
+                    "UPDATE import_ledger SET file_size = ?, file_mtime_ns = ? WHERE session_name = ? AND file_path = ?",
+                    (stat.st_size, stat.st_mtime_ns, session_name, str(path))
+                )
+                return {'skip': True, 'entry': entry}
+        
+        return {'skip': False, 'entry': entry, 'data': data, 'content_hash': content_hash, 'stat': stat}
+    
+    def _remove_file_detections(self, conn, session_name: str, file_path: str) -> int:
+        """結果ファイル1つ分の検出と、それに依存するイベント・録音時刻・集計を削除"""
+        where = "session_name = ? AND file_path = ?"
+        params = (session_name, file_path)
+        
+        self._update_activity_rollup(conn, where, params, -1)
+        deleted = conn.execute(f"DELETE FROM bird_detections WHERE {where}", params).rowcount
+        conn.execute(f"DELETE FROM bird_events WHERE {where}", params)
+        conn.execute(f"DELETE FROM recording_files WHERE {where}", params)
+        
+        return deleted
+    
+    def _legacy_file_paths(self, conn, session_name: str, filename: str) -> List[str]:
+        """台帳ができる前にインポートされた、同じ名前の結果ファイルの保存されたパスを取得
+        
+        以前は指定されたパスをそのまま（相対パスのことも多い）保存していたので、
+        台帳にないパスをファイル名で照合する。セッションごとに一度だけ検索する。
+        """
+        if session_name not in self._legacy_files:
+            legacy = {}
+            
+            for (file_path,) in conn.execute("""
+                SELECT DISTINCT file_path FROM bird_detections AS d
+                WHERE session_name = ? AND file_path IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM import_ledger AS l
+                    WHERE l.session_name = d.session_name AND l.file_path = d.file_path
+                )
+            """, (session_name,)):
+                legacy.setdefault(Path(file_path).name, []).append(file_path)
+            
+            self._legacy_files[session_name] = legacy
+        
+        return self._legacy_files[session_name].get(filename, [])
+    
+    def _import_records(self, path: Path, session_name: str, records: List[tuple], check: Dict) -> Dict:
+        """検出を挿入し、同じセッション・同じファイルの以前の検出を1つのトランザクションで置き換える"""
+        with sqlite3.connect(self.db_path) as conn:
+            # 変更されたファイルの以前の検出を削除（他のセッションの検出は残す）
+            replaced = self._remove_file_detections(conn, session_name, str(path))
+            
+            # 台帳のない古いインポートの検出は、同じセッションの同じ名前のファイルとして置き換える
+            if check['entry'] is None:
+                for file_path in self._legacy_file_paths(conn, session_name, path.name):
+                    if file_path != str(path):
+                        replaced += self._remove_file_detections(conn, session_name, file_path)
+            
+            conn.executemany("""
+                INSERT INTO bird_detections (
+                    session_name, model_name, model_type, filename, file_path,
+                    start_time_seconds, end_time_seconds, scientific_name, common_name, confidence,
+                    location, species, analysis_date, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, records)
+            
+            conn.execute("""
+                INSERT OR REPLACE INTO import_ledger (
+                    session_name, file_path, file_size, file_mtime_ns, content_hash, row_count
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            """, (session_name, str(path), check['stat'].st_size, check['stat'].st_mtime_ns, check['content_hash'], len(records)))
+            conn.commit()
+        
+        # 置き換えた古いインポートは次回から台帳で判定する
+        self._legacy_files.get(session_name, {}).pop(path.name, None)
+        
+        return {
+            'success': True,
+            'detections_imported': len(records),
+            'detections_replaced': replaced,
+            'session_name': session_name,
+            'filename': path.name
+        }
+    
+    @staticmethod
+    def _skipped_result(path: Path, check: Dict) -> Dict:
+        """インポートを省略したファイルの結果"""
+        return {
+            'success': True,
+            'skipped': True,
+            'detections_imported': 0,
+            'session_name': check['entry']['session_name'],
+            'filename': path.name
+        }
     
-    def import_csv_results(self, csv_path: str, session_name: str, model_name: str = "BirdNET", model_type: str = "default") -> Dict:
-        """CSVファイルから検出結果をインポート"""
+    def import_csv_results(self, csv_path: str, session_name: str, model_name: str = "BirdNET", model_type: str = "default", force: bool = False) -> Dict:
+        """CSVファイルから検出結果をインポート（インポート済みで変更のないファイルはスキップ）
+        
+        force=True の場合は台帳に関係なくインポートし直す（以前の検出は置き換える）
+        """
         csv_path = Path(csv_path)
         
         if not csv_path.exists():
             return {'success': False, 'error': f'CSV file not found: {csv_path}'}
         
         try:
-            # CSVファイルを読み込み
-            df = pd.read_csv(csv_path)
+            check = self._check_import_ledger(csv_path, session_name, force)
+            
+            if check['skip']:
+                return self._skipped_result(csv_path, check)
+            
+            # CSVファイルを読み込み（ハッシュを計算した内容をそのまま使う）
+            df = pd.read_csv(io.BytesIO(check['data']))
             
             # 列名の確認と標準化
             required_columns = ['Start (s)', 'End (s)', 'Scientific name', 'Common name', 'Confidence']
@@ -79,53 +448,62 @@ class BirdNetSimpleDB:
             
             # セッション名から場所、種名、日付を解析
             location, species, analysis_date = self._parse_session_name(session_name)
+            created_at = datetime.now().isoformat()
             
-            # データベースに挿入
-            records = []
-            for _, row in df.iterrows():
-                record = {
-                    'session_name': session_name,
-                    'model_name': model_name,
-                    'model_type': model_type,
-                    'filename': csv_path.name,
-                    'file_path': str(csv_path),
-                    'start_time_seconds': row['Start (s)'],
-                    'end_time_seconds': row['End (s)'],
-                    'scientific_name': row['Scientific name'] if pd.notna(row['Scientific name']) else None,
-                    'common_name': row['Common name'] if pd.notna(row['Common name']) else None,
-                    'confidence': row['Confidence'],
-                    'location': location,
-                    'species': species,
-                    'analysis_date': analysis_date,
-                    'created_at': datetime.now().isoformat()
-                }
-                records.append(record)
+            # データベースに挿入するレコード
+            records = [
+                (session_name, model_name, model_type, csv_path.name, str(csv_path),
+                 start, end, scientific_name, common_name, confidence,
+                 location, species, analysis_date, created_at)
+                for start, end, scientific_name, common_name, confidence in zip(
+                    df['Start (s)'].tolist(),
+                    df['End (s)'].tolist(),
+                    df['Scientific name'].astype(object).where(df['Scientific name'].notna(), None).tolist(),
+                    df['Common name'].astype(object).where(df['Common name'].notna(), None).tolist(),
+                    df['Confidence'].tolist()
+                )
+            ]
             
-            # データベースに一括挿入
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                insert_sql = """
-                    INSERT INTO bird_detections (
-                        session_name, model_name, model_type, filename, file_path,
-                        start_time_seconds, end_time_seconds, scientific_name, common_name, confidence,
-                        location, species, analysis_date, created_at
-                    ) VALUES (
-                        :session_name, :model_name, :model_type, :filename, :file_path,
-                        :start_time_seconds, :end_time_seconds, :scientific_name, :common_name, :confidence,
-                        :location, :species, :analysis_date, :created_at
-                    )
-                """
-                
-                cursor.executemany(insert_sql, records)
-                conn.commit()
+            return self._import_records(csv_path, session_name, records, check)
             
-            return {
-                'success': True,
-                'detections_imported': len(records),
-                'session_name': session_name,
-                'filename': csv_path.name
-            }
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
+    def import_parquet_results(self, parquet_path: str, session_name: str, model_name: str = "BirdNET", model_type: str = "default", force: bool = False) -> Dict:
+        """Parquetファイル (--rtype parquet) から検出結果をインポート（インポート済みで変更のないファイルはスキップ）"""
+        parquet_path = Path(parquet_path)
+        
+        if not parquet_path.exists():
+            return {'success': False, 'error': f'Parquet file not found: {parquet_path}'}
+        
+        try:
+            check = self._check_import_ledger(parquet_path, session_name, force)
+            
+            if check['skip']:
+                return self._skipped_result(parquet_path, check)
+            
+            # 必要な列だけを読み込み（型付きの列なので文字列の解析は不要）
+            df = pd.read_parquet(io.BytesIO(check['data']), columns=['start', 'end', 'scientific_name', 'common_name', 'confidence'])
+            
+            # セッション名から場所、種名、日付を解析
+            location, species, analysis_date = self._parse_session_name(session_name)
+            created_at = datetime.now().isoformat()
+            
+            # 列単位で変換してからまとめてレコードを作成
+            records = [
+                (session_name, model_name, model_type, parquet_path.name, str(parquet_path),
+                 start, end, scientific_name, common_name, confidence,
+                 location, species, analysis_date, created_at)
+                for start, end, scientific_name, common_name, confidence in zip(
+                    df['start'].tolist(),
+                    df['end'].tolist(),
+                    df['scientific_name'].astype(str).tolist(),
+                    df['common_name'].astype(str).tolist(),
+                    df['confidence'].astype('float64').round(4).tolist()
+                )
+            ]
+            
+            return self._import_records(parquet_path, session_name, records, check)
             
         except Exception as e:
             return {'success': False, 'error': str(e)}
@@ -213,6 +591,396 @@ class BirdNetSimpleDB:
             
             return [dict(row) for row in cursor.fetchall()]
     
+    def query_detections(self, session_name: str = None, scientific_name: str = None,
+                         min_confidence: float = None, max_confidence: float = None,
+                         file_path: str = None, start_utc=None, end_utc=None,
+                         order: str = 'confidence', after: tuple = None,
+                         limit: int = 100) -> Tuple[List[Detection], Optional[tuple]]:
+        """条件に合う検出結果をページ単位で取得（キーセット・ページネーション）
+        
+        OFFSETを使わず、前のページの最後の行のキーから続きを読むので、
+        何ページ目でもインデックスから limit 件を読むだけで済む。
+        
+        Args:
+            session_name, scientific_name, file_path: 完全一致の条件
+            min_confidence, max_confidence: 信頼度の範囲（両端を含む）
+            start_utc, end_utc: 検出時刻（UTC）の範囲 [start_utc, end_utc)
+            order: 'confidence'（信頼度の高い順）, 'file'（セッション・ファイルごとに記録順）,
+                   'time'（検出時刻順、絶対時刻のない検出は含まない）
+                   各並び順のキー（カーソル）は DETECTION_ORDERS の列で、'file' は (session_name, file_path, id)。
+                   ファイル内は開始時刻ではなく挿入順 (id) で、結果ファイルの行の順（BirdNETの出力では開始時刻順）になる。
+            after: 前回返された next_cursor（最初のページは None）
+            limit: 1ページの件数
+        
+        Returns:
+            (Detection のリスト, 次のページの next_cursor または None)
+        """
+        if order not in DETECTION_ORDERS:
+            raise ValueError(f"order は {', '.join(DETECTION_ORDERS)} のいずれかです: {order}")
+        
+        key_columns, direction = DETECTION_ORDERS[order]
+        conditions = []
+        params = []
+        
+        for column, value in (('session_name', session_name), ('scientific_name', scientific_name), ('file_path', file_path)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        
+        if min_confidence is not None:
+            conditions.append("confidence >= ?")
+            params.append(min_confidence)
+        
+        if max_confidence is not None:
+            conditions.append("confidence <= ?")
+            params.append(max_confidence)
+        
+        if start_utc is not None:
+            conditions.append("detection_time_utc >= ?")
+            params.append(self._format_utc(start_utc))
+        
+        if end_utc is not None:
+            conditions.append("detection_time_utc < ?")
+            params.append(self._format_utc(end_utc))
+        
+        if order == 'time' and start_utc is None:
+            conditions.append("detection_time_utc IS NOT NULL")
+        
+        if after is not None:
+            # 行値の比較 (a, b) < (?, ?) はインデックスで範囲検索できる
+            conditions.append(f"({', '.join(key_columns)}) {'<' if direction == 'DESC' else '>'} ({', '.join('?' * len(key_columns))})")
+            params.extend(after)
+        
+        query = f"""
+            SELECT {', '.join(Detection._fields)}
+            FROM bird_detections
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+            ORDER BY {', '.join(f"{column} {direction}" for column in key_columns)}
+            LIMIT ?
+        """
+        params.append(limit)
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = _detection_row
+            rows = conn.execute(query, params).fetchall()
+        
+        # 最後のページでなければ、最後の行のキーを次のページの開始位置にする
+        next_cursor = None
+        
+        if len(rows) == limit and rows:
+            next_cursor = tuple(getattr(rows[-1], column) for column in key_columns)
+        
+        return rows, next_cursor
+    
+    @staticmethod
+    def _to_seconds(values: pd.Series) -> pd.Series:
+        """開始・終了時刻を秒に変換（CSV結果の '1m23s' 形式と数値の両方に対応）"""
+        seconds = pd.to_numeric(values, errors='coerce')
+        text = seconds.isna() & values.notna()
+        
+        if text.any():
+            parts = values[text].astype(str).str.extract(r'^(\d+)m(\d+(?:\.\d+)?)s$').astype(float)
+            seconds[text] = parts[0] * 60 + parts[1]
+        
+        return seconds
+    
+    def materialize_events(self, session_name: str = None, gap_seconds: float = 0.0, min_confidence: float = 0.0) -> Dict:
+        """検出結果を種ごとのイベント（1回の鳴き声）にまとめて bird_events に保存
+        
+        オーバーラップ解析では1回の鳴き声が複数のセグメントで検出されるため、
+        同じファイル・モデル・種の検出を開始時刻順に並べ、前の検出の終了から
+        gap_seconds 秒以内に始まるものを1つのイベントに統合する。
+        イベントには最大・平均信頼度と統合した検出数を保存する。
+        既存のイベントはセッション単位で置き換える。
+        """
+        keys = ['model_name', 'model_type', 'filename', 'file_path', 'scientific_name', 'common_name']
+        summary = {'success': True, 'sessions': 0, 'detections': 0, 'events': 0}
+        
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                if session_name:
+                    session_names = [session_name]
+                else:
+                    session_names = [row[0] for row in conn.execute("SELECT DISTINCT session_name FROM bird_detections")]
+                
+                # メモリ使用量を抑えるためセッションごとに処理
+                for name in session_names:
+                    df = pd.read_sql_query("""
+                        SELECT 
+                            model_name, model_type, filename, file_path, scientific_name, common_name,
+                            start_time_seconds, end_time_seconds, confidence,
+                            location, species, analysis_date
+                        FROM bird_detections
+                        WHERE session_name = ? AND confidence >= ?
+                    """, conn, params=(name, min_confidence))
+                    
+                    df['start'] = self._to_seconds(df['start_time_seconds'])
+                    df['end'] = self._to_seconds(df['end_time_seconds'])
+                    df = df.sort_values(keys + ['start'], kind='mergesort', na_position='first').reset_index(drop=True)
+                    
+                    # グループ内の最も遅い終了時刻より gap_seconds 以上離れていれば新しいイベント
+                    group_id = df.groupby(keys, sort=False, dropna=False).ngroup()
+                    latest_end = df['end'].groupby(group_id).cummax()
+                    new_event = (group_id != group_id.shift()) | (df['start'] > latest_end.shift() + gap_seconds)
+                    
+                    events = df.groupby(new_event.cumsum(), sort=False).agg(
+                        **{key: (key, 'first') for key in keys},
+                        start_time_seconds=('start', 'min'),
+                        end_time_seconds=('end', 'max'),
+                        max_confidence=('confidence', 'max'),
+                        mean_confidence=('confidence', 'mean'),
+                        hit_count=('confidence', 'size'),
+                        location=('location', 'first'),
+                        species=('species', 'first'),
+                        analysis_date=('analysis_date', 'first')
+                    )
+                    events = events.astype(object).where(events.notna(), None)
+                    created_at = datetime.now().isoformat()
+                    
+                    # 同じトランザクションで置き換え
+                    conn.execute("DELETE FROM bird_events WHERE session_name = ?", (name,))
+                    conn.executemany("""
+                        INSERT INTO bird_events (
+                            session_name, model_name, model_type, filename, file_path, scientific_name, common_name,
+                            start_time_seconds, end_time_seconds, max_confidence, mean_confidence, hit_count,
+                            location, species, analysis_date, gap_seconds, created_at
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (
+                        (name, *row, gap_seconds, created_at)
+                        for row in events.itertuples(index=False, name=None)
+                    ))
+                    conn.commit()
+                    
+                    summary['sessions'] += 1
+                    summary['detections'] += len(df)
+                    summary['events'] += len(events)
+            
+            return summary
+            
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
+    def get_events(self, session_name: str = None, limit: int = 100) -> List[Dict]:
+        """イベントを取得"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            
+            if session_name:
+                query = """
+                    SELECT * FROM bird_events 
+                    WHERE session_name = ? 
+                    ORDER BY filename, start_time_seconds 
+                    LIMIT ?
+                """
+                cursor.execute(query, (session_name, limit))
+            else:
+                query = """
+                    SELECT * FROM bird_events 
+                    ORDER BY created_at DESC 
+                    LIMIT ?
+                """
+                cursor.execute(query, (limit,))
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @staticmethod
+    def _format_utc(value) -> str:
+        """UTCの日時を検索用の文字列にする（タイムゾーンのない日時はUTCとみなす）"""
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        
+        return value.isoformat(sep=' ', timespec='milliseconds')
+    
+    def set_recording_start(self, session_name: str, file_path: str, recording_start: datetime,
+                            source: str = None, audio_path: str = None) -> int:
+        """ファイルの録音開始時刻（UTC）を保存し、検出の絶対時刻を更新
+        
+        Returns:
+            更新した検出数
+        """
+        recording_start_utc = self._format_utc(recording_start)
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO recording_files (
+                    session_name, file_path, audio_path, recording_start_utc, timestamp_source, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            """, (session_name, file_path, audio_path, recording_start_utc, source, datetime.now().isoformat()))
+            
+            df = pd.read_sql_query(
+                "SELECT id, start_time_seconds FROM bird_detections WHERE session_name = ? AND file_path = ?",
+                conn, params=(session_name, file_path)
+            )
+            
+            # 以前の時刻での集計を取り消す
+            file_condition = "session_name = ? AND file_path = ?"
+            self._update_activity_rollup(conn, file_condition, (session_name, file_path), -1)
+            
+            # 開始時刻 + ファイル内の秒数をまとめて計算
+            seconds = self._to_seconds(df['start_time_seconds'])
+            times = pd.Timestamp(recording_start_utc) + pd.to_timedelta(seconds, unit='s')
+            times = times.dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:-3]
+            
+            conn.executemany(
+                "UPDATE bird_detections SET detection_time_utc = ? WHERE id = ?",
+                zip(times.where(times.notna(), None).tolist(), df['id'].tolist())
+            )
+            self._update_activity_rollup(conn, file_condition, (session_name, file_path))
+            conn.commit()
+            
+            return len(df)
+    
+    def get_files_without_recording_start(self, session_name: str = None) -> List[Dict]:
+        """絶対時刻が設定されていない検出を含むファイル一覧を取得"""
+        with sqlite3.connect(self.db_path) as conn:
+            query = """
+                SELECT session_name, file_path, COUNT(*)
+                FROM bird_detections
+                WHERE detection_time_utc IS NULL AND file_path IS NOT NULL
+            """
+            params = ()
+            
+            if session_name:
+                query += " AND session_name = ?"
+                params = (session_name,)
+            
+            query += " GROUP BY session_name, file_path ORDER BY session_name, file_path"
+            
+            return [
+                {'session_name': row[0], 'file_path': row[1], 'detection_count': row[2]}
+                for row in conn.execute(query, params)
+            ]
+    
+    def get_detections_in_time_range(self, start_utc, end_utc, scientific_name: str = None,
+                                     min_confidence: float = 0.0, limit: int = 1000) -> List[Dict]:
+        """絶対時刻（UTC）の範囲で検出結果を取得（start_utc <= 時刻 < end_utc）"""
+        query = """
+            SELECT * FROM bird_detections
+            WHERE detection_time_utc >= ? AND detection_time_utc < ? AND confidence >= ?
+        """
+        params = [self._format_utc(start_utc), self._format_utc(end_utc), min_confidence]
+        
+        if scientific_name:
+            query += " AND scientific_name = ?"
+            params.append(scientific_name)
+        
+        query += " ORDER BY detection_time_utc LIMIT ?"
+        params.append(limit)
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(query, params)]
+    
+    def get_activity(self, bucket: str = 'hour', scientific_name: str = None, session_name: str = None,
+                     min_confidence: float = 0.0, start_date: str = None, end_date: str = None,
+                     utc_offset: float = 0) -> List[Dict]:
+        """種ごとの時間帯別検出数を取得（日周・季節の活動パターン）
+        
+        Args:
+            bucket: 'hour'（時刻 0-23）、'day'（YYYY-MM-DD）、'week'（YYYY-Www）
+            scientific_name: 対象の種（省略時は全種）
+            session_name: 対象のセッション（省略時は全セッション）
+            min_confidence: 信頼度の下限
+            start_date, end_date: 期間（YYYY-MM-DD、両端を含む、utc_offset適用後の日付）
+            utc_offset: 集計に使う現地時刻のUTCからの時差（時間）
+        
+        0.05刻みの信頼度の下限は集計テーブルから、それ以外は検出結果から直接集計する。
+        集計テーブルは1時間単位なので、+5.5 のような時間単位でない時差も検出結果から集計する。
+        絶対時刻のない検出は含まれない。
+        """
+        if bucket not in ACTIVITY_BUCKETS:
+            raise ValueError(f"bucket must be one of {list(ACTIVITY_BUCKETS)}")
+        
+        level = round(min_confidence * 100)
+        whole_hours = float(utc_offset).is_integer()
+        source_params = []
+        
+        if whole_hours and level in ROLLUP_LEVELS and abs(level - min_confidence * 100) < 1e-6:
+            # 集計テーブルの行（1時間ごとの信頼度の下限別の件数）
+            source = f"""
+                SELECT session_name, scientific_name, common_name, day, hour,
+                       {ROLLUP_COLUMNS[ROLLUP_LEVELS.index(level)]} AS detection_count
+                FROM activity_rollup
+            """
+        elif whole_hours:
+            source = f"""
+                SELECT
+                    session_name, COALESCE(scientific_name, '') AS scientific_name, common_name,
+                    substr(detection_time_utc, 1, 10) AS day,
+                    CAST(substr(detection_time_utc, 12, 2) AS INTEGER) AS hour,
+                    1 AS detection_count
+                FROM bird_detections
+                WHERE detection_time_utc IS NOT NULL AND confidence >= {float(min_confidence)!r}
+            """
+        else:
+            # 検出ごとに分単位の時差で現地時刻にしてから時間帯に分ける
+            source = f"""
+                SELECT
+                    session_name, COALESCE(scientific_name, '') AS scientific_name, common_name,
+                    substr(local_detection_time, 1, 10) AS day,
+                    CAST(substr(local_detection_time, 12, 2) AS INTEGER) AS hour,
+                    1 AS detection_count
+                FROM (
+                    SELECT *, datetime(detection_time_utc, ?) AS local_detection_time
+                    FROM bird_detections
+                    WHERE detection_time_utc IS NOT NULL AND confidence >= {float(min_confidence)!r}
+                )
+            """
+            source_params.append(f"{round(utc_offset * 60):+d} minutes")
+        
+        # 時間単位でない時差は source で適用済み
+        conditions, params = [], [f"{int(utc_offset) if whole_hours else 0:+d} hours", *source_params]
+        
+        if session_name:
+            conditions.append("session_name = ?")
+            params.append(session_name)
+        
+        if scientific_name:
+            conditions.append("scientific_name = ?")
+            params.append(scientific_name)
+        
+        date_conditions = []
+        
+        if start_date:
+            date_conditions.append("date(local_time) >= ?")
+        
+        if end_date:
+            date_conditions.append("date(local_time) <= ?")
+        
+        query = f"""
+            SELECT scientific_name, MAX(common_name), {ACTIVITY_BUCKETS[bucket]} AS bucket, SUM(detection_count)
+            FROM (
+                SELECT *, datetime(day || printf(' %02d:00:00', hour), ?) AS local_time
+                FROM (
+                    -- セッションをまとめてから現地時刻に変換
+                    SELECT scientific_name, MAX(common_name) AS common_name, day, hour, SUM(detection_count) AS detection_count
+                    FROM ({source})
+                    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                    GROUP BY scientific_name, day, hour
+                )
+            )
+            {'WHERE ' + ' AND '.join(date_conditions) if date_conditions else ''}
+            GROUP BY scientific_name, bucket
+            HAVING SUM(detection_count) > 0
+            ORDER BY scientific_name, bucket
+        """
+        params += [d for d in (start_date, end_date) if d]
+        
+        with sqlite3.connect(self.db_path) as conn:
+            return [
+                {
+                    'scientific_name': row[0] or None,
+                    'common_name': row[1],
+                    bucket: row[2],
+                    'detection_count': row[3]
+                }
+                for row in conn.execute(query, params)
+            ]
+    
     def get_statistics(self) -> Dict:
         """統計情報を取得"""
         with sqlite3.connect(self.db_path) as conn:
@@ -267,52 +1035,101 @@ class BirdNetSimpleDB:
                 'top_species': top_species
             }
     
-    def export_to_csv(self, output_path: str, session_name: str = None) -> bool:
-        """検出結果をCSVにエクスポート"""
+    def export_detections(self, output_path: str, session_name: str = None, file_format: str = None,
+                          compress: bool = None, chunk_size: int = EXPORT_CHUNK_SIZE, progress: bool = False) -> Dict:
+        """検出結果をCSVまたはParquetにエクスポート（チャンク単位で書き込み、メモリ使用量は一定）
+        
+        Args:
+            output_path: 出力ファイル（.csv, .csv.gz, .parquet）
+            session_name: 対象のセッション（省略時は全セッション）
+            file_format: 'csv' または 'parquet'（省略時は拡張子から判定）
+            compress: CSVをgzip圧縮するか（省略時は拡張子 .gz で判定）
+            chunk_size: 1回に読み込む行数
+            progress: 進捗と行数/秒を表示するか
+        
+        Returns:
+            {'success', 'rows', 'seconds', 'rows_per_second'} または {'success': False, 'error'}
+        """
+        output_path = Path(output_path)
+        suffixes = [suffix.lower() for suffix in output_path.suffixes]
+        file_format = file_format or ('parquet' if suffixes[-1:] == ['.parquet'] else 'csv')
+        compress = suffixes[-1:] == ['.gz'] if compress is None else compress
+        
+        # 書き込みが終わるまでは一時ファイルに出力
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
+        
+        query = f"""
+            SELECT {', '.join(f"{column} AS '{name}'" for column, name in EXPORT_COLUMNS)}
+            FROM bird_detections
+        """
+        count_query = "SELECT COUNT(*) FROM bird_detections"
+        params = ()
+        
+        if session_name:
+            query += " WHERE session_name = ? ORDER BY filename, start_time_seconds"
+            count_query += " WHERE session_name = ?"
+            params = (session_name,)
+        else:
+            query += " ORDER BY created_at DESC"
+        
+        started = time.perf_counter()
+        rows_written = 0
+        
         try:
             with sqlite3.connect(self.db_path) as conn:
-                if session_name:
-                    query = """
-                        SELECT 
-                            start_time_seconds as 'Start (s)',
-                            end_time_seconds as 'End (s)',
-                            scientific_name as 'Scientific name',
-                            common_name as 'Common name',
-                            confidence as 'Confidence',
-                            session_name,
-                            filename,
-                            location,
-                            species,
-                            analysis_date
-                        FROM bird_detections 
-                        WHERE session_name = ? 
-                        ORDER BY filename, start_time_seconds
-                    """
-                    df = pd.read_sql_query(query, conn, params=(session_name,))
-                else:
-                    query = """
-                        SELECT 
-                            start_time_seconds as 'Start (s)',
-                            end_time_seconds as 'End (s)',
-                            scientific_name as 'Scientific name',
-                            common_name as 'Common name',
-                            confidence as 'Confidence',
-                            session_name,
-                            filename,
-                            location,
-                            species,
-                            analysis_date
-                        FROM bird_detections 
-                        ORDER BY created_at DESC
-                    """
-                    df = pd.read_sql_query(query, conn)
+                total = conn.execute(count_query, params).fetchone()[0]
+                cursor = conn.execute(query, params)
+                names = [description[0] for description in cursor.description]
                 
-                df.to_csv(output_path, index=False, encoding='utf-8-sig')
-                return True
+                if file_format == 'parquet':
+                    writer = _ParquetChunkWriter(tmp_path, names)
+                else:
+                    writer = _CsvChunkWriter(tmp_path, names, compress)
                 
+                try:
+                    while True:
+                        rows = cursor.fetchmany(chunk_size)
+                        
+                        if not rows:
+                            break
+                        
+                        writer.write(rows)
+                        rows_written += len(rows)
+                        
+                        if progress:
+                            elapsed = time.perf_counter() - started
+                            print(f"\r  {rows_written:,}/{total:,} rows ({rows_written / max(elapsed, 1e-9):,.0f} rows/s)", end="", flush=True)
+                finally:
+                    writer.close()
+            
+            os.replace(tmp_path, output_path)
+            
         except Exception as e:
-            print(f"CSV export error: {e}")
-            return False
+            if tmp_path.exists():
+                tmp_path.unlink()
+            
+            return {'success': False, 'error': str(e)}
+        
+        elapsed = time.perf_counter() - started
+        
+        if progress:
+            print()
+        
+        return {
+            'success': True,
+            'rows': rows_written,
+            'seconds': elapsed,
+            'rows_per_second': rows_written / max(elapsed, 1e-9)
+        }
+    
+    def export_to_csv(self, output_path: str, session_name: str = None, compress: bool = None, progress: bool = False) -> bool:
+        """検出結果をCSVにエクスポート（.gz の場合はgzip圧縮）"""
+        result = self.export_detections(output_path, session_name, 'csv', compress, progress=progress)
+        
+        if not result['success']:
+            print(f"CSV export error: {result['error']}")
+        
+        return result['success']
     
     def delete_session(self, session_name: str) -> bool:
         """セッションを削除"""
@@ -321,7 +1138,12 @@ class BirdNetSimpleDB:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM bird_detections WHERE session_name = ?", (session_name,))
                 deleted_count = cursor.rowcount
+                cursor.execute("DELETE FROM bird_events WHERE session_name = ?", (session_name,))
+                cursor.execute("DELETE FROM recording_files WHERE session_name = ?", (session_name,))
+                cursor.execute("DELETE FROM activity_rollup WHERE session_name = ?", (session_name,))
+                cursor.execute("DELETE FROM import_ledger WHERE session_name = ?", (session_name,))
                 conn.commit()
+                self._legacy_files.pop(session_name, None)
                 return deleted_count > 0
         except Exception as e:
             print(f"Delete session error: {e}")
@@ -6,6 +6,7 @@ BirdNet Database Viewer (Simple版)
 
 import os
 import sys
+import json
 import sqlite3
 import pandas as pd
 import argparse
@@ -14,7 +15,7 @@ from pathlib import Path
 # プロジェクトのlibディレクトリをパスに追加
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from db.simple_database import BirdNetSimpleDB
+from db.simple_database import BirdNetSimpleDB, EXPORT_CHUNK_SIZE
 
 def get_database_path():
     """データベースパスを取得"""
@@ -44,12 +45,23 @@ def show_sessions(db):
             print(f"    平均信頼度: {session['avg_confidence']:.3f}" if session['avg_confidence'] else "    平均信頼度: N/A")
             print()
 
-def show_detections(db, session_name=None, limit=10):
-    """検出結果を表示"""
+def show_detections(db, session_name=None, limit=10, filters=None, order=None, after=None):
+    """検出結果を表示
+    
+    filters, order, after のいずれかを指定した場合は query_detections でページ単位に表示し、
+    続きを表示するための --after の値を出力する
+    """
     print(f"\n[INFO] 検出結果 (最大{limit}件):")
     print("-" * 80)
     
-    detections = db.get_detections(session_name, limit)
+    next_cursor = None
+    
+    if filters or order or after:
+        rows, next_cursor = db.query_detections(session_name, order=order or 'confidence', after=after,
+                                                limit=limit, **(filters or {}))
+        detections = [row._asdict() for row in rows]
+    else:
+        detections = db.get_detections(session_name, limit)
     
     if not detections:
         print("  検出結果がありません")
@@ -60,7 +72,7 @@ def show_detections(db, session_name=None, limit=10):
         # 表示用カラムを選択
         display_columns = [
             'session_name', 'filename', 'start_time_seconds', 'end_time_seconds',
-            'scientific_name', 'common_name', 'confidence'
+            'scientific_name', 'common_name', 'confidence', 'detection_time_utc'
         ]
         
         available_columns = [col for col in display_columns if col in df.columns]
@@ -73,9 +85,54 @@ def show_detections(db, session_name=None, limit=10):
             
             print(df[available_columns].to_string(index=False))
             
-            if len(detections) == limit:
+            if next_cursor is not None:
+                print(f"\n  次のページ: --after '{json.dumps(next_cursor, ensure_ascii=False)}'")
+            elif after is None and len(detections) == limit:
                 print(f"\n  ⚠️  表示制限により{limit}件のみ表示しています")
 
+def show_events(db, session_name=None, limit=10):
+    """イベント（統合された検出）を表示"""
+    print(f"\n[INFO] イベント (最大{limit}件):")
+    print("-" * 80)
+    
+    events = db.get_events(session_name, limit)
+    
+    if not events:
+        print("  イベントがありません（import_results_simple.py --merge-gap で作成）")
+    else:
+        df = pd.DataFrame(events)
+        
+        display_columns = [
+            'session_name', 'filename', 'start_time_seconds', 'end_time_seconds',
+            'scientific_name', 'common_name', 'max_confidence', 'mean_confidence', 'hit_count'
+        ]
+        
+        pd.set_option('display.max_columns', None)
+        pd.set_option('display.width', None)
+        pd.set_option('display.max_colwidth', 30)
+        
+        print(df[display_columns].to_string(index=False))
+        
+        if len(events) == limit:
+            print(f"\n  ⚠️  表示制限により{limit}件のみ表示しています")
+
+def show_activity(db, bucket, session_name=None, min_confidence=0.0, utc_offset=0):
+    """種ごとの時間帯別検出数を表示"""
+    print(f"\n[INFO] 時間帯別検出数 ({bucket}, 信頼度 >= {min_confidence}):")
+    print("-" * 80)
+    
+    activity = db.get_activity(bucket, session_name=session_name, min_confidence=min_confidence, utc_offset=utc_offset)
+    
+    if not activity:
+        print("  絶対時刻のある検出結果がありません（import_results_simple.py --assign-times で設定）")
+    else:
+        df = pd.DataFrame(activity)
+        df['name'] = df['common_name'].fillna(df['scientific_name'])
+        
+        # 種 x 時間帯 の表
+        table = df.pivot_table(index='name', columns=bucket, values='detection_count', aggfunc='sum', fill_value=0)
+        print(table.to_string())
+
 def show_statistics(db, session_name=None):
     """統計情報を表示"""
     print(f"\n[INFO] 統計情報:")
@@ -122,21 +179,20 @@ def show_statistics(db, session_name=None):
             for species in stats['top_species']:
                 print(f"    {species['common_name']}: {species['detection_count']}件 (平均信頼度: {species['avg_confidence']:.3f})")
 
-def export_csv(db, output_file, session_name=None):
-    """検出結果をCSVにエクスポート"""
+def export_csv(db, output_file, session_name=None, compress=None, chunk_size=None):
+    """検出結果をCSV（.gz で圧縮）またはParquetにエクスポート"""
     try:
-        if db.export_to_csv(output_file, session_name):
+        result = db.export_detections(output_file, session_name, compress=compress,
+                                      chunk_size=chunk_size or EXPORT_CHUNK_SIZE, progress=True)
+        if result['success']:
             # ファイルサイズを確認
-            file_path = Path(output_file)
-            if file_path.exists():
-                file_size = file_path.stat().st_size
-                print(f"✅ CSVエクスポート完了: {output_file} ({file_size:,} bytes)")
-            else:
-                print(f"✅ CSVエクスポート完了: {output_file}")
+            file_size = Path(output_file).stat().st_size
+            print(f"✅ エクスポート完了: {output_file} ({result['rows']:,}件, {file_size:,} bytes, "
+                  f"{result['seconds']:.1f}秒, {result['rows_per_second']:,.0f}件/秒)")
         else:
-            print(f"❌ CSVエクスポート失敗: {output_file}")
+            print(f"❌ エクスポート失敗: {output_file} ({result['error']})")
     except Exception as e:
-        print(f"❌ CSVエクスポートエラー: {e}")
+        print(f"❌ エクスポートエラー: {e}")
 
 def main():
     parser = argparse.ArgumentParser(description='BirdNet Simple Database Viewer')
@@ -144,9 +200,22 @@ def main():
     parser.add_argument('--sessions', action='store_true', help='セッション一覧を表示')
     parser.add_argument('--detections', action='store_true', help='検出結果を表示')
     parser.add_argument('--stats', action='store_true', help='統計情報を表示')
+    parser.add_argument('--events', action='store_true', help='イベント（統合された検出）を表示')
+    parser.add_argument('--activity', choices=['hour', 'day', 'week'], help='種ごとの時間帯別検出数を表示')
+    parser.add_argument('--min-confidence', type=float, default=0.0, help='信頼度の下限（--detections, --activity）')
+    parser.add_argument('--max-confidence', type=float, help='--detections の信頼度の上限')
+    parser.add_argument('--species', help='--detections の学名')
+    parser.add_argument('--file', help='--detections の結果ファイルのパス')
+    parser.add_argument('--start', help='--detections の検出時刻（UTC）の開始 (例: 2024-06-29 04:00)')
+    parser.add_argument('--end', help='--detections の検出時刻（UTC）の終了')
+    parser.add_argument('--order', choices=['confidence', 'file', 'time'], help='--detections の並び順（指定するとページ単位で表示）')
+    parser.add_argument('--after', type=json.loads, help='--detections の続きを表示（前回表示された値）')
+    parser.add_argument('--utc-offset', type=float, default=0.0, help='--activity の現地時刻のUTCからの時差（時間）')
     parser.add_argument('--session-name', help='特定セッション名')
     parser.add_argument('--limit', type=int, default=10, help='表示件数制限（デフォルト: 10）')
-    parser.add_argument('--export', help='CSVファイルにエクスポート')
+    parser.add_argument('--export', help='CSVファイルにエクスポート（.csv.gz で圧縮、.parquet でParquet）')
+    parser.add_argument('--gzip', action='store_true', help='--export のCSVをgzip圧縮')
+    parser.add_argument('--chunk-size', type=int, help='--export で1回に読み込む行数')
     parser.add_argument('--all', action='store_true', help='全ての情報を表示')
     
     args = parser.parse_args()
@@ -161,7 +230,7 @@ def main():
     
     try:
         # 引数に応じて処理実行
-        if args.all or (not any([args.sessions, args.detections, args.stats, args.export])):
+        if args.all or (not any([args.sessions, args.detections, args.stats, args.events, args.activity, args.export])):
             # デフォルトまたは--allの場合、全ての情報を表示
             show_sessions(db)
             show_detections(db, args.session_name, args.limit)
@@ -171,13 +240,28 @@ def main():
                 show_sessions(db)
             
             if args.detections:
-                show_detections(db, args.session_name, args.limit)
+                filters = {
+                    'scientific_name': args.species,
+                    'min_confidence': args.min_confidence or None,
+                    'max_confidence': args.max_confidence,
+                    'file_path': args.file,
+                    'start_utc': args.start,
+                    'end_utc': args.end,
+                }
+                filters = {key: value for key, value in filters.items() if value is not None}
+                show_detections(db, args.session_name, args.limit, filters, args.order, args.after)
             
             if args.stats:
                 show_statistics(db, args.session_name)
             
+            if args.events:
+                show_events(db, args.session_name, args.limit)
+            
+            if args.activity:
+                show_activity(db, args.activity, args.session_name, args.min_confidence, args.utc_offset)
+            
             if args.export:
-                export_csv(db, args.export, args.session_name)
+                export_csv(db, args.export, args.session_name, args.gzip or None, args.chunk_size)
     
     except Exception as e:
         print(f"❌ エラーが発生しました: {e}")
@@ -8,6 +8,7 @@ import os
 import sys
 import subprocess
 import shutil
+import filecmp
 from pathlib import Path
 from datetime import datetime
 import glob
@@ -105,16 +106,36 @@ class BirdNetAnalyzer:
         print("  [4] 解析結果を表示")
         print("  [5] データベース統計")
         print("  [6] データベースビューアー")
+        print("  [7] 全モデルで一括解析 + DB保存")
         print("  [0] 終了")
         print()
     
-    def run_analysis(self, model_path=None, output_dir=None):
-        """BirdNet解析実行"""
+    def run_analysis(self, model_path=None, output_dir=None, classifiers=None):
+        """BirdNet解析実行
+        
+        classifiers: (モデル名, パス) のリスト。指定した場合は全モデルを1回の解析で実行
+        output_dir: 出力先（省略時は database/analysis_results/<実行日時>_<モデル名>）
+        
+        実行ごとに別のフォルダに出力するので、別のモデルの結果が以前の結果ファイルを上書きしない。
+        """
         if not self.get_audio_files():
             print("[ERROR] 解析する音声ファイルがありません。")
             print(f"   音声ファイルを {self.test_folder} に配置してください。")
             return False
         
+        if output_dir is None:
+            if classifiers:
+                run_name = "all_models"
+            elif model_path:
+                run_name = Path(model_path).parent.name
+            else:
+                run_name = "default"
+            
+            output_dir = self.results_folder / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{run_name}"
+        
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        
         print("[INFO] BirdNet解析を開始しています...")
         print("   (数分かかる場合があります)")
         print()
@@ -124,22 +145,30 @@ class BirdNetAnalyzer:
             sys.executable,
             str(self.project_root / "lib" / "birdnet" / "analyze.py"),
             "--i", str(self.test_folder),
-            "--o", str(self.results_folder),
+            "--o", str(output_dir),
             "--overlap", "2",
+            "--adaptive_overlap",  # 重なり無しで解析し、候補区間のみ重なり2で再解析
+            "--candidate_conf", "0.1",  # 再解析する候補の闾値（--min_conf と同じだとほぼ全区間が候補になる）
             "--rtype", "csv",
             "--sensitivity", "1.5",
             "--min_conf", "0.01"
         ]
         
+        # 複数モデルの場合（BirdNETの埋め込みは1回だけ計算される）
+        if classifiers:
+            cmd.extend(["--classifier", *[f"{name}={path}" for name, path in classifiers]])
+            cmd.append("--default_detections")  # デフォルトモデルの結果も同時に保存
+            cmd.extend(["--min_conf", "0.1"])  # カスタムモデル用の闾値
+            print(f"[INFO] 使用モデル: default, {', '.join(name for name, _ in classifiers)}")
         # カスタムモデルの場合
-        if model_path:
+        elif model_path:
             cmd.extend(["--classifier", str(model_path)])
             cmd.extend(["--min_conf", "0.1"])  # カスタムモデル用の闾値
             print(f"[INFO] カスタムモデル使用: {model_path.parent.name}")
         else:
             print("[INFO] デフォルトモデル使用")
         
-        print(f"[INFO] 出力先: {self.results_folder}")
+        print(f"[INFO] 出力先: {output_dir}")
         print()
         
         try:
@@ -149,7 +178,7 @@ class BirdNetAnalyzer:
             
             if result.returncode == 0:
                 print("[OK] 解析が完了しました！")
-                return str(self.results_folder)
+                return str(output_dir)
             else:
                 print("[ERROR] 解析中にエラーが発生しました:")
                 print(result.stderr)
@@ -164,23 +193,32 @@ class BirdNetAnalyzer:
         source_path = Path(source_dir)
         
         # CSVファイルを検索
-        csv_files = list(source_path.glob("*.BirdNET.results.csv"))
+        csv_files = list(source_path.glob("*.BirdNET.*results.csv"))
         
         if not csv_files:
             print("[WARNING] CSVファイルが見つかりませんでした")
             return []
         
+        # すでに保存先にある場合はコピーしない（コピーすると同じ結果が重複する）
+        if source_path.resolve() == self.results_folder.resolve():
+            return csv_files
+        
         moved_files = []
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         for csv_file in csv_files:
-            # 新しいファイル名を生成
+            # 新しいファイル名を生成（実行日時を付けないので、同じ結果は同じファイル名になる）
             safe_session_name = "".join(c for c in session_name if c.isalnum() or c in (' ', '_', '-')).strip()
             safe_session_name = safe_session_name.replace(' ', '_')
             
-            new_filename = f"{timestamp}_{safe_session_name}_{csv_file.name}"
+            new_filename = f"{safe_session_name}_{csv_file.name}"
             dest_path = self.results_folder / new_filename
             
+            # 同じ内容のファイルが保存済みならスキップ
+            if dest_path.exists() and filecmp.cmp(csv_file, dest_path, shallow=False):
+                moved_files.append(dest_path)
+                print(f"[INFO] 保存済み: {dest_path.name}")
+                continue
+            
             try:
                 # ファイルをコピー
                 shutil.copy2(csv_file, dest_path)
@@ -208,8 +246,9 @@ class BirdNetAnalyzer:
             session_name = suggestion['suggested_name']
             print(f"[INFO] 自動生成: {session_name}")
         
-        # 結果ファイルの確認（すでにdatabase/analysis_resultsにある）
-        csv_files = list(Path(source_dir).glob("*.BirdNET.results.csv"))
+        # 結果ファイルの確認（今回の実行の出力先 database/analysis_results/<実行日時>_<モデル名> にある）
+        # モデル名付きのファイル (*.BirdNET.<モデル名>.results.csv) も含む
+        csv_files = list(Path(source_dir).glob("*.BirdNET.*results.csv"))
         
         if not csv_files:
             print("[ERROR] 保存するファイルがありません")
@@ -224,7 +263,9 @@ class BirdNetAnalyzer:
             sys.executable,
             str(self.project_root / "lib" / "db" / "import_results_simple.py"),
             str(source_dir),
-            "--session", session_name
+            "--session", session_name,
+            "--model", model_name,
+            "--audio-dir", str(self.test_folder)
         ]
         
         try:
@@ -234,7 +275,7 @@ class BirdNetAnalyzer:
             if result.returncode == 0:
                 print("[OK] データベースへの保存が完了しました！")
                 print(f"[INFO] セッション: {session_name}")
-                print(f"[INFO] CSVファイル: {len(csv_files)}件を database/analysis_results/ に保存済み")
+                print(f"[INFO] CSVファイル: {len(csv_files)}件を {source_dir} に保存済み")
                 print()
                 
                 # 統計表示
@@ -318,6 +359,32 @@ class BirdNetAnalyzer:
         
         input("\nEnterキーを押してメニューに戻る...")
     
+    def analyze_all_models(self):
+        """デフォルトモデルと全カスタムモデルで一括解析"""
+        custom_models = self.get_custom_models()
+        
+        if not custom_models:
+            print("[ERROR] カスタムモデルが見つかりません！")
+            print("   カスタムモデルを先に作成してください。")
+            input("\nEnterキーを押してメニューに戻る...")
+            return
+        
+        print()
+        print(f"[INFO] default + カスタムモデル {len(custom_models)}件を1回の解析で実行します")
+        
+        classifiers = [(name, self.model_folder / name / "models.tflite") for name in custom_models]
+        
+        output_dir = self.run_analysis(classifiers=classifiers)
+        if output_dir:
+            # モデル名なしの結果ファイルは最初のカスタムモデルの結果
+            if self.save_to_database(output_dir, custom_models[0]):
+                print("[SUCCESS] 解析とDB保存が完了しました！")
+            else:
+                print("[WARNING] 解析は完了しましたが、DB保存に失敗しました")
+                print(f"   結果は {output_dir} で確認できます")
+        
+        input("\nEnterキーを押してメニューに戻る...")
+    
     def open_test_folder(self):
         """テストフォルダを開く"""
         try:
@@ -336,12 +403,12 @@ class BirdNetAnalyzer:
         
         # database/analysis_resultsの結果
         print("\n[INFO] 保存済み解析結果 (database/analysis_results/):")
-        result_files = list(self.results_folder.glob("*.csv"))
+        result_files = list(self.results_folder.rglob("*.csv"))
         
         if result_files:
             for file in sorted(result_files, key=lambda x: x.stat().st_mtime, reverse=True)[:5]:
                 mtime = datetime.fromtimestamp(file.stat().st_mtime)
-                print(f"   - {file.name} ({mtime.strftime('%Y-%m-%d %H:%M')})")
+                print(f"   - {file.relative_to(self.results_folder)} ({mtime.strftime('%Y-%m-%d %H:%M')})")
             
             if len(result_files) > 5:
                 print(f"   ... 他 {len(result_files) - 5} 件")
@@ -444,7 +511,7 @@ class BirdNetAnalyzer:
             self.display_menu()
             
             try:
-                choice = input("オプションを選択してください (0-6): ").strip()
+                choice = input("オプションを選択してください (0-7): ").strip()
                 
                 if choice == "1":
                     self.analyze_default()
@@ -458,6 +525,8 @@ class BirdNetAnalyzer:
                     self.show_database_stats()
                 elif choice == "6":
                     self.open_database_viewer()
+                elif choice == "7":
+                    self.analyze_all_models()
                 elif choice == "0":
                     print("[INFO] さようなら！")
                     break
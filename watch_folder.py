@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+"""
+BirdNet フォルダ監視デーモン
+録音機から同期される音声ファイルを監視し、届いたものから順に解析してデータベースに追加する
+
+- Linuxでは inotify で変更を待ち、それ以外は一定間隔でフォルダを走査する
+- サイズと更新時刻が --settle 秒変わらなくなるまで待ってから解析する（書き込み途中のファイル対策）
+- モデルは起動時に1回だけ読み込み、同じプロセスで解析を続ける
+- 解析待ちのキューは --queue-size 件までで、溢れたファイルは監視側で待たせる
+- 処理状況（キュー、遅延、スループット）を --status-file にJSONで書き出す
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import queue
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+PROJECT_ROOT = Path(__file__).parent
+BIRDNET_FOLDER = PROJECT_ROOT / "lib" / "birdnet"
+
+# BirdNETとデータベースのモジュールはスクリプトと同じ形式でimportする
+sys.path.append(str(BIRDNET_FOLDER))
+sys.path.append(str(PROJECT_ROOT / "lib" / "db"))
+
+import analyze
+import config as cfg
+import utils
+from simple_database import BirdNetSimpleDB
+from session_manager import LocationSpeciesDateManager
+from import_results_simple import import_result_file
+
+# 書き込みが終わったファイルを確認する間隔（秒）
+CHECK_INTERVAL = 1.0
+
+
+class InotifyWatcher:
+    """inotify でフォルダ（サブフォルダを含む）の変更を待つ（Linuxのみ）"""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, folders):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        # inotify のないOSでは AttributeError になり、ポーリングに切り替える
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.libc = libc
+        self.watches = {}
+
+        for folder in folders:
+            self._add_tree(folder)
+
+    def _add_tree(self, folder):
+        """フォルダとサブフォルダを監視対象に追加"""
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+
+        for root, _, _ in os.walk(folder):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), mask)
+
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {root}")
+
+            self.watches[wd] = root
+
+    def wait(self, timeout):
+        """変更を待つ
+
+        Returns:
+            (変更されたファイルのパスのリスト, 全体を走査し直す必要があるか)
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return [], False
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return [], False
+
+        paths = []
+        rescan = False
+        position = 0
+
+        while position + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, position)
+            name = data[position + self.EVENT.size:position + self.EVENT.size + length].rstrip(b"\0")
+            position += self.EVENT.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # イベントが溢れた場合は取りこぼしがあるので走査し直す
+                rescan = True
+            elif wd in self.watches and name:
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+
+                if mask & self.IN_ISDIR:
+                    # 新しいフォルダ（フォルダごと同期された場合は中身も）
+                    self._add_tree(path)
+                    rescan = True
+                else:
+                    paths.append(path)
+
+        return paths, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchFolderDaemon:
+    """フォルダを監視して解析とデータベースへの追加を続けるデーモン"""
+
+    def __init__(self, folders, db, session_name=None, model_name="default", settle_seconds=30.0,
+                 poll_interval=10.0, queue_size=100, status_file=None, utc_offset=0.0, use_inotify=True):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.db = db
+        self.session_name = session_name
+        self.model_name = model_name
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.status_file = Path(status_file) if status_file else None
+        self.utc_offset = utc_offset
+        self.use_inotify = use_inotify
+
+        # 解析待ちのキュー（上限あり）と、書き込みが終わるのを待っているファイル
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = {}  # パス -> {'size', 'mtime_ns', 'changed', 'first_seen'}
+        self.queued = {}  # キューに入れたか解析中のファイル -> 最初に見つけた時刻
+        self.finished = set()
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.scanned = threading.Event()
+        self.mode = "polling"
+        self.started_at = time.time()
+        self.stats = {
+            'processed_files': 0,
+            'failed_files': 0,
+            'detections_imported': 0,
+            'audio_seconds': 0.0,
+            'busy_seconds': 0.0,
+            'last_file': None,
+            'last_lag_seconds': None,
+            'last_error': None,
+        }
+
+    def is_audio_file(self, path):
+        """解析対象の音声ファイルか（同期ツールの一時ファイル .xxx は除く）"""
+        name = os.path.basename(path)
+        return not name.startswith(".") and name.rsplit(".", 1)[-1].lower() in cfg.ALLOWED_FILETYPES
+
+    def observe(self, path, now):
+        """ファイルの状態を記録し、変化していれば待ち時間をやり直す"""
+        if path in self.finished or path in self.queued or not self.is_audio_file(path):
+            return
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # 解析前に削除・移動された
+            with self.lock:
+                self.pending.pop(path, None)
+            return
+
+        entry = self.pending.get(path)
+
+        if entry is None:
+            if os.path.exists(analyze.get_result_file_name(path)):
+                self.finished.add(path)
+                return
+
+            # 最後の書き込みが十分前なら、書き込みは終わっているとみなす
+            changed = now if now - stat.st_mtime < self.settle_seconds else 0.0
+
+            with self.lock:
+                self.pending[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'changed': changed, 'first_seen': now}
+        elif (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, changed=now)
+
+    def scan(self, now):
+        """監視フォルダ全体を走査"""
+        for folder in self.folders:
+            for path in utils.collect_audio_files(folder):
+                self.observe(path, now)
+
+    def enqueue_ready(self, now):
+        """書き込みが終わったファイルを古い順にキューへ移す（キューが一杯なら次回）"""
+        for path in sorted(self.pending):
+            if self.queue.full():
+                break
+
+            self.observe(path, now)
+            entry = self.pending.get(path)
+
+            if entry is None or entry['size'] == 0 or now - entry['changed'] < self.settle_seconds:
+                continue
+
+            # 解析側が取り出す前に記録しておく（キューに入れるのはこのスレッドだけ）
+            with self.lock:
+                self.queued[path] = entry['first_seen']
+                del self.pending[path]
+
+            self.queue.put_nowait(path)
+
+    def next_timeout(self, now):
+        """次に待ち時間が終わるファイルまでの秒数（監視の待ち時間）"""
+        waits = [entry['changed'] + self.settle_seconds - now for entry in self.pending.values()]
+        return max(CHECK_INTERVAL, min([self.poll_interval, *waits]))
+
+    def open_watcher(self):
+        """inotify を使えれば InotifyWatcher を返す（使えなければ None でポーリング）"""
+        if not self.use_inotify:
+            return None
+
+        try:
+            watcher = InotifyWatcher(self.folders)
+        except (AttributeError, OSError, TypeError) as e:
+            print(f"[INFO] inotify が使えないためポーリングで監視します ({e})")
+            return None
+
+        self.mode = "inotify"
+        return watcher
+
+    def watch(self, watcher=None):
+        """監視スレッド: 変更を待ち、書き込みの終わったファイルをキューに入れる"""
+        # inotify の場合もイベントの取りこぼしに備えて時々走査する
+        rescan_interval = self.poll_interval * (30 if watcher else 1)
+        last_scan = last_check = 0.0
+
+        try:
+            while not self.stop_event.is_set():
+                now = time.time()
+
+                if now - last_scan >= rescan_interval:
+                    self.scan(now)
+                    last_scan = now
+                    self.scanned.set()
+
+                # 書き込み中は変更イベントが続くので、確認は一定間隔で行う
+                if now - last_check >= CHECK_INTERVAL:
+                    self.enqueue_ready(now)
+                    self.write_status()
+                    last_check = now
+
+                if watcher:
+                    paths, rescan = watcher.wait(self.next_timeout(time.time()))
+
+                    for path in paths:
+                        self.observe(path, time.time())
+
+                    if rescan:
+                        last_scan = 0.0
+                else:
+                    self.stop_event.wait(self.next_timeout(time.time()))
+        finally:
+            if watcher:
+                watcher.close()
+
+    def warm_up(self):
+        """モデルを読み込み、1回推論しておく（最初のファイルの解析を速くする）"""
+        print("[INFO] モデルを読み込んでいます...")
+        analyze.predictOutputs([np.zeros(int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE), dtype="float32")])
+
+    def suggest_session_name(self, path):
+        """監視フォルダ（サブフォルダではなく）と日付からセッション名を作成"""
+        folder = max((folder for folder in self.folders if path.startswith(folder + os.sep)), key=len, default=os.path.dirname(path))
+        return LocationSpeciesDateManager.suggest_session_name(folder)['suggested_name']
+
+    def analyze_file(self, path):
+        """1ファイルを解析して結果ファイルを保存
+
+        Returns:
+            音声の長さ（秒）、失敗した場合は None
+        """
+        config = cfg.getConfig()
+        _, length = analyze.getFileLength((path, config))
+
+        if length is None:
+            return None
+
+        results = {}
+
+        for unit in analyze.getWorkUnits(path, length):
+            *_, unit_results = analyze.analyzeUnit((*unit, config))
+
+            if unit_results is None:
+                return None
+
+            analyze.mergeResults(results, unit_results)
+
+        if not analyze.saveResults(results, path, length):
+            return None
+
+        return length
+
+    def process(self, path):
+        """解析してデータベースに追加"""
+        start = time.time()
+        print(f"[INFO] 解析: {path}", flush=True)
+
+        try:
+            length = self.analyze_file(path)
+
+            if length is None:
+                raise RuntimeError("解析に失敗しました")
+
+            session_name = self.session_name or self.suggest_session_name(path)
+            time_options = {'audio_dir': os.path.dirname(path), 'utc_offset': self.utc_offset}
+            result = import_result_file(self.db, Path(analyze.get_result_file_name(path)), session_name, self.model_name, time_options)
+
+            if not result['success']:
+                raise RuntimeError(result.get('error', 'インポートに失敗しました'))
+
+            end = time.time()
+
+            with self.lock:
+                self.stats['processed_files'] += 1
+                self.stats['detections_imported'] += result['detections_imported']
+                self.stats['audio_seconds'] += length
+                self.stats['last_lag_seconds'] = round(end - self.queued.get(path, start), 3)
+                self.stats['last_file'] = {
+                    'path': path,
+                    'session_name': session_name,
+                    'detections': result['detections_imported'],
+                    'audio_seconds': length,
+                    'processing_seconds': round(end - start, 3),
+                    'finished_at': datetime.fromtimestamp(end).isoformat(timespec='seconds'),
+                }
+
+            print(f"[OK] {result['detections_imported']}件を '{session_name}' に追加 ({end - start:.1f}秒)", flush=True)
+
+        except Exception as e:
+            utils.writeErrorLog(e)
+
+            with self.lock:
+                self.stats['failed_files'] += 1
+                self.stats['last_error'] = {'path': path, 'error': str(e)}
+
+            print(f"[ERROR] {path}: {e}", flush=True)
+
+        finally:
+            # 失敗したファイルも再起動するまでは解析し直さない
+            with self.lock:
+                self.stats['busy_seconds'] += time.time() - start
+                self.finished.add(path)
+                self.queued.pop(path, None)
+
+    def write_status(self, state="running"):
+        """処理状況をJSONファイルに書き出す（一時ファイルから置き換え）"""
+        if self.status_file is None:
+            return
+
+        now = time.time()
+
+        with self.lock:
+            waiting = [entry['first_seen'] for entry in self.pending.values()] + list(self.queued.values())
+            elapsed = max(now - self.started_at, 1e-9)
+            status = {
+                'state': state,
+                'pid': os.getpid(),
+                'mode': self.mode,
+                'folders': self.folders,
+                'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+                'updated_at': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                'queue': {'size': self.queue.qsize(), 'max_size': self.queue.maxsize},
+                'pending_files': len(self.pending),
+                'processed_files': self.stats['processed_files'],
+                'failed_files': self.stats['failed_files'],
+                'detections_imported': self.stats['detections_imported'],
+                'lag_seconds': {
+                    # 最後のファイルを見つけてからデータベースに入るまで
+                    'last_file': self.stats['last_lag_seconds'],
+                    # 待っている中で最も古いファイルを見つけてからの時間
+                    'oldest_waiting': round(now - min(waiting), 3) if waiting else 0.0,
+                },
+                'throughput': {
+                    'files_per_hour': round(self.stats['processed_files'] * 3600 / elapsed, 2),
+                    # 解析中の速さ（音声の秒数 / 処理時間、1以上ならリアルタイムより速い）
+                    'audio_seconds_per_second': round(self.stats['audio_seconds'] / self.stats['busy_seconds'], 2) if self.stats['busy_seconds'] else None,
+                    # 稼働時間のうち解析していた割合
+                    'utilization': round(self.stats['busy_seconds'] / elapsed, 3),
+                },
+                'last_file': self.stats['last_file'],
+                'last_error': self.stats['last_error'],
+            }
+
+        tmp_path = self.status_file.with_name(self.status_file.name + ".tmp")
+
+        try:
+            self.status_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps(status, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.status_file)
+        except OSError as e:
+            print(f"[WARNING] 状況ファイルを書き込めません: {e}")
+
+    def run(self, once=False):
+        """監視を開始し、停止されるまで解析を続ける
+
+        once=True の場合は、今あるファイルを解析し終えたら終了する
+        """
+        self.warm_up()
+
+        watcher = threading.Thread(target=self.watch, args=(self.open_watcher(),), name="watcher", daemon=True)
+        watcher.start()
+
+        print(f"[INFO] 監視を開始しました: {', '.join(self.folders)} ({self.mode})", flush=True)
+
+        # 解析はモデルを読み込んだメインスレッドで行う
+        while not self.stop_event.is_set():
+            try:
+                path = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                with self.lock:
+                    idle = self.scanned.is_set() and not self.pending and not self.queued
+
+                if once and idle:
+                    break
+
+                continue
+
+            self.process(path)
+            self.write_status()
+
+        self.stop_event.set()
+        watcher.join(timeout=self.poll_interval + 1)
+        self.write_status("stopped")
+        print("[INFO] 監視を終了しました", flush=True)
+
+
+def configure_analysis(args):
+    """analyze.py と同じ手順でBirdNETの設定を行う（start_analysis.py と同じ既定値）"""
+    cfg.MODEL_PATH = str(BIRDNET_FOLDER / cfg.MODEL_PATH)
+    cfg.LABELS_FILE = str(BIRDNET_FOLDER / cfg.LABELS_FILE)
+    cfg.LABELS = utils.readLines(cfg.LABELS_FILE)
+    cfg.TRANSLATED_LABELS_PATH = str(BIRDNET_FOLDER / cfg.TRANSLATED_LABELS_PATH)
+    cfg.MDATA_MODEL_PATH = str(BIRDNET_FOLDER / cfg.MDATA_MODEL_PATH)
+    cfg.CODES_FILE = str(BIRDNET_FOLDER / cfg.CODES_FILE)
+    cfg.ERROR_LOG_FILE = str(BIRDNET_FOLDER / cfg.ERROR_LOG_FILE)
+    cfg.CODES = analyze.loadCodes()
+
+    # カスタムモデル (model/<名前>/models.tflite)
+    if args.model != "default":
+        cfg.CUSTOM_CLASSIFIER = str(PROJECT_ROOT / "model" / args.model / "models.tflite")
+        cfg.LABELS_FILE, cfg.LABELS, cfg.APPLY_SIGMOID = analyze.loadClassifierLabels(cfg.CUSTOM_CLASSIFIER)
+
+    cfg.TRANSLATED_LABELS = cfg.LABELS
+    cfg.SPECIES_LIST_FILE = None
+    cfg.SPECIES_LIST = []
+
+    # 監視フォルダの共通の親からの相対パスで結果を保存する（複数フォルダでも名前が重ならない）
+    folders = [os.path.abspath(folder) for folder in args.i]
+    cfg.INPUT_PATH = os.path.commonpath(folders) if len(folders) > 1 else folders[0]
+    cfg.OUTPUT_PATH = os.path.abspath(args.o)
+    os.makedirs(cfg.OUTPUT_PATH, exist_ok=True)
+
+    min_conf = args.min_conf if args.min_conf is not None else (0.01 if args.model == "default" else 0.1)
+    cfg.MIN_CONFIDENCE = max(0.01, min(0.99, float(min_conf)))
+    cfg.SIGMOID_SENSITIVITY = max(0.5, min(1.0 - (float(args.sensitivity) - 1.0), 1.5))
+    cfg.SIG_OVERLAP = max(0.0, min(2.9, float(args.overlap)))
+    cfg.ADAPTIVE_OVERLAP = args.overlap > 0
+    cfg.CANDIDATE_CONFIDENCE = max(0.01, min(0.99, float(args.candidate_conf)))
+    cfg.RESULT_TYPE = "csv"
+    cfg.SKIP_EXISTING_RESULTS = True
+
+    # 1ファイルずつ解析するので、スレッドはTFLiteの推論に使う
+    cfg.CPU_THREADS = 1
+    cfg.TFLITE_THREADS = max(1, int(args.threads))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BirdNet フォルダ監視デーモン（新しい音声ファイルを自動で解析・DB保存）')
+    parser.add_argument('--i', nargs='+', default=[str(PROJECT_ROOT / "data" / "audio" / "test")], help='監視する音声フォルダ（複数可、既定: data/audio/test）')
+    parser.add_argument('--o', default=str(PROJECT_ROOT / "database" / "analysis_results"), help='解析結果の保存先（既定: database/analysis_results）')
+    parser.add_argument('--model', default='default', help='model/ 以下のカスタムモデル名（既定: default）')
+    parser.add_argument('--session', help='セッション名（省略時はフォルダ名と日付から自動生成）')
+    parser.add_argument('--db', help='データベースファイルパス（既定: database/result.db）')
+    parser.add_argument('--min_conf', type=float, help='信頼度の下限（既定: default 0.01, カスタムモデル 0.1）')
+    parser.add_argument('--sensitivity', type=float, default=1.5, help='検出感度 (0.5-1.5、既定: 1.5)')
+    parser.add_argument('--overlap', type=float, default=2.0, help='候補区間を再解析するときの重なり（秒、既定: 2.0）')
+    parser.add_argument('--candidate_conf', type=float, default=0.1, help='重なりありで再解析する候補区間の信頼度の下限（既定: 0.1）')
+    parser.add_argument('--threads', type=int, default=4, help='推論に使うスレッド数（既定: 4）')
+    parser.add_argument('--utc-offset', type=float, default=0.0, help='タイムゾーンのない録音時刻のUTCからの時差（時間）')
+    parser.add_argument('--settle', type=float, default=30.0, help='サイズと更新時刻がこの秒数変わらなければ書き込み完了とみなす（既定: 30）')
+    parser.add_argument('--poll-interval', type=float, default=10.0, help='ポーリングの間隔（秒、既定: 10）')
+    parser.add_argument('--queue-size', type=int, default=100, help='解析待ちキューの上限（既定: 100）')
+    parser.add_argument('--status-file', default=str(PROJECT_ROOT / "database" / "watch_status.json"), help='処理状況を書き出すJSONファイル')
+    parser.add_argument('--polling', action='store_true', help='inotify を使わずポーリングで監視')
+    parser.add_argument('--once', action='store_true', help='今あるファイルを解析したら終了')
+
+    args = parser.parse_args()
+
+    for folder in args.i:
+        os.makedirs(folder, exist_ok=True)
+
+    configure_analysis(args)
+
+    daemon = WatchFolderDaemon(
+        args.i,
+        BirdNetSimpleDB(args.db) if args.db else BirdNetSimpleDB(),
+        session_name=args.session,
+        model_name=args.model,
+        settle_seconds=max(0.0, args.settle),
+        poll_interval=max(0.5, args.poll_interval),
+        queue_size=max(1, args.queue_size),
+        status_file=args.status_file,
+        utc_offset=args.utc_offset,
+        use_inotify=not args.polling,
+    )
+
+    # Ctrl+C / SIGTERM では解析中のファイルを終えてから停止する
+    def stop(signum, frame):
+        print("\n[INFO] 停止しています（解析中のファイルの完了を待ちます）...", flush=True)
+        daemon.stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, stop)
+
+    daemon.run(once=args.once)
+
+
+if __name__ == "__main__":
+    main()